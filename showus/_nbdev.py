@@ -2,9 +2,105 @@
 
 __all__ = ["index", "modules", "custom_doc_links", "git_url"]
 
-index = {"Path.ls": "showus.ipynb",
+index = {"make_synthetic_corpus": "benchmark.ipynb",
+         "make_tiny_model": "benchmark.ipynb",
+         "benchmark_corpus": "benchmark.ipynb",
+         "run_benchmarks": "benchmark.ipynb",
+         "results_table": "benchmark.ipynb",
+         "compare_benchmarks": "benchmark.ipynb",
+         "make_synthetic_labels": "benchmark.ipynb",
+         "benchmark_fuzzy_index": "benchmark.ipynb",
+         "main": "serve.ipynb",
+         "non_o_confidence": "cascade.ipynb",
+         "cascade_word_probs": "cascade.ipynb",
+         "cascade_ner_predict": "cascade.ipynb",
+         "ensemble_word_probs": "distill.ipynb",
+         "write_soft_labels": "distill.ipynb",
+         "tokenize_and_align_soft_labels": "distill.ipynb",
+         "DataCollatorForDistillation": "distill.ipynb",
+         "DistillationTrainer": "distill.ipynb",
+         "distill": "distill.ipynb",
+         "distillation_report": "distill.ipynb",
+         "EarlyExitForTokenClassification": "earlyexit.ipynb",
+         "train_early_exit": "earlyexit.ipynb",
+         "early_exit_word_probs": "earlyexit.ipynb",
+         "early_exit_report": "earlyexit.ipynb",
+         "FuzzyIndex": "fuzzy.ipynb",
+         "fuzzy_literal_match": "fuzzy.ipynb",
+         "knowledge_bank_matcher": "fuzzy.ipynb",
+         "peak_rss_mb": "instrument.ipynb",
+         "current_rss_mb": "instrument.ipynb",
+         "Instrument": "instrument.ipynb",
+         "configure": "instrument.ipynb",
+         "span": "instrument.ipynb",
+         "spanned": "instrument.ipynb",
+         "count": "instrument.ipynb",
+         "count_padding": "instrument.ipynb",
+         "log": "instrument.ipynb",
+         "snapshot": "instrument.ipynb",
+         "reset": "instrument.ipynb",
+         "write_jsonl": "instrument.ipynb",
+         "to_prometheus": "instrument.ipynb",
+         "start_profiling": "instrument.ipynb",
+         "stop_profiling": "instrument.ipynb",
+         "load_manifest": "manifest.ipynb",
+         "save_manifest": "manifest.ipynb",
+         "update_paper_digests": "manifest.ipynb",
+         "stale_papers": "manifest.ipynb",
+         "save_paper_artifact": "manifest.ipynb",
+         "load_paper_artifact": "manifest.ipynb",
+         "incremental_predict": "manifest.ipynb",
+         "run_incremental": "manifest.ipynb",
+         "mine_hard_negatives": "mining.ipynb",
+         "training_set_report": "mining.ipynb",
+         "MMAP_SUPPORTED": "modelcache.ipynb",
+         "cache_checkpoint": "modelcache.ipynb",
+         "mmap_safetensors": "modelcache.ipynb",
+         "load_cached_model": "modelcache.ipynb",
+         "load_model": "modelcache.ipynb",
+         "process_memory": "modelcache.ipynb",
+         "drop_page_cache": "modelcache.ipynb",
+         "worker_load_report": "modelcache.ipynb",
+         "compare_model_loading": "modelcache.ipynb",
+         "StageStats": "overlap.ipynb",
+         "run_stages": "overlap.ipynb",
+         "overlapped_predict": "overlap.ipynb",
+         "pack_ner_data": "packing.ipynb",
+         "unpack_predictions": "packing.ipynb",
+         "tokenize_and_align_packed_labels": "packing.ipynb",
+         "supports_boundary_masking": "packing.ipynb",
+         "get_position_offset": "packing.ipynb",
+         "packed_attention_inputs": "packing.ipynb",
+         "DataCollatorForPackedTokenClassification": "packing.ipynb",
+         "BOUNDARY_MASK_MODEL_TYPES": "packing.ipynb",
+         "packed_ner_predict": "packing.ipynb",
+         "hash_args": "pipeline.ipynb",
+         "file_digest": "pipeline.ipynb",
+         "papers_digest": "pipeline.ipynb",
+         "checkpoint_digest": "pipeline.ipynb",
+         "Artifact": "pipeline.ipynb",
+         "stage": "pipeline.ipynb",
+         "predict_tags": "pipeline.ipynb",
+         "combine_ensemble_labels": "pipeline.ipynb",
+         "build_pipeline": "pipeline.ipynb",
+         "run_pipeline": "pipeline.ipynb",
+         "latency_percentiles": "serve.ipynb",
+         "ServerStats": "serve.ipynb",
+         "MicroBatcher": "serve.ipynb",
+         "LabelServer": "serve.ipynb",
+         "load_test": "serve.ipynb",
+         "benchmark_server": "serve.ipynb",
+         "write_job": "shard.ipynb",
+         "run_shard": "shard.ipynb",
+         "worker_command": "shard.ipynb",
+         "map_shards": "shard.ipynb",
+         "merge_shards": "shard.ipynb",
+         "reduce_shards": "shard.ipynb",
+         "run_sharded": "shard.ipynb",
+         "Path.ls": "showus.ipynb",
          "load_train_meta": "showus.ipynb",
          "load_papers": "showus.ipynb",
+         "iter_papers": "showus.ipynb",
          "AAAsTITLE": "showus.ipynb",
          "ZZZsTITLE": "showus.ipynb",
          "AAAsTEXT": "showus.ipynb",
@@ -13,32 +109,74 @@ index = {"Path.ls": "showus.ipynb",
          "load_paper": "showus.ipynb",
          "text2words": "showus.ipynb",
          "clean_training_text": "showus.ipynb",
+         "PaperText": "showus.ipynb",
+         "paper_text": "showus.ipynb",
          "extract_sentences": "showus.ipynb",
+         "section_stats": "showus.ipynb",
+         "classify_section": "showus.ipynb",
+         "prune_sections": "showus.ipynb",
+         "SECTION_KINDS": "showus.ipynb",
+         "DEFAULT_SECTION_POLICY": "showus.ipynb",
+         "section_pruning_report": "showus.ipynb",
          "shorten_sentences": "showus.ipynb",
          "find_sublist": "showus.ipynb",
          "get_ner_classlabel": "showus.ipynb",
          "tag_sentence": "showus.ipynb",
          "get_paper_ner_data": "showus.ipynb",
+         "SentenceDeduplicator": "showus.ipynb",
          "get_ner_data": "showus.ipynb",
          "write_ner_json": "showus.ipynb",
          "load_ner_datasets": "showus.ipynb",
+         "AdaptiveBatchSize": "showus.ipynb",
          "batched_write_ner_json": "showus.ipynb",
          "create_tokenizer": "showus.ipynb",
          "tokenize_and_align_labels": "showus.ipynb",
          "remove_nonoriginal_outputs": "showus.ipynb",
          "jaccard_similarity": "showus.ipynb",
          "compute_metrics": "showus.ipynb",
+         "train_ner": "showus.ipynb",
+         "get_paper_inference_sentences": "showus.ipynb",
          "get_ner_inference_data": "showus.ipynb",
          "batched_write_ner_inference_json": "showus.ipynb",
          "ner_predict": "showus.ipynb",
+         "StoredPredictions": "showus.ipynb",
          "batched_ner_predict": "showus.ipynb",
+         "tokenize_sentences": "showus.ipynb",
+         "predict_probs": "showus.ipynb",
+         "get_word_probs": "showus.ipynb",
+         "batched_word_probs": "showus.ipynb",
+         "get_sentence_dataset_labels": "showus.ipynb",
          "get_paper_dataset_labels": "showus.ipynb",
          "create_knowledge_bank": "showus.ipynb",
          "literal_match": "showus.ipynb",
+         "KnowledgeBank": "showus.ipynb",
+         "load_knowledge_bank": "showus.ipynb",
          "combine_matching_and_model": "showus.ipynb",
-         "filter_dataset_labels": "showus.ipynb"}
+         "filter_dataset_labels": "showus.ipynb",
+         "StreamingNERDataset": "streaming.ipynb",
+         "StreamingEpochCallback": "streaming.ipynb",
+         "window_sentences": "windowing.ipynb",
+         "stitch_window_probs": "windowing.ipynb",
+         "windowed_predict_probs": "windowing.ipynb",
+         "windowed_ner_predict": "windowing.ipynb"}
 
-modules = ["showus.py"]
+modules = ["benchmark.py",
+           "cascade.py",
+           "distill.py",
+           "earlyexit.py",
+           "fuzzy.py",
+           "instrument.py",
+           "manifest.py",
+           "mining.py",
+           "modelcache.py",
+           "overlap.py",
+           "packing.py",
+           "pipeline.py",
+           "serve.py",
+           "shard.py",
+           "showus.py",
+           "streaming.py",
+           "windowing.py"]
 
 doc_url = "https://qAp.github.io/showus/"
 
@@ -0,0 +1,462 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/benchmark.ipynb (unless otherwise specified).
+
+__all__ = ['make_synthetic_corpus', 'make_tiny_model', 'benchmark_corpus', 'run_benchmarks', 'results_table',
+           'compare_benchmarks', 'make_synthetic_labels', 'benchmark_fuzzy_index', 'main']
+
+# Cell
+import os, sys, time
+import json
+import random
+import collections
+import uuid
+import platform
+import argparse
+import subprocess
+from pathlib import Path
+import pandas as pd
+import torch
+import transformers
+from datasets import load_metric
+from transformers import BertConfig, BertForTokenClassification, BertTokenizerFast
+from transformers import AutoModelForTokenClassification
+from .showus import *
+from .fuzzy import FuzzyIndex, fuzzy_literal_match
+from .instrument import log, configure, snapshot
+
+# Cell
+_FILLER_WORDS = (
+    'the we of and in to a is that for with on as was were by this are from an be at which it '
+    'analysis results data study model sample participants effect response survey estimates table '
+    'figure among using between rates higher lower significant population years national health '
+    'education income students school children outcomes measures variables regression associated '
+    'respectively however furthermore methods based reported average group compared level').split()
+
+_NAME_WORDS = (
+    'Aging Health Education Income Nutrition Labor Housing Youth Family Employment Climate Ocean '
+    'Agriculture Retirement Dynamics Achievement Cognitive Adolescent Household Occupational Coastal '
+    'Drought Farm Rural Urban Veterans Wage Literacy Mobility Fisheries Wellbeing Disability').split()
+
+_NAME_PATTERNS = ['National Survey of {0} and {1}', '{0} Longitudinal Study', 'Survey of {0} {1}',
+                  '{0} and {1} Panel Study', 'Early {0} Study', 'National {0} {1} Database',
+                  '{0} {1} Census', 'Trends in {0} and {1}']
+
+_SECTION_TITLES = ['Abstract', 'Introduction', 'Background', 'Data', 'Methods', 'Results',
+                   'Discussion', 'Conclusion', 'Acknowledgements', 'References']
+
+
+def _make_datasets(num_datasets, rnd):
+    titles = {}
+    while len(titles) < num_datasets:
+        words = rnd.sample(_NAME_WORDS, 2)
+        title = rnd.choice(_NAME_PATTERNS).format(*words)
+        acronym = ''.join(word[0] for word in title.split() if word[0].isupper())
+        titles[title] = acronym
+    return list(titles.items())
+
+
+def _make_sentence(rnd, words_per_sentence, mention=None):
+    words = [rnd.choice(_FILLER_WORDS) for _ in range(rnd.randint(*words_per_sentence))]
+    if mention is not None:
+        words.insert(rnd.randrange(len(words) + 1), f'the {mention}')
+    sentence = ' '.join(words)
+    return sentence[0].upper() + sentence[1:] + '.'
+
+
+def make_synthetic_corpus(out_dir, num_papers=100, sections_per_paper=(3, 8),
+                          sentences_per_section=(5, 30), words_per_sentence=(8, 30),
+                          datasets_per_paper=(1, 3), mention_density=0.02, num_datasets=100,
+                          distractor_density=0., seed=0):
+    '''
+    Write papers in the competition's json format, and the meta data for them.
+    If `out_dir` already holds a corpus made with the same arguments, it's left as it is.
+
+    Args:
+        num_papers (int): Number of papers.
+        sections_per_paper, sentences_per_section, words_per_sentence, datasets_per_paper (tuple):
+            Smallest and largest number of each, drawn uniformly for every paper, section, etc.
+        mention_density (float): Probability that a sentence mentions one of the datasets
+            used in the paper.  Every dataset is mentioned at least once in each paper using it.
+        num_datasets (int): Number of distinct datasets.  Each is mentioned by its title,
+            or by its acronym.
+        distractor_density (float): Probability that a sentence mentions one of `num_datasets`
+            other datasets, which aren't in the meta data, like the unlabelled mentions in
+            the competition's papers.  These make hard negatives.
+        seed (int): Seed of the random number generator.
+
+    Returns:
+        out_dir (Path): Directory with the papers in 'train', 'train.csv', and 'sample_submission.csv'.
+    '''
+    out_dir = Path(out_dir)
+    params = dict(num_papers=num_papers, sections_per_paper=list(sections_per_paper),
+                  sentences_per_section=list(sentences_per_section),
+                  words_per_sentence=list(words_per_sentence),
+                  datasets_per_paper=list(datasets_per_paper),
+                  mention_density=mention_density, num_datasets=num_datasets, seed=seed)
+    if distractor_density:
+        params['distractor_density'] = distractor_density
+    pth_params = out_dir/'corpus.json'
+    if pth_params.exists() and json.load(open(pth_params, mode='r')) == params:
+        return out_dir
+
+    (out_dir/'train').mkdir(parents=True, exist_ok=True)
+    datasets = _make_datasets(num_datasets, random.Random(seed))
+    distractors = [(title, acronym) for title, acronym in _make_datasets(num_datasets, random.Random(f'{seed}-d'))
+                   if title not in dict(datasets) and acronym not in dict(datasets).values()]
+
+    rows = []
+    for i in range(num_papers):
+        rnd = random.Random(f'{seed}-{i}')
+        paper_id = str(uuid.UUID(int=rnd.getrandbits(128)))
+        used = rnd.sample(datasets, rnd.randint(*datasets_per_paper))
+        mentions = [rnd.choice([title, acronym]) for title, acronym in used]
+
+        titles = sorted(rnd.sample(_SECTION_TITLES, rnd.randint(*sections_per_paper)),
+                        key=_SECTION_TITLES.index)
+        def mention():
+            if rnd.random() < mention_density:
+                return rnd.choice(mentions)
+            if distractor_density and rnd.random() < distractor_density:
+                return rnd.choice(rnd.choice(distractors))
+
+        sections = [[_make_sentence(rnd, words_per_sentence, mention())
+                     for _ in range(rnd.randint(*sentences_per_section))]
+                    for _ in titles]
+        for label in mentions:
+            sentences = rnd.choice(sections)
+            sentences[rnd.randrange(len(sentences))] = _make_sentence(rnd, words_per_sentence, label)
+
+        paper = [{'section_title': title, 'text': ' '.join(sentences)}
+                 for title, sentences in zip(titles, sections)]
+        with open(out_dir/'train'/f'{paper_id}.json', mode='w') as f:
+            json.dump(paper, f)
+        for (title, _), label in zip(used, mentions):
+            rows.append({'Id': paper_id, 'pub_title': f'Synthetic paper {i}', 'dataset_title': title,
+                         'dataset_label': label,
+                         'cleaned_label': clean_training_text(label, lower=True)})
+
+    df = pd.DataFrame(rows)
+    df.to_csv(out_dir/'train.csv', index=False)
+    pd.DataFrame({'Id': df['Id'].unique(), 'PredictionString': ''}).to_csv(
+        out_dir/'sample_submission.csv', index=False)
+    with open(pth_params, mode='w') as f:
+        json.dump(params, f)
+    return out_dir
+
+# Cell
+def make_tiny_model(out_dir, hidden_size=32, num_hidden_layers=2, seed=0):
+    '''
+    Save a randomly initialised BERT for token classification, and its tokenizer,
+    whose vocabulary is the words used by `make_synthetic_corpus`, and single
+    characters for anything else.  Load them with `create_tokenizer(out_dir)` and
+    `AutoModelForTokenClassification.from_pretrained(out_dir)`.
+    '''
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    chars = [chr(c) for c in range(33, 127)]
+    words = {w for word in _FILLER_WORDS + _NAME_WORDS + ' '.join(_NAME_PATTERNS).split()
+             for w in (word, word.capitalize())}
+    vocab = (['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + sorted(words - set(chars)) + chars
+             + ['##' + c for c in chars])
+    with open(out_dir/'vocab.txt', mode='w') as f:
+        f.write('\n'.join(dict.fromkeys(vocab)))
+    tokenizer = BertTokenizerFast(str(out_dir/'vocab.txt'), do_lower_case=False, model_max_length=512)
+    tokenizer.save_pretrained(out_dir)
+
+    torch.manual_seed(seed)
+    classlabel = get_ner_classlabel()
+    config = BertConfig(vocab_size=len(tokenizer) + 8, hidden_size=hidden_size,
+                        num_hidden_layers=num_hidden_layers, num_attention_heads=2,
+                        intermediate_size=2 * hidden_size, max_position_embeddings=512,
+                        num_labels=classlabel.num_classes,
+                        id2label=dict(enumerate(classlabel.names)),
+                        label2id={name: i for i, name in enumerate(classlabel.names)})
+    BertForTokenClassification(config).save_pretrained(out_dir)
+    return out_dir
+
+# Cell
+def benchmark_corpus(corpus_dir, model_dir, work_dir=None, repeat=3, stages=None, metric=None,
+                     per_device_batch_size=16):
+    '''
+    Time each stage on the corpus in `corpus_dir`, with the model in `model_dir`.
+
+    Args:
+        repeat (int): Number of times to run each stage.
+        stages (None, list): Names of the stages to time.  All of them if None.  The
+            stages that the selected ones depend on are still run, once, untimed.
+        metric: Passed to `ner_predict`.
+
+    Returns:
+        results (list): A dict for each stage, with the 'stage', the 'seconds' taken
+            by the fastest run, the 'mean_seconds', the number of 'items' processed,
+            and their 'unit', or an 'error' if the stage failed.
+    '''
+    corpus_dir = Path(corpus_dir)
+    work_dir = Path(work_dir or corpus_dir)
+    dir_json = corpus_dir/'train'
+    results = []
+
+    def timed(stage, fn, items=None, unit='papers', required=False):
+        if stages is not None and stage not in stages:
+            return fn() if required else None
+        times = []
+        try:
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                out = fn()
+                times.append(time.perf_counter() - t0)
+        except Exception as e:
+            if required:
+                raise
+            log(f'{stage}: {type(e).__name__}: {e}')
+            results.append({'stage': stage, 'error': f'{type(e).__name__}: {e}'})
+            return None
+        items = items(out) if callable(items) else items
+        results.append({'stage': stage, 'seconds': min(times), 'mean_seconds': sum(times) / len(times),
+                        'items': items, 'unit': unit,
+                        'items_per_second': items / min(times) if min(times) > 0 else None})
+        log(f'{stage}: {min(times):.3f} s for {items} {unit}')
+        return out
+
+    df = load_train_meta(corpus_dir/'train.csv', group_id=True)
+    sample_submission = pd.read_csv(corpus_dir/'sample_submission.csv')
+    paper_ids = list(sample_submission['Id'])
+    classlabel = get_ner_classlabel()
+
+    papers = timed('load_papers', lambda: load_papers(dir_json, paper_ids), len(paper_ids),
+                   required=True)
+
+    timed('get_ner_data', lambda: get_ner_data(papers, df, classlabel=classlabel, shuffle=False),
+          len(df))
+
+    test_rows, paper_length = timed(
+        'get_ner_inference_data', lambda: get_ner_inference_data(papers, sample_submission),
+        len(paper_ids), required=True)
+    sentences = [[word for word, _ in row] for row in test_rows]
+
+    pth_test = work_dir/'test_ner.json'
+    timed('batched_write_ner_inference_json',
+          lambda: batched_write_ner_inference_json(papers, sample_submission, pth=pth_test),
+          len(paper_ids), required=True)
+
+    dataset_labels = dict(zip(df['Id'], df['dataset_label']))
+    labels = [[text2words(label) for label in dataset_labels[paper_id].split('|')] for paper_id in paper_ids]
+    sentence_labels = [labels_ for labels_, n in zip(labels, paper_length) for _ in range(n)]
+    timed('find_sublist',
+          lambda: [find_sublist(sentence, label)
+                   for sentence, labels_ in zip(sentences, sentence_labels) for label in labels_],
+          len(sentences), unit='sentences')
+
+    tags = [[classlabel.int2str(tag) for _, tag in tag_sentence(sentence, labels_, classlabel)[1]]
+            for sentence, labels_ in zip(sentences, sentence_labels)]
+    timed('get_paper_dataset_labels', lambda: get_paper_dataset_labels(str(pth_test), paper_length, tags),
+          len(sentences), unit='sentences')
+
+    if stages is None or {'ner_predict', 'batched_word_probs'} & set(stages):
+        tokenizer = create_tokenizer(model_dir)
+        model = AutoModelForTokenClassification.from_pretrained(model_dir)
+        timed('ner_predict',
+              lambda: ner_predict(str(pth_test), tokenizer=tokenizer, model=model, metric=metric,
+                                  per_device_train_batch_size=per_device_batch_size,
+                                  per_device_eval_batch_size=per_device_batch_size),
+              len(sentences), unit='sentences')
+        timed('batched_word_probs',
+              lambda: batched_word_probs(sentences, tokenizer=tokenizer, model=model,
+                                         batch_size=per_device_batch_size),
+              len(sentences), unit='sentences')
+
+    knowledge_bank = timed('create_knowledge_bank', lambda: create_knowledge_bank(corpus_dir/'train.csv'),
+                           len(df), required=True)
+    literal_preds = timed('literal_match',
+                          lambda: [literal_match(papers[paper_id], knowledge_bank) for paper_id in paper_ids],
+                          len(paper_ids), required=True)
+
+    indexed_bank = timed('KnowledgeBank.from_meta', lambda: KnowledgeBank.from_meta(corpus_dir/'train.csv'),
+                         len(df), required=True)
+    indexed_bank.save(work_dir/'knowledge_bank.pkl')
+    timed('load_knowledge_bank', lambda: load_knowledge_bank(work_dir/'knowledge_bank.pkl'), len(df))
+    timed('PaperText', lambda: [PaperText(papers[paper_id]).offsets for paper_id in paper_ids], len(paper_ids))
+    timed('KnowledgeBank.match', lambda: [indexed_bank.match(papers[paper_id]) for paper_id in paper_ids],
+          len(paper_ids))
+    fuzzy_index = timed('FuzzyIndex', lambda: FuzzyIndex(indexed_bank), len(df), required=True)
+    timed('fuzzy_literal_match',
+          lambda: [fuzzy_literal_match(papers[paper_id], fuzzy_index) for paper_id in paper_ids],
+          len(paper_ids))
+
+    all_labels = combine_matching_and_model(
+        literal_preds, get_paper_dataset_labels(pth_test, paper_length, tags))
+    timed('filter_dataset_labels', lambda: filter_dataset_labels(all_labels), len(paper_ids))
+    return results
+
+# Cell
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True, cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError, NameError):
+        return None
+
+
+def run_benchmarks(sizes=(100, 1_000), repeat=3, stages=None, work_dir='showus_benchmark',
+                   pth_results=None, metric=None, seed=0, **corpus_kwargs):
+    '''
+    Time each stage on synthetic corpora of each of `sizes` papers, and write the results
+    to json file `pth_results`, which defaults to 'benchmark_<commit>.json'.
+
+    Args:
+        work_dir (str, Path): Where the corpora and the model are kept, and reused
+            when run again with the same arguments.
+        corpus_kwargs: Passed to `make_synthetic_corpus`.
+
+    Returns:
+        results (dict): With the 'commit', versions, arguments, and under 'results',
+            a dict like those returned by `benchmark_corpus` for each stage and size,
+            with the number of papers in 'num_papers'.
+    '''
+    work_dir = Path(work_dir)
+    model_dir = make_tiny_model(work_dir/'model', seed=seed)
+    commit = _git_commit()
+    results = {'commit': commit, 'time': time.time(), 'python': platform.python_version(),
+               'torch': torch.__version__, 'transformers': transformers.__version__,
+               'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+               'repeat': repeat, 'seed': seed, 'corpus': corpus_kwargs, 'results': []}
+
+    for num_papers in sizes:
+        log(f'Benchmarking on {num_papers} papers...')
+        corpus_dir = make_synthetic_corpus(work_dir/f'corpus_{num_papers}', num_papers=num_papers,
+                                           seed=seed, **corpus_kwargs)
+        for result in benchmark_corpus(corpus_dir, model_dir, repeat=repeat, stages=stages, metric=metric):
+            results['results'].append({'num_papers': num_papers, **result})
+
+    pth_results = pth_results or f"benchmark_{(commit or 'unknown')[:10]}.json"
+    with open(pth_results, mode='w') as f:
+        json.dump(results, f, indent=1)
+    return results
+
+# Cell
+def _load_results(results):
+    if isinstance(results, (str, Path)):
+        results = json.load(open(results, mode='r'))
+    return results
+
+
+def results_table(results):
+    '''
+    Seconds taken by each stage (rows) for each corpus size (columns).
+
+    Args:
+        results (dict, str, Path): Returned by `run_benchmarks`, or the json file it wrote.
+    '''
+    df = pd.DataFrame(_load_results(results)['results'])
+    if 'seconds' not in df:
+        df['seconds'] = float('nan')
+    return df.pivot_table(index='stage', columns='num_papers', values='seconds', sort=False)
+
+
+def compare_benchmarks(base, new, tolerance=0.1):
+    '''
+    Compare the timings in `new` with those in `base`.
+
+    Args:
+        base, new (dict, str, Path): Returned by `run_benchmarks`, or the json file it wrote.
+        tolerance (float): Relative slow-down beyond which a stage is marked as a regression.
+
+    Returns:
+        df (pd.DataFrame): For each stage and size, seconds taken in 'base' and 'new',
+            their 'ratio', and whether it's a 'regression'.
+    '''
+    base, new = results_table(base), results_table(new)
+    df = pd.concat({'base': base.stack(), 'new': new.stack()}, axis=1).dropna()
+    df['ratio'] = df['new'] / df['base']
+    df['regression'] = df['ratio'] > 1 + tolerance
+    return df
+
+# Cell
+def make_synthetic_labels(num_labels, seed=0):
+    '''
+    Dataset labels for a knowledge bank of `num_labels` labels.  Up to 2,000 are the
+    titles and acronyms of datasets that `make_synthetic_corpus` mentions in papers.
+    The others are titles of the same forms, like 'National Survey of {0} and {1}',
+    filled with words drawn from a vocabulary of made-up words with a long-tailed
+    distribution, and with words from the papers' dataset titles, a third of the time.
+    '''
+    rnd = random.Random(seed)
+    labels = dict.fromkeys(label for dataset in _make_datasets(min(num_labels // 2, 1_000), random.Random(seed))
+                           for label in dataset)
+    patterns = _NAME_PATTERNS + ['{0} {1} Survey', 'Survey of {0} {1} {2}', '{0} {1} {2} Study', '{0} {1}']
+    while len(labels) < num_labels:
+        words = [rnd.choice(_NAME_WORDS) if rnd.random() < 1 / 3 else f'w{int(rnd.paretovariate(0.5)) % 10**6}'
+                 for _ in range(3)]
+        labels[rnd.choice(patterns).format(*words)] = None
+    return list(labels)[:num_labels]
+
+
+def benchmark_fuzzy_index(sizes=(1_000, 10_000, 100_000), num_papers=100, threshold=0.5,
+                          work_dir='showus_benchmark', seed=0):
+    '''
+    Time building a `FuzzyIndex` of each of `sizes` synthetic labels, and matching papers
+    from a synthetic corpus with it.
+
+    Returns:
+        df (pd.DataFrame): For each size, seconds to build the index, number of postings,
+            papers and words matched per second, and labels proposed and matches found per paper.
+    '''
+    corpus_dir = make_synthetic_corpus(Path(work_dir)/f'corpus_{num_papers}', num_papers=num_papers, seed=seed)
+    papers = list(load_papers(corpus_dir/'train', pd.read_csv(corpus_dir/'sample_submission.csv')['Id']).values())
+    num_words = sum(len(section['text'].split()) for paper in papers for section in paper)
+
+    rows = []
+    for num_labels in sizes:
+        labels = make_synthetic_labels(num_labels, seed=seed)
+        t0 = time.perf_counter()
+        index = FuzzyIndex(labels, threshold=threshold)
+        build_time = time.perf_counter() - t0
+
+        enabled = configure().enabled
+        configure(enabled=True)
+        before = snapshot()['counters']
+        t0 = time.perf_counter()
+        matches = [index.match(paper) for paper in papers]
+        match_time = time.perf_counter() - t0
+        counters = collections.Counter(snapshot()['counters'])
+        counters.subtract(before)
+        configure(enabled=enabled)
+        rows.append({'labels': num_labels, 'build_s': build_time,
+                     'postings': sum(len(ids) for ids in index.postings.values()),
+                     'papers_per_s': len(papers) / match_time, 'words_per_s': num_words / match_time,
+                     'candidates_per_paper': counters.get('fuzzy_candidates', 0) / len(papers),
+                     'verified_per_paper': counters.get('fuzzy_verified', 0) / len(papers),
+                     'matches_per_paper': sum(len(m) for m in matches) / len(papers)})
+        log(f'{num_labels} labels: {rows[-1]}')
+    return pd.DataFrame(rows)
+
+# Cell
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time each stage on synthetic corpora of several sizes.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1_000],
+                        help='Numbers of papers.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', nargs='*', default=None, help='Only time these stages.')
+    parser.add_argument('--work-dir', default='showus_benchmark')
+    parser.add_argument('--out', default=None,
+                        help='Json file for the results.  Defaults to benchmark_<commit>.json.')
+    parser.add_argument('--compare', default=None,
+                        help='Results of an earlier run to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--mention-density', type=float, default=0.02)
+    parser.add_argument('--distractor-density', type=float, default=0.)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--metric', default='seqeval')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(sizes=args.sizes, repeat=args.repeat, stages=args.stages,
+                             work_dir=args.work_dir, pth_results=args.out,
+                             metric=load_metric(args.metric), seed=args.seed,
+                             mention_density=args.mention_density,
+                             distractor_density=args.distractor_density)
+    print(results_table(results).to_string(float_format='{:.3f}'.format))
+    if args.compare is not None:
+        df = compare_benchmarks(args.compare, results, tolerance=args.tolerance)
+        print(df.to_string(float_format='{:.3f}'.format))
+        if df['regression'].any():
+            sys.exit(1)
\ No newline at end of file
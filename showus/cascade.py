@@ -0,0 +1,105 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/cascade.ipynb (unless otherwise specified).
+
+__all__ = ['non_o_confidence', 'cascade_word_probs', 'cascade_ner_predict']
+
+# Cell
+import os, sys, time
+import json
+import numpy as np
+from .showus import *
+from .instrument import span, count, log
+
+# Cell
+def non_o_confidence(word_probs, classlabel=get_ner_classlabel()):
+    '''
+    Largest probability of a class other than 'O' over the words of each sentence.
+    Sentences without words have a confidence of 0.
+    '''
+    o = classlabel.str2int('O')
+    return np.array([np.delete(prob, o, axis=1).max() if len(prob) else 0.
+                     for prob in word_probs])
+
+# Cell
+def _fill_truncated(prob, num_words):
+    missing = num_words - len(prob)
+    if missing > 0 and len(prob):
+        prob = np.concatenate([prob, np.repeat(prob[-1:], missing, axis=0)])
+    return prob
+
+
+def _add_word_probs(word_probs, idx, sentences, tokenizer, model, batch_size=64):
+    '''
+    Add the probabilities of `model` for the sentences at `idx` to `word_probs`, in place.
+    '''
+    if not len(idx):
+        return
+    probs = batched_word_probs([sentences[i] for i in idx], tokenizer, model, batch_size=batch_size)
+    for i, prob in zip(idx, probs):
+        word_probs[i] = word_probs[i] + _fill_truncated(prob, len(sentences[i]))
+
+
+def cascade_word_probs(sentences, small=None, large=(), band=(0.05, 0.95), batch_size=64,
+                       evaluate=False):
+    '''
+    Args:
+        sentences (list): Each element is a list of words.
+        small (tuple): (tokenizer, model) of the small model, which scores every sentence.
+        large (list): (tokenizer, model) of each of the larger models.
+        band (tuple): Sentences whose `non_o_confidence` from the small model is within
+            this interval are escalated to the larger models.
+        evaluate (bool): If True, the full ensemble is also run on all sentences, to
+            measure agreement with it.  This defeats the purpose of the cascade,
+            so is only for choosing `band`.
+
+    Returns:
+        word_probs (list): For each sentence, an np.array of shape
+            (number of words, number of classes).
+        stats (dict): 'escalated': fraction of sentences escalated.  If `evaluate`,
+            also 'word_agreement' and 'sentence_agreement': fractions of words, and of
+            sentences, whose predicted tags agree with those of the full ensemble.
+    '''
+    low, high = band
+    small_probs = [_fill_truncated(prob, len(sentence)) for prob, sentence
+                   in zip(batched_word_probs(sentences, *small, batch_size=batch_size), sentences)]
+    confidence = non_o_confidence(small_probs)
+    escalate = np.flatnonzero((confidence >= low) & (confidence <= high))
+
+    word_probs = list(small_probs)
+    for tokenizer, model in large:
+        _add_word_probs(word_probs, escalate, sentences, tokenizer, model, batch_size=batch_size)
+    for i in escalate:
+        word_probs[i] = word_probs[i] / (1 + len(large))
+
+    stats = {'escalated': len(escalate) / max(len(sentences), 1)}
+    if evaluate:
+        # Only the larger models' probabilities of the sentences not escalated are missing.
+        full = list(word_probs)
+        rest = np.setdiff1d(np.arange(len(sentences)), escalate)
+        for tokenizer, model in large:
+            _add_word_probs(full, rest, sentences, tokenizer, model, batch_size=batch_size)
+        for i in rest:
+            full[i] = full[i] / (1 + len(large))
+        agree = [prob.argmax(axis=1) == f.argmax(axis=1) for prob, f in zip(word_probs, full)]
+        stats['word_agreement'] = int(sum(a.sum() for a in agree)) / max(sum(len(a) for a in agree), 1)
+        stats['sentence_agreement'] = int(sum(a.all() for a in agree)) / max(len(agree), 1)
+    return word_probs, stats
+
+# Cell
+def cascade_ner_predict(pth, small=None, large=(), band=(0.05, 0.95), batch_size=64, evaluate=False):
+    '''
+    Like `batched_ner_predict`, but with the cascade of `cascade_word_probs`.
+
+    Returns:
+        predictions (list): Each element is a list of predicted label ids for the
+            words in a sentence in `pth`.
+        stats (dict): As returned by `cascade_word_probs`.
+    '''
+    sentences = [json.loads(line)['tokens'] for line in open(pth, mode='r')]
+
+    with span('cascade_predict'):
+        word_probs, stats = cascade_word_probs(sentences, small=small, large=large, band=band,
+                                               batch_size=batch_size, evaluate=evaluate)
+        predictions = [prob.argmax(axis=1).tolist() for prob in word_probs]
+    count('sentences_escalated', round(stats['escalated'] * len(sentences)))
+    log(', '.join(f'{k}: {v:.3f}' for k, v in stats.items()))
+    return predictions, stats
\ No newline at end of file
@@ -0,0 +1,205 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/distill.ipynb (unless otherwise specified).
+
+__all__ = ['ensemble_word_probs', 'write_soft_labels', 'tokenize_and_align_soft_labels', 'DataCollatorForDistillation',
+           'DistillationTrainer', 'distill', 'distillation_report']
+
+# Cell
+import os, sys, time
+import json
+import itertools
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from transformers import DataCollatorForTokenClassification, Trainer
+from .showus import *
+from .instrument import span, count, log
+
+# Cell
+def ensemble_word_probs(sentences, models, batch_size=64):
+    '''
+    Word-level class probabilities, averaged over the models of an ensemble.
+
+    Args:
+        sentences (list): Each element is a list of words.
+        models (list): (tokenizer, model) of each model in the ensemble.
+
+    Returns:
+        word_probs (list): For each sentence, an np.array of shape
+            (number of words, number of classes).  Words truncated by a
+            model's tokenizer are given its probabilities of the last word kept.
+    '''
+    word_probs = [0.] * len(sentences)
+    for tokenizer, model in models:
+        for i, prob in enumerate(batched_word_probs(sentences, tokenizer, model, batch_size=batch_size)):
+            missing = len(sentences[i]) - len(prob)
+            if missing > 0 and len(prob):
+                prob = np.concatenate([prob, np.repeat(prob[-1:], missing, axis=0)])
+            word_probs[i] = word_probs[i] + prob
+    return [prob / len(models) for prob in word_probs]
+
+
+def write_soft_labels(pth, models, pth_out='train_ner_soft.json', batch_size=64, chunk_size=4_096,
+                      decimals=4):
+    '''
+    Store the ensemble's averaged word probabilities for the sentences in json file `pth`.
+
+    Args:
+        pth (str, Path): Json file of sentences, as written by `write_ner_json` or
+            `batched_write_ner_inference_json`.  Their 'ner_tags', if any, are ignored.
+        models (list): (tokenizer, model) of each model in the ensemble.
+        pth_out (str, Path): Json file to write to.  If it already has sentences, those
+            are skipped.
+        chunk_size (int): Number of sentences predicted and written at a time.
+        decimals (int): Probabilities are rounded to this many decimals.
+
+    Returns:
+        num_sentences (int): Number of sentences in `pth_out`.
+    '''
+    done = 0
+    if Path(pth_out).exists():
+        with open(pth_out, mode='r+') as f:
+            offset = 0
+            for line in f:
+                if not line.endswith('\n'):  # Partly written when interrupted.
+                    break
+                done, offset = done + 1, offset + len(line.encode('utf-8'))
+            f.truncate(offset)
+        if done:
+            log(f'Resuming after {done} sentences.')
+
+    num_sentences = done
+    with open(pth, mode='r') as f, open(pth_out, mode='a') as f_out:
+        lines = itertools.islice(f, done, None)
+        for chunk in iter(lambda: list(itertools.islice(lines, chunk_size)), []):
+            sentences = [json.loads(line)['tokens'] for line in chunk]
+            with span('ensemble_predict', log=False):
+                word_probs = ensemble_word_probs(sentences, models, batch_size=batch_size)
+            for sentence, prob in zip(sentences, word_probs):
+                f_out.write(json.dumps({'tokens': sentence, 'ner_tags': prob.argmax(axis=1).tolist(),
+                                        'soft_labels': np.round(prob, decimals).tolist()}) + '\n')
+            f_out.flush()
+            num_sentences += len(sentences)
+            count('sentences_soft_labelled', len(sentences))
+    return num_sentences
+
+# Cell
+def tokenize_and_align_soft_labels(examples, tokenizer=None, label_all_tokens=True):
+    '''
+    Like `tokenize_and_align_labels`, and also adds 'soft_labels': for each sub-token,
+    the class probabilities of the word it belongs to, or zeros where its label is -100.
+    '''
+    tokenized_inputs = tokenize_and_align_labels(examples, tokenizer=tokenizer,
+                                                 label_all_tokens=label_all_tokens)
+    soft_labels = []
+    for probs, word_ids, labels in zip(examples['soft_labels'], tokenized_inputs['word_ids'],
+                                       tokenized_inputs['labels']):
+        zeros = [0.] * len(probs[0])
+        soft_labels.append([zeros if label == -100 else probs[word_idx]
+                            for word_idx, label in zip(word_ids, labels)])
+    tokenized_inputs['soft_labels'] = soft_labels
+    return tokenized_inputs
+
+
+class DataCollatorForDistillation(DataCollatorForTokenClassification):
+    '''
+    `DataCollatorForTokenClassification` that also pads the 'soft_labels' with zeros,
+    if there are any, e.g. not for evaluation batches.
+    '''
+    def __call__(self, features):
+        if 'soft_labels' not in features[0]:
+            return super().__call__(features)
+        soft_labels = [feature.pop('soft_labels') for feature in features]
+        batch = super().__call__(features)
+        length = batch['labels'].shape[1]
+        num_classes = len(soft_labels[0][0])
+        padded = torch.zeros(len(features), length, num_classes)
+        for i, soft in enumerate(soft_labels):
+            soft = torch.tensor(soft, dtype=torch.float)[:length]
+            if self.tokenizer.padding_side == 'left':
+                padded[i, length - len(soft):] = soft
+            else:
+                padded[i, :len(soft)] = soft
+        batch['soft_labels'] = padded
+        return batch
+
+
+class DistillationTrainer(Trainer):
+    '''
+    `Trainer` whose loss is a mix of the KL divergence from the ensemble's
+    soft labels, at `temperature`, and the cross-entropy with the tags.
+
+    Args:
+        temperature (float): Temperature `T` of the student's and the ensemble's probabilities.
+        alpha (float): Weight of the KL divergence.  The cross-entropy has weight `1 - alpha`.
+    '''
+    def __init__(self, *args, temperature=2., alpha=0.5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.temperature, self.alpha = temperature, alpha
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        soft_labels = inputs.pop('soft_labels', None)
+        outputs = model(**inputs)
+        if soft_labels is None:  # Evaluation.
+            return (outputs.loss, outputs) if return_outputs else outputs.loss
+        mask = inputs['labels'] != -100
+        t = self.temperature
+        teacher = soft_labels[mask].clamp_min(1e-8) ** (1 / t)
+        teacher = teacher / teacher.sum(dim=-1, keepdim=True)
+        student = F.log_softmax(outputs.logits[mask] / t, dim=-1)
+        kl = F.kl_div(student, teacher, reduction='batchmean') * t ** 2
+        loss = self.alpha * kl + (1 - self.alpha) * outputs.loss
+        return (loss, outputs) if return_outputs else loss
+
+# Cell
+def distill(pth_train, student_checkpoint, pth_valid=None, metric=None, temperature=2., alpha=0.5,
+            num_train_epochs=1, batch_size=16, learning_rate=5e-5, output_dir='showus_distillation',
+            seed=0, callbacks=None):
+    '''
+    Train a student model from `student_checkpoint` on the soft labels in json file
+    `pth_train`, as written by `write_soft_labels`.  If `pth_valid`, of gold tags, is
+    given, the trainer evaluates on it with `compute_metrics` and `metric`.
+
+    Returns:
+        trainer (DistillationTrainer): Trainer of the student, `trainer.model`.
+    '''
+    tokenizer = create_tokenizer(student_checkpoint)
+    return train_ner(pth_train, student_checkpoint, pth_valid=pth_valid, metric=metric,
+                     num_train_epochs=num_train_epochs, batch_size=batch_size, learning_rate=learning_rate,
+                     output_dir=output_dir, seed=seed, callbacks=callbacks, tokenizer=tokenizer,
+                     tokenize_fn=tokenize_and_align_soft_labels,
+                     data_collator=DataCollatorForDistillation(tokenizer),
+                     trainer_cls=DistillationTrainer, temperature=temperature, alpha=alpha)
+
+# Cell
+def distillation_report(pth_valid, models, student, metric, batch_size=64):
+    '''
+    Validation F1 and throughput of the ensemble, and of the student.
+
+    Args:
+        pth_valid (str, Path): Json file of sentences with gold tags, as written by `write_ner_json`.
+        models (list): (tokenizer, model) of each model in the ensemble.
+        student (tuple): (tokenizer, model) of the student.
+        metric: E.g. `load_metric('seqeval')`.
+
+    Returns:
+        report (pd.DataFrame): For the 'ensemble' and the 'student', the validation
+            'precision', 'recall' and 'f1', and the 'sentences_per_second' predicted.
+    '''
+    label_list = get_ner_classlabel().names
+    rows = [json.loads(line) for line in open(pth_valid, mode='r')]
+    sentences = [row['tokens'] for row in rows]
+    references = [[label_list[tag] for tag in row['ner_tags']] for row in rows]
+
+    report = {}
+    for name, models_ in [('ensemble', models), ('student', [student])]:
+        t0 = time.perf_counter()
+        word_probs = ensemble_word_probs(sentences, models_, batch_size=batch_size)
+        seconds = time.perf_counter() - t0
+        predictions = [[label_list[i] for i in prob.argmax(axis=1)] for prob in word_probs]
+        results = metric.compute(predictions=predictions, references=references)
+        report[name] = {'precision': results['overall_precision'], 'recall': results['overall_recall'],
+                        'f1': results['overall_f1'], 'sentences_per_second': len(sentences) / seconds}
+        log(f'{name}: {report[name]}')
+    return pd.DataFrame.from_dict(report, orient='index')
\ No newline at end of file
@@ -0,0 +1,245 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/earlyexit.ipynb (unless otherwise specified).
+
+__all__ = ['EarlyExitForTokenClassification', 'train_early_exit', 'early_exit_word_probs', 'early_exit_report']
+
+# Cell
+import os, sys, time
+import json
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from transformers import AutoModelForTokenClassification
+from transformers.modeling_outputs import TokenClassifierOutput
+from .showus import *
+from .instrument import span, count, log
+try:
+    from transformers.masking_utils import create_bidirectional_mask
+except ImportError:  # transformers < 4.56
+    create_bidirectional_mask = None
+
+# Cell
+def _transformer_layers(model):
+    '''
+    The module holding the list of transformer layers of `model`, and its name in it.
+    '''
+    num_layers = model.config.num_hidden_layers
+    for _, module in model.named_modules():
+        for name, child in module.named_children():
+            if isinstance(child, torch.nn.ModuleList) and len(child) == num_layers:
+                return module, name
+    raise ValueError(f'Cannot find the {num_layers} transformer layers of {type(model).__name__}.')
+
+
+class EarlyExitForTokenClassification(torch.nn.Module):
+    '''
+    Token classification `model` with extra classification heads on some of its layers.
+
+    Args:
+        model (transformers.PreTrainedModel): E.g. from `AutoModelForTokenClassification`.
+        exit_layers (list): Numbers of the layers, from 1, with a head.
+        freeze_base (bool): If True, only the heads are trained, and `model` is left as it is.
+    '''
+    def __init__(self, model, exit_layers=(1, 2), freeze_base=False):
+        super().__init__()
+        num_layers = model.config.num_hidden_layers
+        assert all(0 < k < num_layers for k in exit_layers), f'Exit layers should be in [1, {num_layers}).'
+        self.model, self.config = model, model.config
+        self.exit_layers, self.freeze_base = sorted(exit_layers), freeze_base
+        self.heads = torch.nn.ModuleDict({str(k): torch.nn.Linear(model.config.hidden_size, model.config.num_labels)
+                                          for k in self.exit_layers})
+        for p in self.model.parameters():
+            p.requires_grad = not freeze_base
+
+    def forward(self, input_ids=None, attention_mask=None, token_type_ids=None, labels=None):
+        '''
+        The loss is the mean of the heads' cross-entropies, plus the model's own, unless
+        `freeze_base`.  The logits are the model's.
+        '''
+        inputs = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if token_type_ids is not None:
+            inputs['token_type_ids'] = token_type_ids
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not self.freeze_base):
+            outputs = self.model(**inputs, labels=labels, output_hidden_states=True)
+        loss = None
+        if labels is not None:
+            head_losses = [F.cross_entropy(self.heads[str(k)](outputs.hidden_states[k]).flatten(0, 1),
+                                           labels.flatten(), ignore_index=-100)
+                           for k in self.exit_layers]
+            loss = torch.stack(head_losses).mean()
+            if not self.freeze_base:
+                loss = loss + outputs.loss
+        return TokenClassifierOutput(loss=loss, logits=outputs.logits)
+
+    def save_pretrained(self, out_dir):
+        '''
+        Save the model, and the heads to 'exit_heads.pt', in `out_dir`.
+        '''
+        out_dir = Path(out_dir)
+        self.model.save_pretrained(out_dir)
+        torch.save({'exit_layers': self.exit_layers, 'state_dict': self.heads.state_dict()},
+                   out_dir/'exit_heads.pt')
+
+    @classmethod
+    def from_pretrained(cls, out_dir):
+        model = AutoModelForTokenClassification.from_pretrained(out_dir)
+        saved = torch.load(Path(out_dir)/'exit_heads.pt')
+        early_exit = cls(model, exit_layers=saved['exit_layers'])
+        early_exit.heads.load_state_dict(saved['state_dict'])
+        return early_exit
+
+# Cell
+def train_early_exit(pth_train, model, exit_layers=(1, 2), freeze_base=False, tokenizer=None,
+                     num_train_epochs=1, batch_size=16, learning_rate=2e-5,
+                     output_dir='showus_early_exit', seed=0):
+    '''
+    Train the heads of an `EarlyExitForTokenClassification`, and the model too unless
+    `freeze_base`, on the NER data in json file `pth_train`, as written by `write_ner_json`.
+
+    Args:
+        model (str, Path, transformers.PreTrainedModel): Checkpoint, or a model already
+            fine-tuned, e.g. to add heads to it afterwards, with `freeze_base`.
+        tokenizer (transformers.PreTrainedTokenizerFast): If None, it's `create_tokenizer` of
+            the checkpoint, or of the one the model was loaded from, `model.name_or_path`.
+
+    Returns:
+        early_exit (EarlyExitForTokenClassification): Model with trained heads.
+    '''
+    if tokenizer is None:
+        name_or_path = model if isinstance(model, (str, Path)) else model.name_or_path
+        if not name_or_path:
+            raise ValueError('`tokenizer` is needed for a model that was not loaded from a checkpoint.')
+        tokenizer = create_tokenizer(name_or_path)
+    if isinstance(model, (str, Path)):
+        model = AutoModelForTokenClassification.from_pretrained(model, num_labels=get_ner_classlabel().num_classes)
+        model.resize_token_embeddings(len(tokenizer))
+    early_exit = EarlyExitForTokenClassification(model, exit_layers=exit_layers, freeze_base=freeze_base)
+    train_ner(pth_train, model=early_exit, tokenizer=tokenizer, num_train_epochs=num_train_epochs,
+              batch_size=batch_size, learning_rate=learning_rate, output_dir=output_dir, seed=seed)
+    return early_exit
+
+# Cell
+def _layer_attention_mask(model, attention_mask, hidden):
+    '''
+    `attention_mask`, of shape (batch size, sequence length), as the transformer layers of `model` take it.
+    '''
+    if create_bidirectional_mask is not None:
+        return create_bidirectional_mask(config=model.config, inputs_embeds=hidden, attention_mask=attention_mask)
+    if model.config.model_type == 'distilbert' and getattr(model.config, '_attn_implementation', 'eager') == 'eager':
+        return attention_mask
+    return model.get_extended_attention_mask(attention_mask, attention_mask.shape)
+
+
+def _run_layers(model, layers, hidden, attention_mask):
+    '''
+    Output of `layers` of `model`, run one after the other on `hidden`.
+    '''
+    mask = _layer_attention_mask(model, attention_mask, hidden)
+    for layer in layers:
+        output = layer(hidden, mask)
+        hidden = output[0] if isinstance(output, tuple) else output
+    return hidden
+
+
+def early_exit_word_probs(sentences, tokenizer=None, early_exit=None, threshold=0.99, batch_size=64):
+    '''
+    Like `batched_word_probs`, with sentences that are confidently all 'O' at an exit
+    layer given the probabilities of its head, and not passed through later layers.
+
+    Returns:
+        word_probs (list): For each sentence, an np.array of shape
+            (number of words, number of classes).
+        stats (dict): 'exit_layer': mean number of layers each sentence goes through,
+            and 'exited_early': fraction of sentences that exit before the last layer.
+    '''
+    model = early_exit.model
+    model.eval()
+    num_layers = model.config.num_hidden_layers
+    o = get_ner_classlabel().str2int('O')
+    parent, name = _transformer_layers(model)
+    layers = list(getattr(parent, name))
+    stages = list(zip([0] + early_exit.exit_layers, early_exit.exit_layers + [num_layers]))
+    trim = tokenizer.padding_side == 'right'
+
+    order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+    word_probs, exit_layers = [None] * len(sentences), []
+    for ib in range(0, len(order), batch_size):
+        idx = order[ib:ib + batch_size]
+        inputs, word_ids = tokenize_sentences([sentences[i] for i in idx], tokenizer=tokenizer)
+        inputs = {k: v.to(model.device) for k, v in inputs.items()}
+        words = torch.tensor([[w is not None and (j == 0 or word_id[j - 1] != w) for j, w in enumerate(word_id)]
+                              for word_id in word_ids], device=model.device)
+        probs = torch.zeros(*words.shape, model.config.num_labels, device=model.device)
+        exit_layer = torch.full((len(idx),), num_layers)
+        active = torch.arange(len(idx), device=model.device)
+        with torch.no_grad():
+            embedding_inputs = {k: v for k, v in inputs.items() if k in ('input_ids', 'token_type_ids')}
+            hidden = model.base_model.embeddings(**embedding_inputs)
+            for start, end in stages:
+                attention_mask = inputs['attention_mask'][active]
+                width = int(attention_mask.sum(dim=1).max()) if trim else words.shape[1]
+                output = _run_layers(model, layers[start:end], hidden[:, :width], attention_mask[:, :width])
+                if end == num_layers:
+                    probs[active, :width] = torch.softmax(model.classifier(output), dim=-1)
+                    break
+                head_probs = torch.softmax(early_exit.heads[str(end)](output), dim=-1)
+                confident = ((head_probs[..., o] >= threshold) | ~words[active, :width]).all(dim=1)
+                probs[active[confident], :width] = head_probs[confident]
+                exit_layer[active[confident].cpu()] = end
+                active, hidden = active[~confident], output[~confident]
+                if not len(active):
+                    break
+        exit_layers.extend(exit_layer.tolist())
+        for i, prob in zip(idx, get_word_probs(probs.cpu().numpy(), word_ids)):
+            word_probs[i] = prob
+
+    count('early_exit_layers_skipped', sum(num_layers - n for n in exit_layers))
+    return word_probs, {'exit_layer': float(np.mean(exit_layers)) if exit_layers else 0.,
+                        'exited_early': float(np.mean([n < num_layers for n in exit_layers])) if exit_layers else 0.}
+
+# Cell
+def early_exit_report(pth, tokenizer, early_exit, thresholds=(0.9, 0.99, 0.999), batch_size=64, metric=None):
+    '''
+    Args:
+        pth (str, Path): Json file of sentences, as written by `batched_write_ner_inference_json`.
+        thresholds (list): Values of `threshold` to pass to `early_exit_word_probs`.
+        metric: E.g. `load_metric('seqeval')`.  If given, the 'ner_tags' in `pth`
+            are taken as gold tags.
+
+    Returns:
+        report (pd.DataFrame): For the full model, and each threshold, the mean 'exit_layer',
+            the fraction 'exited_early', 'seconds', 'speedup' over the full model, 'word_agreement' and
+            'sentence_agreement' with the full model, and the 'f1' if `metric` is given.
+    '''
+    label_list = get_ner_classlabel().names
+    rows = [json.loads(line) for line in open(pth, mode='r')]
+    sentences = [row['tokens'] for row in rows]
+    num_layers = early_exit.model.config.num_hidden_layers
+
+    def f1(word_probs):
+        predictions = [[label_list[i] for i in prob.argmax(axis=1)] for prob in word_probs]
+        references = [[label_list[tag] for tag in row['ner_tags']] for row in rows]
+        return metric.compute(predictions=predictions, references=references)['overall_f1']
+
+    t0 = time.perf_counter()
+    full = batched_word_probs(sentences, tokenizer, early_exit.model, batch_size=batch_size)
+    seconds = time.perf_counter() - t0
+    report = {'full': {'exit_layer': num_layers, 'exited_early': 0., 'seconds': seconds, 'speedup': 1.,
+                       'word_agreement': 1., 'sentence_agreement': 1.}}
+    if metric is not None:
+        report['full']['f1'] = f1(full)
+
+    for threshold in thresholds:
+        t0 = time.perf_counter()
+        word_probs, stats = early_exit_word_probs(sentences, tokenizer, early_exit, threshold=threshold,
+                                                  batch_size=batch_size)
+        seconds = time.perf_counter() - t0
+        agree = [prob.argmax(axis=1) == f.argmax(axis=1) for prob, f in zip(word_probs, full)]
+        report[threshold] = {**stats, 'seconds': seconds, 'speedup': report['full']['seconds'] / seconds,
+                             'word_agreement': int(sum(a.sum() for a in agree)) / max(sum(len(a) for a in agree), 1),
+                             'sentence_agreement': int(sum(a.all() for a in agree)) / max(len(agree), 1)}
+        if metric is not None:
+            report[threshold]['f1'] = f1(word_probs)
+        log(f'threshold {threshold}: {report[threshold]}')
+    return pd.DataFrame.from_dict(report, orient='index')
\ No newline at end of file
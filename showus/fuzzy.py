@@ -0,0 +1,183 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/fuzzy.ipynb (unless otherwise specified).
+
+__all__ = ['FuzzyIndex', 'fuzzy_literal_match', 'knowledge_bank_matcher']
+
+# Cell
+import os, sys, time
+import math
+import itertools
+import collections
+from .showus import *
+from .instrument import span, count
+
+# Cell
+class FuzzyIndex:
+    '''
+    Inverted index of labels, to find windows of text with a word-level Jaccard
+    similarity, as computed by `jaccard_similarity`, of at least `threshold` to a label.
+
+    Args:
+        labels (iter): Labels to index.  They're cleaned with `clean_training_text`.
+        threshold (float): Smallest Jaccard similarity of a match.
+        max_df (int): Words in more labels than this, when a label is added, aren't used
+            to propose it, unless all of its words are.
+
+    Attributes:
+        knowledge_bank (KnowledgeBank): The labels as given, for exact matching.
+    '''
+    def __init__(self, labels=(), threshold=0.5, max_df=1000):
+        self.threshold = threshold
+        self.max_df = max_df
+        self.labels = []  # cleaned label of each label id
+        self.label_ids = {}  # cleaned label -> label id
+        self.postings = collections.defaultdict(list)  # word, or pair of words -> label ids
+        self.num_labels_with = collections.Counter()  # word -> number of labels containing it
+        self.max_window = 1  # longest window that can match a label
+        self.knowledge_bank = KnowledgeBank()
+        self.add(labels)
+
+    def _min_shared(self, n):
+        return 1 if n == 1 else max(math.ceil(self.threshold * n - 1e-9), 2)
+
+    def _max_window(self, n):
+        return int(n / self.threshold + 1e-9)
+
+    def add(self, labels):
+        '''
+        Add `labels` to the index.
+
+        Returns:
+            n (int): Number of labels that weren't already in the index.
+        '''
+        labels = list(labels)
+        self.knowledge_bank.add(labels)
+        new_ids = []
+        for label in labels:
+            label = clean_training_text(label, lower=True, total_clean=True)
+            if label and label not in self.label_ids:
+                self.label_ids[label] = len(self.labels)
+                new_ids.append(len(self.labels))
+                self.labels.append(label)
+                self.num_labels_with.update(set(label.split(' ')))
+
+        for label_id in new_ids:
+            words = set(self.labels[label_id].split(' '))
+            self.max_window = max(self.max_window, self._max_window(len(words)))
+            rarest = sorted(words, key=lambda word: (self.num_labels_with[word], word))
+            key_words = [word for word in rarest if self.num_labels_with[word] <= self.max_df]
+            if len(key_words) < 2:
+                key_words = rarest[:2]
+            k = self._min_shared(len(key_words))
+            if k <= 1:
+                keys = key_words
+            else:
+                keys = (' '.join(sorted(pair))
+                        for pair in itertools.combinations(key_words[:len(key_words) - k + 2], 2))
+            for key in keys:
+                self.postings[key].append(label_id)
+        return len(new_ids)
+
+    def _keys(self, words, positions):
+        # Pairs of distinct words less than `max_window` apart.
+        indexed = [(i, word) for i, word in enumerate(words) if word in positions]
+        keys = set(positions)
+        for a, (i, word) in enumerate(indexed):
+            for j, other in itertools.islice(indexed, a + 1, None):
+                if j - i >= self.max_window:
+                    break
+                if other != word:
+                    keys.add(f'{word} {other}' if word < other else f'{other} {word}')
+        return keys
+
+    def __len__(self):
+        return len(self.labels)
+
+    def find(self, words):
+        '''
+        Find windows of `words` similar to a label.
+
+        Args:
+            words (list): Words of a cleaned, lowercased text, like a sentence.
+
+        Returns:
+            matches (list): (similarity, start, stop, label) for each window `words[start:stop]`
+                matching `label`, most similar first.  Windows don't overlap.
+        '''
+        positions = collections.defaultdict(list)
+        for i, word in enumerate(words):
+            if word in self.num_labels_with:
+                positions[word].append(i)
+        candidates = set()
+        for key in self._keys(words, positions):
+            label_ids = self.postings.get(key)
+            if label_ids:
+                candidates.update(label_ids)
+        count('fuzzy_candidates', len(candidates))
+
+        found = []
+        for label_id in candidates:
+            label_words = set(self.labels[label_id].split(' '))
+            n = len(label_words)
+            k = self._min_shared(n)
+            shared = label_words.intersection(positions)
+            if len(shared) < k:
+                continue
+            max_len = self._max_window(n)
+            for start in sorted(i for word in shared for i in positions[word]):
+                window, num_shared = set(), 0
+                for stop in range(start, min(len(words), start + max_len)):
+                    word = words[stop]
+                    if word in window:
+                        continue
+                    window.add(word)
+                    if word in label_words:
+                        num_shared += 1
+                        similarity = num_shared / (n + len(window) - num_shared)
+                        if num_shared >= k and similarity >= self.threshold:
+                            found.append((similarity, start, stop + 1, self.labels[label_id]))
+        count('fuzzy_verified', len(found))
+
+        matches, taken = [], set()
+        for similarity, start, stop, label in sorted(found, key=lambda m: (-m[0], m[2] - m[1], m[1])):
+            if taken.isdisjoint(range(start, stop)):
+                matches.append((similarity, start, stop, label))
+                taken.update(range(start, stop))
+        return matches
+
+    def match(self, paper):
+        '''
+        Cleaned text of the windows in `paper` that are similar to a label,
+        like `literal_match` returns for exact matches.  Windows are within sentences.
+        '''
+        labels = set()
+        for sentence in paper_text(paper).sentences():
+            words = clean_training_text(sentence, lower=True, total_clean=True).split(' ')
+            for _, start, stop, _ in self.find(words):
+                labels.add(' '.join(words[start:stop]))
+        return labels
+
+# Cell
+def fuzzy_literal_match(paper, index):
+    '''
+    Labels found by `literal_match`, along with mentions that are similar to a label in `index`.
+
+    Args:
+        index (FuzzyIndex): Index of the knowledge bank's labels.
+
+    Returns:
+        labels (set): Cleaned text of the labels and mentions found.
+    '''
+    with span('fuzzy_match', log=False):
+        return literal_match(paper, index.knowledge_bank) | index.match(paper)
+
+
+def knowledge_bank_matcher(knowledge_bank, fuzzy_threshold=None):
+    '''
+    Function that returns the labels of `knowledge_bank` found in a paper: with `literal_match`,
+    or, if `fuzzy_threshold` is given, with `fuzzy_literal_match` and a `FuzzyIndex` of
+    `knowledge_bank` with that threshold.
+    '''
+    if fuzzy_threshold is None:
+        return lambda paper: literal_match(paper, knowledge_bank)
+    index = FuzzyIndex(knowledge_bank, threshold=fuzzy_threshold)
+    return lambda paper: fuzzy_literal_match(paper, index)
\ No newline at end of file
@@ -0,0 +1,370 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/instrument.ipynb (unless otherwise specified).
+
+__all__ = ['peak_rss_mb', 'current_rss_mb', 'Instrument', 'configure', 'span', 'spanned', 'count', 'count_padding',
+           'log', 'snapshot', 'reset', 'write_jsonl', 'to_prometheus', 'start_profiling', 'stop_profiling']
+
+# Cell
+import os, sys, time
+import json
+import threading
+import collections
+import functools
+import re
+import atexit
+import cProfile
+import pstats
+from pathlib import Path
+
+# Cell
+def peak_rss_mb():
+    '''
+    Peak resident memory of this process so far, in MB.
+    '''
+    try:
+        import resource
+    except ImportError:  # Windows
+        return float('nan')
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024**2 if sys.platform == 'darwin' else 1024)
+
+
+def current_rss_mb():
+    '''
+    Resident memory of this process now, in MB.  Where this isn't available,
+    the peak so far, from `peak_rss_mb`.
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb()
+
+# Cell
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Span:
+    __slots__ = ('instrument', 'name', 'log', 't0', 'profiler')
+
+    def __init__(self, instrument, name, log=True):
+        self.instrument, self.name, self.log = instrument, name, log
+
+    def __enter__(self):
+        profiler = self.instrument.profiler
+        self.profiler = profiler if profiler is not None and profiler.start(self.name) else None
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.t0
+        if self.profiler is not None:  # The profiler that started, even if profiling has stopped since.
+            self.profiler.stop(self.name)
+        if self.instrument.enabled:
+            self.instrument._record_span(self.name, elapsed)
+        if self.instrument.verbose and self.log:
+            print(f'{self.name}: completed in {elapsed / 60:.2f} mins.')
+        return False
+
+
+class Instrument:
+    '''
+    Spans and counters.  Usually used through the module-level functions, which
+    act on a shared instance.
+
+    Args:
+        enabled (bool): Record spans and counters.
+        verbose (bool): Print how long each span took, and messages passed to `log`.
+    '''
+    _null_span = _NullSpan()
+
+    def __init__(self, enabled=False, verbose=True):
+        self.enabled, self.verbose = enabled, verbose
+        self.profiler = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.spans = {}
+            self.counters = collections.Counter()
+            self.t0 = time.time()
+
+    def span(self, name, log=True):
+        if not (self.enabled or self.verbose or self.profiler):
+            return self._null_span
+        return _Span(self, name, log=log)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += value
+
+    def log(self, message):
+        if self.verbose:
+            print(message)
+
+    def _record_span(self, name, elapsed):
+        rss = peak_rss_mb()
+        with self._lock:
+            s = self.spans.get(name)
+            if s is None:
+                s = self.spans[name] = {'calls': 0, 'seconds': 0., 'max_seconds': 0., 'peak_rss_mb': 0.}
+            s['calls'] += 1
+            s['seconds'] += elapsed
+            s['max_seconds'] = max(s['max_seconds'], elapsed)
+            s['peak_rss_mb'] = max(s['peak_rss_mb'], rss)
+
+    def snapshot(self):
+        '''
+        Returns:
+            snapshot (dict): 'spans', 'counters', 'peak_rss_mb' of the process,
+                'elapsed' seconds since the last reset, and 'derived' rates.
+        '''
+        with self._lock:
+            spans = {name: dict(s) for name, s in self.spans.items()}
+            counters = dict(self.counters)
+        elapsed = time.time() - self.t0
+
+        derived = {}
+        for name in ('papers', 'sentences', 'words', 'subword_tokens'):
+            if name in counters and elapsed > 0:
+                derived[f'{name}_per_second'] = counters[name] / elapsed
+        if counters.get('padded_positions'):
+            derived['padding_ratio'] = 1 - counters.get('subword_tokens', 0) / counters['padded_positions']
+        hits, misses = counters.get('cache_hits', 0), counters.get('cache_misses', 0)
+        if hits + misses:
+            derived['cache_hit_ratio'] = hits / (hits + misses)
+        return {'time': time.time(), 'elapsed': elapsed, 'peak_rss_mb': peak_rss_mb(),
+                'spans': spans, 'counters': counters, 'derived': derived}
+
+# Cell
+_instrument = Instrument(enabled=os.environ.get('SHOWUS_INSTRUMENT', '0') not in ('', '0'),
+                         verbose=os.environ.get('SHOWUS_VERBOSE', '1') not in ('', '0'))
+
+
+def configure(enabled=None, verbose=None):
+    '''
+    Turn recording and printing on or off.  Arguments left as None are unchanged.
+    '''
+    if enabled is not None:
+        _instrument.enabled = enabled
+    if verbose is not None:
+        _instrument.verbose = verbose
+    return _instrument
+
+
+def span(name, log=True):
+    '''
+    Context manager timing the stage called `name`.  If `log` is False, its time
+    isn't printed even when verbose, for spans that are entered many times.
+    '''
+    return _instrument.span(name, log=log)
+
+
+def spanned(name=None, log=True):
+    '''
+    Decorator running every call of a function inside `span(name)`.
+    `name` defaults to the function's name.
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _instrument.span(name or fn.__name__, log=log):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    '''
+    Add `value` to counter `name`.
+    '''
+    _instrument.count(name, value)
+
+
+def count_padding(lengths, batch_size):
+    '''
+    Count the sub-tokens of sequences with `lengths`, and the positions they take up
+    once consecutive groups of `batch_size` of them are each padded to the longest.
+    '''
+    if not _instrument.enabled:
+        return
+    lengths = list(lengths)
+    count('subword_tokens', sum(lengths))
+    count('padded_positions', sum(len(lengths[i:i + batch_size]) * max(lengths[i:i + batch_size])
+                                  for i in range(0, len(lengths), batch_size)))
+
+
+def log(message):
+    '''
+    Print `message` if verbose.
+    '''
+    _instrument.log(message)
+
+
+def snapshot():
+    return _instrument.snapshot()
+
+
+def reset():
+    _instrument.reset()
+
+# Cell
+def write_jsonl(pth, **labels):
+    '''
+    Append a snapshot to the file at `pth`, as one line of json.  `labels`, for
+    example a run name or the model used, are added to it, to tell runs apart.
+    '''
+    with open(pth, mode='a') as f:
+        f.write(json.dumps({**labels, **snapshot()}) + '\n')
+
+
+def _prometheus_name(name):
+    return ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def to_prometheus(prefix='showus', **labels):
+    '''
+    A snapshot in Prometheus' text exposition format.  `labels` are added to every sample.
+    '''
+    s = snapshot()
+    label_str = ','.join(f'{k}="{v}"' for k, v in labels.items())
+
+    def sample(name, value, **extra):
+        all_labels = ','.join(filter(None, [label_str] + [f'{k}="{v}"' for k, v in extra.items()]))
+        return f'{prefix}_{name}{{{all_labels}}} {value}' if all_labels else f'{prefix}_{name} {value}'
+
+    lines = [f'# TYPE {prefix}_peak_rss_mb gauge', sample('peak_rss_mb', s['peak_rss_mb'])]
+    for name, value in sorted(s['counters'].items()):
+        lines += [f'# TYPE {prefix}_{_prometheus_name(name)}_total counter',
+                  sample(f'{_prometheus_name(name)}_total', value)]
+    for field, kind in [('calls', 'counter'), ('seconds', 'counter'), ('max_seconds', 'gauge')]:
+        metric = f'span_{field}_total' if kind == 'counter' else f'span_{field}'
+        lines.append(f'# TYPE {prefix}_{metric} {kind}')
+        lines += [sample(metric, span_stats[field], span=name) for name, span_stats in sorted(s['spans'].items())]
+    for name, value in sorted(s['derived'].items()):
+        lines += [f'# TYPE {prefix}_{name} gauge', sample(name, value)]
+    return '\n'.join(lines) + '\n'
+
+# Cell
+class _Profiler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.profiles = {}  # (span name, thread id) -> cProfile.Profile
+        self.stacks = collections.defaultdict(collections.Counter)  # span name -> stack -> samples
+        self.active = {}  # thread id -> names of the spans the thread is in, innermost last
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._sample, name='showus-sampler', daemon=True)
+        self.sampler.start()
+
+    def start(self, name):
+        tid = threading.get_ident()
+        with self.lock:
+            names = self.active.get(tid, [])
+            outer = self.profiles[(names[-1], tid)] if names else None
+            profile = self.profiles.setdefault((name, tid), cProfile.Profile())
+        if outer is not None:
+            outer.disable()
+        try:
+            profile.enable()
+        except ValueError:  # Another profiler is active in this thread.
+            if outer is not None:
+                outer.enable()
+            return False
+        with self.lock:
+            self.active[tid] = names + [name]
+        return True
+
+    def stop(self, name):
+        tid = threading.get_ident()
+        self.profiles[(name, tid)].disable()
+        with self.lock:
+            names = self.active.pop(tid)[:-1]
+            if names:
+                self.active[tid] = names
+        if names:
+            self.profiles[(names[-1], tid)].enable()
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                active = dict(self.active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for tid, names in active.items():
+                frame, stack = frames.get(tid), []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                if stack:
+                    stack = ';'.join(reversed(stack))
+                    with self.lock:
+                        for name in set(names):
+                            self.stacks[name][stack] += 1
+
+    def write(self, profile_dir, top=20):
+        self.stopped.set()
+        self.sampler.join()
+        profile_dir = Path(profile_dir)
+        profile_dir.mkdir(parents=True, exist_ok=True)
+
+        rows, samples = [], {}
+        for name in sorted({name for name, _ in self.profiles}):
+            fname = re.sub(r'[^\w.-]', '_', name)
+            stats = pstats.Stats(*[p for (n, _), p in self.profiles.items() if n == name])
+            stats.dump_stats(profile_dir/f'{fname}.pstats')
+            with open(profile_dir/f'{fname}.collapsed', mode='w') as f:
+                for stack, n in self.stacks[name].most_common():
+                    f.write(f'{stack} {n}\n')
+            samples[name] = sum(self.stacks[name].values())
+            for (filename, line, func), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+                rows.append((tottime, cumtime, ncalls, name, f'{func} ({os.path.basename(filename)}:{line})'))
+
+        total = sum(row[0] for row in rows) or 1
+        lines = [f'Samples per span: {samples}', '',
+                 f'{"self s":>9} {"self %":>7} {"cum s":>9} {"calls":>10}  {"span":<24} function']
+        for tottime, cumtime, ncalls, name, func in sorted(rows, reverse=True)[:top]:
+            lines.append(f'{tottime:9.3f} {100 * tottime / total:6.1f}% {cumtime:9.3f} {ncalls:10d}  {name:<24} {func}')
+        summary = '\n'.join(lines)
+        with open(profile_dir/'hotspots.txt', mode='w') as f:
+            f.write(summary + '\n')
+        return summary
+
+# Cell
+def start_profiling(interval=0.005):
+    '''
+    Start profiling spans, sampling stacks every `interval` seconds.
+    '''
+    if _instrument.profiler is None:
+        _instrument.profiler = _Profiler(interval=interval)
+
+
+def stop_profiling(profile_dir='showus_profile', top=20):
+    '''
+    Stop profiling, and write to `profile_dir`, for each profiled span, '<span>.pstats'
+    and '<span>.collapsed', and 'hotspots.txt', the `top` functions by time spent in
+    the function itself, across all spans.
+
+    Returns:
+        summary (str): Content of 'hotspots.txt'.
+    '''
+    profiler, _instrument.profiler = _instrument.profiler, None
+    if profiler is None:
+        return ''
+    return profiler.write(profile_dir, top=top)
+
+
+if os.environ.get('SHOWUS_PROFILE'):
+    start_profiling()
+    atexit.register(stop_profiling, os.environ['SHOWUS_PROFILE'])
\ No newline at end of file
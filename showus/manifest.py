@@ -0,0 +1,211 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/manifest.ipynb (unless otherwise specified).
+
+__all__ = ['load_manifest', 'save_manifest', 'update_paper_digests', 'stale_papers', 'save_paper_artifact',
+           'load_paper_artifact', 'incremental_predict', 'run_incremental']
+
+# Cell
+import os, sys, time
+import json
+import pickle
+from pathlib import Path
+import pandas as pd
+from .showus import *
+from .instrument import span, count, log
+from .fuzzy import knowledge_bank_matcher
+from .pipeline import hash_args, file_digest, checkpoint_digest, predict_tags, combine_ensemble_labels
+
+# Cell
+def load_manifest(pth):
+    '''
+    Load manifest at `pth`.  Returns an empty manifest if there's none yet.
+    '''
+    if not Path(pth).exists():
+        return {}
+    with open(pth, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, pth):
+    '''
+    Save manifest to `pth`, replacing any existing one only once writing has succeeded.
+    '''
+    pth = Path(pth)
+    pth.parent.mkdir(parents=True, exist_ok=True)
+    pth_tmp = pth.with_suffix('.tmp')
+    with open(pth_tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(pth_tmp, pth)
+
+# Cell
+def update_paper_digests(manifest, dir_json, paper_ids):
+    '''
+    Record the digest of each paper's json file in the manifest.  The file is only
+    read if its size or modification time differ from those recorded.
+
+    Returns:
+        digests (dict): Digest of each paper in `paper_ids`.
+    '''
+    digests = {}
+    for paper_id in paper_ids:
+        pth = f'{dir_json}/{paper_id}.json'
+        st = os.stat(pth)
+        entry = manifest.setdefault(paper_id, {'artifacts': {}})
+        if entry.get('size') != st.st_size or entry.get('mtime_ns') != st.st_mtime_ns:
+            entry.update(digest=file_digest(pth), size=st.st_size, mtime_ns=st.st_mtime_ns)
+        digests[paper_id] = entry['digest']
+    return digests
+
+
+def _count_stale(name, stale, paper_ids):
+    log(f'{name}: {len(stale)} of {len(paper_ids)} papers to process.')
+    count('cache_hits', len(paper_ids) - len(stale))
+    count('cache_misses', len(stale))
+
+
+def stale_papers(manifest, name, keys):
+    '''
+    IDs of papers whose artifact `name` is missing, or was produced
+    with a key different from the one in `keys`.
+
+    Args:
+        keys (dict): Expected key of the artifact for each paper ID.
+    '''
+    return [paper_id for paper_id, key in keys.items()
+            if manifest[paper_id]['artifacts'].get(name) != key]
+
+# Cell
+def save_paper_artifact(store_dir, name, paper_id, value):
+    pth = Path(store_dir)/name/f'{paper_id}.pkl'
+    pth.parent.mkdir(parents=True, exist_ok=True)
+    with open(pth, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_paper_artifact(store_dir, name, paper_id):
+    with open(Path(store_dir)/name/f'{paper_id}.pkl', 'rb') as f:
+        return pickle.load(f)
+
+# Cell
+def incremental_predict(dir_json, paper_ids, store_dir='showus_store', model_checkpoints=(),
+                        pth_knowledge_bank=None, metric=None,
+                        mark_title=False, mark_text=False, sentence_definition='sentence',
+                        max_length=64, overlap=20, min_length=10, contains_keywords=['data', 'study'],
+                        batch_size=64_000, per_device_batch_size=16, max_similarity=0.75,
+                        model_cache_dir=None, memory_budget=None, section_policy=None,
+                        fuzzy_threshold=None):
+    '''
+    Predict dataset labels for papers, re-using the artifacts already produced for
+    papers that haven't changed since the last run.
+
+    Args:
+        dir_json (str, Path): Directory containing the papers' json files.
+        paper_ids (list): IDs of the papers to predict for.
+        store_dir (str, Path): Directory holding the manifest and the per-paper artifacts.
+        model_checkpoints (list): Checkpoints of the models in the ensemble.
+        pth_knowledge_bank (None, str): Meta data like 'train.csv', or a `KnowledgeBank`
+            saved with `KnowledgeBank.save`, for literal matching.
+            If None, literal matching is not done.
+        fuzzy_threshold (None, float): As for `build_pipeline`.
+        model_cache_dir, memory_budget: Passed to `predict_tags`.
+        section_policy (None, dict): Passed to `get_paper_inference_sentences`.
+
+    Returns:
+        filtered_dataset_labels (list): Labels for each paper in `paper_ids`,
+            seperated by '|'.
+    '''
+    pth_manifest = Path(store_dir)/'manifest.json'
+    manifest = load_manifest(pth_manifest)
+    digests = update_paper_digests(manifest, dir_json, paper_ids)
+
+    # Sentences
+    sentence_params = dict(mark_title=mark_title, mark_text=mark_text,
+                           sentence_definition=sentence_definition,
+                           max_length=max_length, overlap=overlap,
+                           min_length=min_length, contains_keywords=contains_keywords)
+    if section_policy is not None:  # Only then, to keep the keys of sentences cached before.
+        sentence_params['section_policy'] = section_policy
+    sentence_keys = {paper_id: hash_args('sentences', sentence_params, digest)
+                     for paper_id, digest in digests.items()}
+    stale = stale_papers(manifest, 'sentences', sentence_keys)
+    _count_stale('sentences', stale, paper_ids)
+    if stale:
+        test_rows, paper_length = get_ner_inference_data(
+            dir_json, pd.DataFrame({'Id': stale}), **sentence_params)
+        istart = 0
+        for paper_id, n in zip(stale, paper_length):
+            rows = [[word for word, _ in row] for row in test_rows[istart:istart + n]]
+            save_paper_artifact(store_dir, 'sentences', paper_id, rows)
+            manifest[paper_id]['artifacts']['sentences'] = sentence_keys[paper_id]
+            istart += n
+        save_manifest(manifest, pth_manifest)
+
+    # Model predictions
+    model_names = []
+    for model_checkpoint in model_checkpoints:
+        model_digest = checkpoint_digest(model_checkpoint)
+        name = f'labels-{model_digest[:16]}'
+        model_names.append(name)
+        keys = {paper_id: hash_args('predict', model_digest, sentence_keys[paper_id])
+                for paper_id in paper_ids}
+        stale = stale_papers(manifest, name, keys)
+        _count_stale(name, stale, paper_ids)
+        if not stale:
+            continue
+
+        sentences = [load_paper_artifact(store_dir, 'sentences', paper_id) for paper_id in stale]
+        predictions = []
+        if any(sentences):
+            pth_json = Path(store_dir)/'predict_tmp.json'
+            write_ner_json([list(zip(sentence, len(sentence) * [0]))
+                            for rows in sentences for sentence in rows], pth=pth_json)
+            predictions = predict_tags(pth_json, model_checkpoint=model_checkpoint, metric=metric,
+                                       batch_size=batch_size, per_device_batch_size=per_device_batch_size,
+                                       model_cache_dir=model_cache_dir, store_dir=Path(store_dir)/'batches',
+                                       memory_budget=memory_budget)
+        istart = 0
+        for paper_id, rows in zip(stale, sentences):
+            labels = set().union(*(get_sentence_dataset_labels(sentence, pred) for sentence, pred
+                                   in zip(rows, predictions[istart:istart + len(rows)])))
+            save_paper_artifact(store_dir, name, paper_id, labels)
+            manifest[paper_id]['artifacts'][name] = keys[paper_id]
+            istart += len(rows)
+        save_manifest(manifest, pth_manifest)
+
+    # Literal matching
+    if pth_knowledge_bank is not None:
+        kb_digest = file_digest(pth_knowledge_bank)
+        if fuzzy_threshold is not None:
+            kb_digest = hash_args(kb_digest, {'fuzzy_threshold': fuzzy_threshold})
+        keys = {paper_id: hash_args('literal_match', kb_digest, digest)
+                for paper_id, digest in digests.items()}
+        stale = stale_papers(manifest, 'literal_match', keys)
+        _count_stale('literal_match', stale, paper_ids)
+        if stale:
+            match = knowledge_bank_matcher(load_knowledge_bank(pth_knowledge_bank),
+                                           fuzzy_threshold=fuzzy_threshold)
+            for paper_id, paper in iter_papers(dir_json, stale):
+                save_paper_artifact(store_dir, 'literal_match', paper_id, match(paper))
+                manifest[paper_id]['artifacts']['literal_match'] = keys[paper_id]
+            save_manifest(manifest, pth_manifest)
+
+    # Merge
+    literal_preds = [load_paper_artifact(store_dir, 'literal_match', paper_id)
+                     if pth_knowledge_bank is not None else set()
+                     for paper_id in paper_ids]
+    model_preds = [[load_paper_artifact(store_dir, name, paper_id) for paper_id in paper_ids]
+                   for name in model_names]
+
+    return filter_dataset_labels(combine_ensemble_labels(literal_preds, *model_preds),
+                                 max_similarity=max_similarity)
+
+# Cell
+def run_incremental(dir_json, pth_sample_submission, pth_submission='submission.csv', **kwargs):
+    '''
+    Like `run_pipeline`, but only processes papers that are new or have changed since the
+    last run.  `kwargs` are passed to `incremental_predict`.
+    '''
+    sample_submission = pd.read_csv(pth_sample_submission)
+    sample_submission['PredictionString'] = incremental_predict(
+        dir_json, list(sample_submission['Id']), **kwargs)
+    sample_submission.to_csv(pth_submission, index=False)
+    return sample_submission
\ No newline at end of file
@@ -0,0 +1,122 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/mining.ipynb (unless otherwise specified).
+
+__all__ = ['mine_hard_negatives', 'training_set_report']
+
+# Cell
+import os, sys, time
+import random
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from transformers import TrainerCallback
+from .showus import *
+from .cascade import non_o_confidence
+from .instrument import span, count, log
+
+# Cell
+def mine_hard_negatives(papers, df, tokenizer, model, pth='train_ner_mined.json',
+                        min_confidence=0.5, random_prob=0.02, score_size=4_096, batch_size=64,
+                        seed=0, classlabel=get_ner_classlabel(), neg_keywords=None, **kwargs):
+    '''
+    Write NER training data with all the positives in the papers, the negatives `model`
+    is likely to get wrong, and a random sample of the others, to json file `pth`, in the
+    same format as `write_ner_json`.
+
+    Args:
+        papers (dict, str, Path): Like that returned by `load_papers`, or the directory
+            containing the papers' json files, which are then read ahead with `iter_papers`.
+        df (pd.DataFrame): Competition's train.csv or a subset of it.
+        min_confidence (float): Negatives with a `non_o_confidence` at least this are kept.
+        random_prob (float): Probability with which to keep each of the other negatives.
+        score_size (int): Number of negatives scored together.
+        batch_size (int): Passed to `batched_word_probs`.
+        neg_keywords (None, iter): Keywords which a candidate negative needs to have.
+            If None, all negatives are candidates.
+        kwargs: Passed to `get_paper_ner_data`, e.g. `max_length`.
+
+    Returns:
+        stats (dict): Number of 'positives', of negatives 'scored', and of those
+            kept as 'hard' negatives and as 'random' negatives.
+    '''
+    rnd = random.Random(seed)
+    stats = dict.fromkeys(['positives', 'scored', 'hard', 'random'], 0)
+    o = classlabel.str2int('O')
+    open(pth, mode='w').close()
+
+    if isinstance(papers, (str, Path)):
+        paper_iter = iter_papers(papers, df['Id'])
+    else:
+        paper_iter = ((paper_id, papers[paper_id]) for paper_id in df['Id'])
+
+    def write_negatives(negatives):
+        with span('score_negatives', log=False):
+            confidence = non_o_confidence(
+                batched_word_probs([[word for word, _ in row] for row in negatives],
+                                   tokenizer=tokenizer, model=model, batch_size=batch_size),
+                classlabel=classlabel)
+        hard = confidence >= min_confidence
+        kept = [row for row, is_hard in zip(negatives, hard) if is_hard or rnd.random() < random_prob]
+        stats['scored'] += len(negatives)
+        stats['hard'] += int(hard.sum())
+        stats['random'] += len(kept) - int(hard.sum())
+        count('negatives_scored', len(negatives))
+        write_ner_json(kept, pth, mode='a')
+
+    negatives = []
+    for (paper_id, paper), dataset_label in zip(paper_iter, df['dataset_label']):
+        _, _, ner_data = get_paper_ner_data(paper, dataset_label.split('|'), classlabel=classlabel,
+                                            neg_keywords=neg_keywords, **kwargs)
+        positives = [row for row in ner_data if any(tag != o for _, tag in row)]
+        negatives.extend(row for row in ner_data if all(tag == o for _, tag in row))
+        write_ner_json(positives, pth, mode='a')
+        stats['positives'] += len(positives)
+        count('papers')
+        if len(negatives) >= score_size:
+            write_negatives(negatives)
+            negatives = []
+    if negatives:
+        write_negatives(negatives)
+
+    log(f"Mined training data: {stats['positives']} positives + {stats['hard']} hard negatives "
+        f"+ {stats['random']} random negatives, out of {stats['scored']} negatives")
+    return stats
+
+# Cell
+class _EpochTimer(TrainerCallback):
+    def __init__(self):
+        self.seconds = []
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.t0 = time.perf_counter()
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        self.seconds.append(time.perf_counter() - self.t0)
+
+
+def training_set_report(train_files, pth_valid, model_checkpoint, metric, output_dir='showus_training_sets',
+                        **kwargs):
+    '''
+    Fine-tune a model on each training set with `train_ner`, and evaluate it on the validation set.
+
+    Args:
+        train_files (dict): Name of each training set -> its json file.
+        pth_valid (str, Path): Json file of the validation set.
+        metric: Passed to `compute_metrics`, e.g. `load_metric('seqeval')`.
+        kwargs: Passed to `train_ner`, e.g. `num_train_epochs`.
+
+    Returns:
+        report (pd.DataFrame): For each training set, the number of 'examples',
+            the 'seconds_per_epoch', and the validation 'precision', 'recall' and 'f1'.
+    '''
+    rows = {}
+    for name, pth_train in train_files.items():
+        timer = _EpochTimer()
+        trainer = train_ner(pth_train, model_checkpoint, pth_valid=pth_valid, metric=metric,
+                            output_dir=Path(output_dir)/name, callbacks=[timer], **kwargs)
+        results = trainer.evaluate()
+        rows[name] = {'examples': len(trainer.train_dataset),
+                      'seconds_per_epoch': float(np.mean(timer.seconds)),
+                      'precision': results['eval_precision'], 'recall': results['eval_recall'],
+                      'f1': results['eval_f1']}
+        log(f'{name}: {rows[name]}')
+    return pd.DataFrame.from_dict(rows, orient='index')
\ No newline at end of file
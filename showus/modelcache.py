@@ -0,0 +1,242 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/modelcache.ipynb (unless otherwise specified).
+
+__all__ = ['MMAP_SUPPORTED', 'cache_checkpoint', 'mmap_safetensors', 'load_cached_model', 'load_model',
+           'process_memory', 'drop_page_cache', 'worker_load_report', 'compare_model_loading']
+
+# Cell
+import os, sys, time
+import json
+import shutil
+import struct
+import multiprocessing as mp
+from itertools import chain
+from pathlib import Path
+import torch
+from transformers import AutoConfig, AutoModelForTokenClassification
+from .pipeline import checkpoint_digest
+from .instrument import span, log
+try:
+    from safetensors.torch import save_file
+except ImportError:
+    save_file = None
+
+# Memory-mapped loading uses `torch.UntypedStorage.from_file`, and `torch.device`
+# as a context manager, which are new in torch 2.0.
+MMAP_SUPPORTED = (save_file is not None and
+                  tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 0))
+
+# Cell
+def cache_checkpoint(model_checkpoint, cache_dir='showus_model_cache'):
+    '''
+    Convert `model_checkpoint` into a safetensors file in `cache_dir`, unless this
+    has already been done.
+
+    Returns:
+        pth (Path): Directory with the model's config and 'model.safetensors'.
+            Pass it to `load_cached_model`.
+    '''
+    pth = Path(cache_dir)/checkpoint_digest(model_checkpoint)[:16]
+    if (pth/'model.safetensors').exists():
+        return pth
+
+    model = AutoModelForTokenClassification.from_pretrained(model_checkpoint)
+    # Non-persistent buffers are saved too, so that no tensor needs to be initialised
+    # when loading.  Tied parameters are saved once, and the other names recorded as aliases.
+    tensors, aliases, names = {}, {}, {}
+    for name, tensor in chain(model.named_parameters(remove_duplicate=False),
+                              model.named_buffers(remove_duplicate=False)):
+        if id(tensor) in names:
+            aliases[name] = names[id(tensor)]
+        else:
+            names[id(tensor)] = name
+            tensors[name] = tensor.detach().contiguous().clone()
+
+    pth_tmp = pth.with_name(f'{pth.name}.{os.getpid()}.tmp')
+    pth_tmp.mkdir(parents=True, exist_ok=True)
+    model.config.save_pretrained(pth_tmp)
+    save_file(tensors, pth_tmp/'model.safetensors', metadata={'aliases': json.dumps(aliases)})
+    try:
+        os.replace(pth_tmp, pth)
+    except OSError:  # Another process converted it first.
+        shutil.rmtree(pth_tmp)
+    return pth
+
+# Cell
+_DTYPES = {'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+           'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8,
+           'U8': torch.uint8, 'BOOL': torch.bool}
+
+
+def mmap_safetensors(pth):
+    '''
+    Map safetensors file at `pth` into memory, without reading it.
+
+    Returns:
+        tensors (dict): Name to tensor.  Each tensor is a view into the mapping.
+        metadata (dict): The file's metadata.
+    '''
+    with open(pth, 'rb') as f:
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size))
+    metadata = header.pop('__metadata__', {})
+
+    nbytes = os.path.getsize(pth)
+    storage = torch.UntypedStorage.from_file(str(pth), shared=False, nbytes=nbytes)
+    data = torch.empty(0, dtype=torch.uint8).set_(storage, 0, (nbytes,))[8 + header_size:]
+
+    tensors = {}
+    for name, info in header.items():
+        start, end = info['data_offsets']
+        dtype = _DTYPES[info['dtype']]
+        view = data[start:end]
+        if view.storage_offset() % view.new_empty(0, dtype=dtype).element_size():
+            view = view.clone()  # Misaligned for `dtype`.
+        tensors[name] = view.view(dtype).view(info['shape'])
+    return tensors, metadata
+
+
+def _set_tensor(model, name, tensor):
+    module_name, _, attr = name.rpartition('.')
+    module = model.get_submodule(module_name)
+    if attr in module._parameters:
+        module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=tensor.is_floating_point())
+    else:
+        module._buffers[attr] = tensor
+
+# Cell
+def load_cached_model(pth, model_class=AutoModelForTokenClassification):
+    '''
+    Load a model from a directory returned by `cache_checkpoint`.  The model is first
+    created without allocating memory for its weights, which are then set to views
+    into the memory-mapped safetensors file.  The model is returned in eval mode.
+    '''
+    pth = Path(pth)
+    config = AutoConfig.from_pretrained(pth)
+    with torch.device('meta'):
+        model = model_class.from_config(config)
+
+    tensors, metadata = mmap_safetensors(pth/'model.safetensors')
+    for name, tensor in tensors.items():
+        _set_tensor(model, name, tensor)
+    for name, target in json.loads(metadata.get('aliases', '{}')).items():
+        _set_tensor(model, name, tensors[target])
+
+    missing = [name for name, tensor in chain(model.named_parameters(), model.named_buffers())
+               if tensor.is_meta]
+    if missing:
+        raise ValueError(f'Tensors missing from {pth}: {missing}')
+    return model.eval()
+
+
+def load_model(model_checkpoint, cache_dir=None):
+    '''
+    Load `model_checkpoint` with `load_cached_model` if `cache_dir` is given,
+    converting it first if needed, and with `from_pretrained` otherwise, or if
+    memory-mapped loading isn't supported (see `MMAP_SUPPORTED`).
+    '''
+    if cache_dir is not None and not MMAP_SUPPORTED:
+        log('Memory-mapped loading needs torch>=2.0 and safetensors.  Loading with from_pretrained.')
+        cache_dir = None
+    if cache_dir is None:
+        return AutoModelForTokenClassification.from_pretrained(model_checkpoint)
+    return load_cached_model(cache_checkpoint(model_checkpoint, cache_dir=cache_dir))
+
+# Cell
+def process_memory():
+    '''
+    Memory used by this process, in MB.  'rss' counts every page in memory, including those
+    shared with other processes.  'pss' divides each shared page among the processes sharing it,
+    and 'uss' counts only pages private to this process.  'pss' and 'uss' are only available on Linux.
+    '''
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as f:
+            kb = {line.split(':')[0]: int(line.split()[1]) for line in f if line.split()[-1] == 'kB'}
+        return {'rss': kb['Rss'] / 1024, 'pss': kb['Pss'] / 1024,
+                'uss': (kb['Private_Clean'] + kb['Private_Dirty']) / 1024}
+    except OSError:
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {'rss': maxrss / (1024 if sys.platform != 'darwin' else 1024**2)}
+
+
+def drop_page_cache(pth):
+    '''
+    Ask the OS to evict the pages of file at `pth` from its cache, so that
+    the next load reads it from disk.  Does nothing where this isn't supported.
+    '''
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(pth, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _load_worker(pths, cached, barrier, results):
+    torch.set_num_threads(1)
+    t0 = time.time()
+    models = [load_cached_model(pth) if cached else AutoModelForTokenClassification.from_pretrained(pth)
+              for pth in pths]
+    load_time = time.time() - t0
+    # Touch every weight, as inference would.
+    with torch.no_grad():
+        for model in models:
+            for param in model.parameters():
+                param.sum()
+    barrier.wait()  # Measure while all workers hold their models.
+    results.put({'load_time': load_time, **process_memory()})
+    barrier.wait()
+
+
+def worker_load_report(pths, cached=True, num_workers=4, start_method='spawn'):
+    '''
+    Start `num_workers` processes which each load all of the models at `pths`, and
+    report their load times and memory use, measured while all of them hold the models.
+
+    Args:
+        pths (list): Directories returned by `cache_checkpoint` if `cached`.
+            Otherwise, checkpoints to load with `from_pretrained`.
+        start_method (str): 'spawn' or 'fork'.
+
+    Returns:
+        report (list): A dict for each worker, with 'load_time' in seconds, and
+            the memory returned by `process_memory`.
+    '''
+    ctx = mp.get_context(start_method)
+    barrier, results = ctx.Barrier(num_workers), ctx.Queue()
+    workers = [ctx.Process(target=_load_worker, args=(pths, cached, barrier, results))
+               for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    report = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    return report
+
+
+def compare_model_loading(model_checkpoints, cache_dir='showus_model_cache', num_workers=4,
+                          start_method='spawn'):
+    '''
+    Print load times and memory per worker, with `from_pretrained`, and with the model cache.
+    For the model cache, 'cold' is a load with the cached files evicted from the OS page
+    cache, and 'warm' is a subsequent load.
+
+    Returns:
+        reports (dict): What `worker_load_report` returns, for each of 'from_pretrained',
+            'cached (cold)', and 'cached (warm)'.
+    '''
+    with span('conversion'):
+        pths = [cache_checkpoint(model_checkpoint, cache_dir=cache_dir) for model_checkpoint in model_checkpoints]
+
+    reports = {'from_pretrained': worker_load_report(model_checkpoints, False, num_workers, start_method)}
+    for pth in pths:
+        drop_page_cache(pth/'model.safetensors')
+    reports['cached (cold)'] = worker_load_report(pths, True, num_workers, start_method)
+    reports['cached (warm)'] = worker_load_report(pths, True, num_workers, start_method)
+
+    for name, report in reports.items():
+        mean = {k: sum(r[k] for r in report) / len(report) for k in report[0]}
+        print(f'{name}: ' + ', '.join(f'{k} {v:.2f} s' if k == 'load_time' else f'{k} {v:.0f} MB'
+                                      for k, v in mean.items()))
+    return reports
\ No newline at end of file
@@ -0,0 +1,241 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/overlap.ipynb (unless otherwise specified).
+
+__all__ = ['StageStats', 'run_stages', 'overlapped_predict']
+
+# Cell
+import os, sys, time
+import threading
+import queue
+import itertools
+from functools import partial
+from tokenizers.pre_tokenizers import BertPreTokenizer
+from .showus import *
+from .instrument import span
+
+# Cell
+_DONE = object()
+_POLL = 0.1  # Seconds between checks of whether to stop, while waiting on a queue.
+
+
+class _Failed:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class _Stopped(Exception):
+    pass
+
+
+class StageStats:
+    '''
+    Time a stage spends working, waiting for input, and waiting for room in its output queue.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.wait_in = 0.
+        self.wait_out = 0.
+        self.total = 0.
+
+    @property
+    def busy(self):
+        return self.total - self.wait_in - self.wait_out
+
+    def __repr__(self):
+        return (f'{self.name}: {self.items} items, busy {self.busy:.2f} s, '
+                f'waiting for input {self.wait_in:.2f} s, for output {self.wait_out:.2f} s')
+
+
+def _get(q, stop):
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            return q.get(timeout=_POLL)
+        except queue.Empty:
+            pass
+
+
+def _put(q, item, stop):
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            return q.put(item, timeout=_POLL)
+        except queue.Full:
+            pass
+
+
+def _iter_queue(q, stats, stop):
+    while True:
+        t0 = time.time()
+        item = _get(q, stop)
+        stats.wait_in += time.time() - t0
+        if item is _DONE:
+            return
+        if isinstance(item, _Failed):
+            raise item.exc
+        yield item
+
+
+def _run_stage(fn, q_in, q_out, stats, stop):
+    t0 = time.time()
+    items = None
+    try:
+        items = fn() if q_in is None else fn(_iter_queue(q_in, stats, stop))
+        for item in items:
+            stats.items += 1
+            t1 = time.time()
+            _put(q_out, item, stop)
+            stats.wait_out += time.time() - t1
+        _put(q_out, _DONE, stop)
+    except _Stopped:
+        pass
+    except BaseException as exc:
+        try:
+            _put(q_out, _Failed(exc), stop)
+        except _Stopped:
+            pass
+    finally:
+        if hasattr(items, 'close'):
+            items.close()
+        stats.total = time.time() - t0
+
+
+def _drain(q):
+    while True:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            return
+
+
+def run_stages(stages, maxsize=4, stats=None):
+    '''
+    Run each stage in its own thread, connected to the next by a bounded queue.
+
+    Args:
+        stages (list): Each element is a 2-tuple: (name, fn).  The first fn takes no
+            arguments; every other fn takes an iterator over the items output by the
+            previous stage.  Each fn returns an iterator over its output items.
+        maxsize (int): Maximum number of items waiting between two stages.
+        stats (None, list): If a list, a `StageStats` for each stage is appended to it.
+
+    Yields:
+        Items output by the last stage.  If a stage raises, the exception is
+        re-raised here.  Once the last item is yielded, or a stage has raised, or
+        the iteration is stopped early, all the stages' threads have finished.
+    '''
+    queues = [queue.Queue(maxsize=maxsize) for _ in stages]
+    stop = threading.Event()
+    threads = []
+    for i, (name, fn) in enumerate(stages):
+        stage_stats = StageStats(name)
+        if stats is not None:
+            stats.append(stage_stats)
+        q_in = queues[i - 1] if i > 0 else None
+        threads.append(threading.Thread(target=_run_stage, args=(fn, q_in, queues[i], stage_stats, stop),
+                                        name=f'showus-{name}', daemon=True))
+    try:
+        for thread in threads:
+            thread.start()
+        yield from _iter_queue(queues[-1], StageStats('consumer'), stop)
+    finally:
+        stop.set()
+        for q in queues:
+            _drain(q)
+        for thread in threads:
+            if thread.is_alive():
+                thread.join()
+
+# Cell
+def _extract(papers, **kwargs):
+    for paper_id, paper in papers:
+        yield paper_id, get_paper_inference_sentences(paper, **kwargs)
+
+
+def _batch(papers, batch_size=64):
+    '''
+    Gather sentences across papers into batches of `batch_size` sentences.  Each batch
+    carries the number of sentences of every paper that first appears in it, so that
+    downstream it's known when all of a paper's sentences have been seen.
+    '''
+    paper_ids, sentences, counts = [], [], {}
+    for paper_id, paper_sentences in papers:
+        counts[paper_id] = len(paper_sentences)
+        for sentence in paper_sentences:
+            paper_ids.append(paper_id)
+            sentences.append(sentence)
+            if len(sentences) == batch_size:
+                yield paper_ids, sentences, counts
+                paper_ids, sentences, counts = [], [], {}
+    if counts or sentences:
+        yield paper_ids, sentences, counts
+
+
+def _tokenize(batches, tokenizer=None):
+    for paper_ids, sentences, counts in batches:
+        inputs, word_ids = tokenize_sentences(sentences, tokenizer=tokenizer) if sentences else (None, [])
+        yield paper_ids, sentences, counts, inputs, word_ids
+
+
+def _forward(batches, model=None):
+    for paper_ids, sentences, counts, inputs, word_ids in batches:
+        probs = predict_probs(inputs, model=model) if sentences else []
+        yield paper_ids, sentences, counts, probs, word_ids
+
+
+def _decode(batches, classlabel=None):
+    '''
+    Yields (paper_id, labels) as soon as all of a paper's sentences are decoded.
+    '''
+    remaining, labels = {}, {}
+    for paper_ids, sentences, counts, probs, word_ids in batches:
+        for paper_id, n in counts.items():
+            remaining[paper_id] = n
+            labels[paper_id] = set()
+        for paper_id, sentence, prob in zip(paper_ids, sentences, get_word_probs(probs, word_ids)):
+            pred = [classlabel.int2str(int(p)) for p in prob.argmax(axis=1)]
+            labels[paper_id] |= get_sentence_dataset_labels(sentence, pred)
+            remaining[paper_id] -= 1
+        for paper_id in [paper_id for paper_id, n in remaining.items() if n == 0]:
+            del remaining[paper_id]
+            yield paper_id, labels.pop(paper_id)
+
+# Cell
+def overlapped_predict(dir_json, paper_ids, tokenizer=None, model=None, batch_size=64, maxsize=4,
+                       num_workers=8, prefetch=32,
+                       mark_title=False, mark_text=False, pretokenizer=BertPreTokenizer(),
+                       sentence_definition='sentence', max_length=64, overlap=20,
+                       min_length=10, contains_keywords=['data', 'study'], stats=None):
+    '''
+    Predict dataset labels for papers, with the stages of inference overlapping in time.
+
+    Args:
+        dir_json (str, Path): Directory containing the papers' json files.
+        paper_ids (list): IDs of the papers.
+        batch_size (int): Number of sentences in each forward pass.
+        maxsize (int): Maximum number of items waiting between two stages.
+        num_workers, prefetch (int): Passed to `iter_papers`.
+        stats (None, list): If a list, a `StageStats` for each stage is appended to it.
+
+    Returns:
+        paper_dataset_labels (list): Each element is a set consisting of labels predicted
+            by the model, for each paper in `paper_ids`.  Like that returned by
+            `get_paper_dataset_labels`.
+    '''
+    sentence_kwargs = dict(mark_title=mark_title, mark_text=mark_text, pretokenizer=pretokenizer,
+                           sentence_definition=sentence_definition,
+                           max_length=max_length, overlap=overlap,
+                           min_length=min_length, contains_keywords=contains_keywords)
+    stages = [
+        ('read', partial(iter_papers, dir_json, paper_ids, num_workers=num_workers, prefetch=prefetch)),
+        ('extract', partial(_extract, **sentence_kwargs)),
+        ('batch', partial(_batch, batch_size=batch_size)),
+        ('tokenize', partial(_tokenize, tokenizer=tokenizer)),
+        ('forward', partial(_forward, model=model)),
+        ('decode', partial(_decode, classlabel=get_ner_classlabel()))]
+
+    with span('overlapped_predict'):
+        labels = dict(run_stages(stages, maxsize=maxsize, stats=stats))
+    return [labels[paper_id] for paper_id in paper_ids]
\ No newline at end of file
@@ -0,0 +1,250 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/packing.ipynb (unless otherwise specified).
+
+__all__ = ['pack_ner_data', 'unpack_predictions', 'tokenize_and_align_packed_labels', 'supports_boundary_masking',
+           'get_position_offset', 'packed_attention_inputs', 'DataCollatorForPackedTokenClassification',
+           'BOUNDARY_MASK_MODEL_TYPES', 'packed_ner_predict']
+
+# Cell
+import os, sys, time
+import json
+import numpy as np
+import torch
+from transformers import DataCollatorForTokenClassification
+from .showus import *
+from .instrument import span, count, log
+
+# Cell
+def pack_ner_data(ner_data, paper_length=None, tokenizer=None, max_tokens=None):
+    '''
+    Greedily pack consecutive sentences of the same paper into sequences of at most
+    `max_tokens` sub-tokens.
+
+    Args:
+        ner_data (list): Each element is a sentence, of the form: [('There', 0), ('has', 0), ...].
+        paper_length (None, list): Number of sentences in each paper.  Sentences are only packed
+            together with sentences of the same paper.  If None, any sentences can be packed together.
+        max_tokens (None, int): Maximum number of sub-tokens in a pack, including special
+            and boundary tokens.  Defaults to the tokenizer's `model_max_length`.
+
+    Returns:
+        packs (list): Each element is a dict with keys 'tokens', 'ner_tags', and 'sentence_idx',
+            the index in `ner_data` of the sentence each word comes from, -1 for boundary words.
+    '''
+    if not ner_data:
+        return []
+    max_tokens = max_tokens or tokenizer.model_max_length
+    boundary = tokenizer.sep_token
+    num_special = tokenizer.num_special_tokens_to_add()
+    if paper_length is None:
+        paper_length = [len(ner_data)]
+    paper_idx = np.repeat(np.arange(len(paper_length)), paper_length)
+
+    sentences = [[word for word, _ in row] for row in ner_data]
+    num_tokens = [len(input_ids) for input_ids in tokenizer(
+        sentences, is_split_into_words=True, add_special_tokens=False)['input_ids']]
+
+    packs, pack, pack_tokens, pack_paper = [], None, 0, None
+    for i, (row, n) in enumerate(zip(ner_data, num_tokens)):
+        if pack is not None and (paper_idx[i] != pack_paper or
+                                 pack_tokens + 1 + n > max_tokens - num_special):
+            packs.append(pack)
+            pack = None
+        if pack is None:
+            pack = {'tokens': [], 'ner_tags': [], 'sentence_idx': []}
+            pack_tokens, pack_paper = 0, paper_idx[i]
+        else:
+            pack['tokens'].append(boundary)
+            pack['ner_tags'].append(0)
+            pack['sentence_idx'].append(-1)
+            pack_tokens += 1
+        for word, tag in row:
+            pack['tokens'].append(word)
+            pack['ner_tags'].append(tag)
+            pack['sentence_idx'].append(i)
+        pack_tokens += n
+    if pack is not None:
+        packs.append(pack)
+    return packs
+
+
+def unpack_predictions(pack_predictions, packs, num_sentences):
+    '''
+    Args:
+        pack_predictions (list): For each pack, a prediction for each of its words.
+        packs (list): As returned by `pack_ner_data`.
+        num_sentences (int): Number of sentences that were packed.
+
+    Returns:
+        predictions (list): For each original sentence, a prediction for each of its words.
+    '''
+    predictions = [[] for _ in range(num_sentences)]
+    for pred, pack in zip(pack_predictions, packs):
+        for p, i in zip(pred, pack['sentence_idx']):
+            if i >= 0:
+                predictions[i].append(p)
+    return predictions
+
+# Cell
+def tokenize_and_align_packed_labels(examples, tokenizer=None, label_all_tokens=True):
+    '''
+    Like `tokenize_and_align_labels`, for packs from `pack_ner_data`.  Boundary words are
+    given the label -100, and a field called 'segment_ids' is added, which is the position
+    within the pack of the sentence that each sub-token belongs to.
+    '''
+    tokenized_inputs = tokenize_and_align_labels(examples, tokenizer=tokenizer,
+                                                 label_all_tokens=label_all_tokens)
+    segment_ids_all = []
+    for labels, word_ids, sentence_idx in zip(tokenized_inputs['labels'],
+                                              tokenized_inputs['word_ids'],
+                                              examples['sentence_idx']):
+        segment, segment_ids = 0, []
+        for j, word_idx in enumerate(word_ids):
+            if word_idx is not None and sentence_idx[word_idx] == -1:
+                labels[j] = -100
+                segment_ids.append(segment)
+                segment += 1
+            else:
+                segment_ids.append(segment)
+        segment_ids_all.append(segment_ids)
+    tokenized_inputs['segment_ids'] = segment_ids_all
+    return tokenized_inputs
+
+
+# Model types whose `forward` accepts a 3D attention mask.
+BOUNDARY_MASK_MODEL_TYPES = ['bert', 'roberta', 'xlm-roberta', 'camembert', 'electra']
+# Model types whose position ids start after `config.pad_token_id`.
+_PADDING_OFFSET_MODEL_TYPES = ['roberta', 'xlm-roberta', 'camembert']
+
+
+def supports_boundary_masking(config):
+    '''
+    Whether models with `config` accept the attention mask from `packed_attention_inputs`.
+    '''
+    return config.model_type in BOUNDARY_MASK_MODEL_TYPES
+
+
+def get_position_offset(config):
+    '''
+    Position id of the first token for models with `config`: `config.pad_token_id + 1`
+    for RoBERTa and its derivatives, 0 otherwise.
+    '''
+    return config.pad_token_id + 1 if config.model_type in _PADDING_OFFSET_MODEL_TYPES else 0
+
+
+def _check_boundary_masking(config):
+    if not supports_boundary_masking(config):
+        raise ValueError(
+            f"Can't mask sentence boundaries for model type '{config.model_type}', which only "
+            f"accepts a 2D attention mask.  Supported model types: {BOUNDARY_MASK_MODEL_TYPES}.")
+
+
+def packed_attention_inputs(segment_ids, attention_mask, position_offset=0):
+    '''
+    Attention mask that stops sub-tokens attending across sentence boundaries, and position ids
+    that restart at 1 for each sentence after the first, as if each had its own leading special token.
+
+    Args:
+        segment_ids (torch.Tensor): Of shape (batch size, sequence length).  Padded with -1.
+        attention_mask (torch.Tensor): The usual 2D padding mask.
+        position_offset (int): Added to the position ids, as returned by `get_position_offset`.
+
+    Returns:
+        attention_mask (torch.Tensor): Of shape (batch size, sequence length, sequence length),
+            and the same dtype as `attention_mask`.
+        position_ids (torch.Tensor): Of shape (batch size, sequence length).
+    '''
+    same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]
+    mask = same_segment & attention_mask.bool()[:, None, :] & attention_mask.bool()[:, :, None]
+
+    seq_len = segment_ids.shape[1]
+    positions = torch.arange(seq_len, device=segment_ids.device).expand_as(segment_ids)
+    is_start = torch.ones_like(segment_ids, dtype=torch.bool)
+    is_start[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+    start = torch.where(is_start, positions, torch.zeros_like(positions))
+    start = torch.cummax(start, dim=1).values
+    position_ids = positions - start + (segment_ids > 0).long() + position_offset
+    return mask.to(attention_mask.dtype), position_ids * attention_mask
+
+
+class DataCollatorForPackedTokenClassification(DataCollatorForTokenClassification):
+    '''
+    Pads like `DataCollatorForTokenClassification`, and, if `mask_boundaries`, replaces
+    the attention mask, and adds position ids, from `packed_attention_inputs`.
+
+    Args:
+        mask_boundaries (None, bool): If None, boundaries are masked if the model supports it.
+        config (None, PretrainedConfig): Config of the model.  Needed to mask boundaries.
+    '''
+    def __init__(self, tokenizer, mask_boundaries=None, config=None, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        if mask_boundaries is None:
+            mask_boundaries = config is not None and supports_boundary_masking(config)
+        if mask_boundaries:
+            if config is None:
+                raise ValueError('The model `config` is needed to mask sentence boundaries.')
+            _check_boundary_masking(config)
+        self.mask_boundaries = mask_boundaries
+        self.position_offset = get_position_offset(config) if mask_boundaries else 0
+
+    def __call__(self, features):
+        segment_ids = [feature.pop('segment_ids') for feature in features]
+        batch = super().__call__(features)
+        if self.mask_boundaries:
+            seq_len = batch['input_ids'].shape[1]
+            segment_ids = torch.tensor([s + [-1] * (seq_len - len(s)) for s in segment_ids])
+            batch['attention_mask'], batch['position_ids'] = packed_attention_inputs(
+                segment_ids, batch['attention_mask'], position_offset=self.position_offset)
+        return batch
+
+# Cell
+def packed_ner_predict(pth, paper_length=None, tokenizer=None, model=None, max_tokens=None,
+                       batch_size=16, mask_boundaries=None):
+    '''
+    Like `batched_ner_predict`, but with sentences of the same paper packed together.
+
+    Args:
+        pth (str, Path): NER json file, like that written by `batched_write_ner_inference_json`.
+        paper_length (None, list): Number of sentences in each paper.
+        max_tokens (None, int): Passed to `pack_ner_data`.
+        batch_size (int): Number of packs in each forward pass.
+        mask_boundaries (None, bool): If True, sentences in a pack don't attend to each other.
+            If None, they don't if the model supports it (see `supports_boundary_masking`).
+
+    Returns:
+        predictions (list): Each element is a list of predicted label ids for the
+            words in a sentence in `pth`.
+        stats (dict): Number of 'sentences', and of 'packs', i.e. of model inputs.
+    '''
+    rows = [json.loads(line) for line in open(pth, mode='r')]
+    ner_data = [list(zip(row['tokens'], row['ner_tags'])) for row in rows]
+
+    with span('pack'):
+        packs = pack_ner_data(ner_data, paper_length=paper_length, tokenizer=tokenizer,
+                              max_tokens=max_tokens)
+    if mask_boundaries is None:
+        mask_boundaries = supports_boundary_masking(model.config)
+    elif mask_boundaries:
+        _check_boundary_masking(model.config)
+    offset = get_position_offset(model.config)
+
+    pack_predictions = []
+    with span('packed_predict'):
+        for i in range(0, len(packs), batch_size):
+            batch = packs[i:i + batch_size]
+            examples = {k: [pack[k] for pack in batch] for k in batch[0]}
+            tokenized = tokenize_and_align_packed_labels(examples, tokenizer=tokenizer)
+            inputs = tokenizer.pad({'input_ids': tokenized['input_ids']}, return_tensors='pt')
+            if mask_boundaries:
+                seq_len = inputs['input_ids'].shape[1]
+                segment_ids = torch.tensor([s + [-1] * (seq_len - len(s))
+                                            for s in tokenized['segment_ids']])
+                inputs['attention_mask'], inputs['position_ids'] = packed_attention_inputs(
+                    segment_ids, inputs['attention_mask'], position_offset=offset)
+            probs = predict_probs(inputs, model=model)
+            pack_predictions.extend(prob.argmax(axis=1).tolist()
+                                    for prob in get_word_probs(probs, tokenized['word_ids']))
+
+    predictions = unpack_predictions(pack_predictions, packs, len(ner_data))
+    count('packs', len(packs))
+    log(f'{len(ner_data)} sentences packed into {len(packs)} sequences.')
+    return predictions, {'sentences': len(ner_data), 'packs': len(packs)}
\ No newline at end of file
@@ -0,0 +1,390 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/pipeline.ipynb (unless otherwise specified).
+
+__all__ = ['hash_args', 'file_digest', 'papers_digest', 'checkpoint_digest', 'Artifact', 'stage', 'predict_tags',
+           'combine_ensemble_labels', 'build_pipeline', 'run_pipeline', 'main']
+
+# Cell
+import os, sys, time
+import argparse
+import hashlib
+import json
+import pickle
+import tempfile
+from pathlib import Path
+import pandas as pd
+from datasets import load_metric
+from transformers import AutoModelForTokenClassification
+from .showus import *
+from .fuzzy import knowledge_bank_matcher
+from .instrument import (span, count, log, configure, write_jsonl, to_prometheus,
+                               start_profiling, stop_profiling)
+
+# Cell
+def hash_args(*args):
+    '''
+    Hash any json-serialisable arguments into a hex digest.
+    Objects which are not json-serialisable are represented by their `str`.
+    '''
+    s = json.dumps(args, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+def file_digest(pth, chunk_size=1 << 20):
+    '''
+    Hex digest of the content of file at `pth`.
+    '''
+    h = hashlib.sha1()
+    with open(pth, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def papers_digest(dir_json, paper_ids):
+    '''
+    Digest of the content of the papers, in the order given by `paper_ids`.
+    '''
+    return hash_args([(paper_id, file_digest(f'{dir_json}/{paper_id}.json'))
+                      for paper_id in paper_ids])
+
+
+def checkpoint_digest(model_checkpoint):
+    '''
+    Digest of a model checkpoint.  For a local directory, this is the digest of its files.
+    Otherwise, `model_checkpoint` is taken to be a name on the model hub, and its name is used.
+    '''
+    pth = Path(model_checkpoint)
+    if not pth.is_dir():
+        return hash_args(str(model_checkpoint))
+    return hash_args([(p.name, file_digest(p)) for p in sorted(pth.iterdir()) if p.is_file()])
+
+# Cell
+class Artifact:
+    '''
+    Output of a pipeline stage.  It's computed, or loaded from the cache, only when
+    `value` is first accessed.
+    '''
+    def __init__(self, key, compute):
+        self.key = key
+        self._compute = compute
+        self._done = False
+        self._value = None
+
+    @property
+    def value(self):
+        if not self._done:
+            self._value = self._compute()
+            self._done = True
+        return self._value
+
+
+def stage(name, fn, deps=(), params=None, cache_dir=None):
+    '''
+    Create a pipeline stage.
+
+    Args:
+        name (str): Name of the stage.  Cached outputs are stored in a sub-directory
+            of `cache_dir` with this name.
+        fn (callable): Called with the values of `deps` as positional arguments,
+            to compute the output of the stage.
+        deps (list): `Artifact`s that the stage depends on.
+        params (dict): Parameters that affect the output of the stage.  They go into
+            the cache key, together with the keys of `deps`.
+        cache_dir (None, str, Path): Directory of the cache.  If None, the output is not cached.
+
+    Returns:
+        artifact (Artifact): The stage's output.
+    '''
+    key = hash_args(name, params or {}, [dep.key for dep in deps])
+
+    def compute():
+        pth = Path(cache_dir)/name/f'{key}.pkl' if cache_dir is not None else None
+        if pth is not None and pth.exists():
+            log(f'{name}: loading cached output {key[:10]}.')
+            count('cache_hits')
+            with open(pth, 'rb') as f:
+                return pickle.load(f)
+
+        count('cache_misses')
+        args = [dep.value for dep in deps]
+        log(f'{name}: computing {key[:10]}...')
+        with span(name):
+            value = fn(*args)
+
+        if pth is not None:
+            pth.parent.mkdir(parents=True, exist_ok=True)
+            pth_tmp = pth.with_suffix('.tmp')
+            with open(pth_tmp, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(pth_tmp, pth)
+        return value
+
+    return Artifact(key, compute)
+
+# Cell
+def _write_sentences(dir_json, sample_submission, pth, memory_budget=None, **kwargs):
+    Path(pth).parent.mkdir(parents=True, exist_ok=True)
+    paper_length = batched_write_ner_inference_json(
+        dir_json, sample_submission, pth=pth, memory_budget=memory_budget, **kwargs)
+    return pth, paper_length
+
+
+def predict_tags(pth, model_checkpoint=None, metric=None,
+                 batch_size=64_000, per_device_batch_size=16, model_cache_dir=None, store_dir=None,
+                 memory_budget=None):
+    '''
+    Predict the tag ('O', 'I', or 'B') of each word in NER json file `pth`,
+    with the model at `model_checkpoint`.  If `model_cache_dir` is given, the model
+    is loaded memory-mapped from there, with `showus.modelcache.load_model`.
+    `store_dir` is passed to `batched_ner_predict`, so that an interrupted run resumes,
+    and `memory_budget`, to adjust the batch size to the memory available.
+    '''
+    classlabel = get_ner_classlabel()
+    tokenizer = create_tokenizer(model_checkpoint=model_checkpoint)
+    if model_cache_dir is None:
+        model = AutoModelForTokenClassification.from_pretrained(model_checkpoint)
+    else:
+        from .modelcache import load_model
+        model = load_model(model_checkpoint, cache_dir=model_cache_dir)
+    predictions, _ = batched_ner_predict(
+        pth, tokenizer=tokenizer, model=model, metric=metric, batch_size=batch_size,
+        per_device_train_batch_size=per_device_batch_size,
+        per_device_eval_batch_size=per_device_batch_size, store_dir=store_dir,
+        memory_budget=memory_budget)
+    return [[classlabel.int2str(p) for p in pred] for pred in predictions]
+
+
+def _literal_match(dir_json, pth_knowledge_bank, paper_ids, fuzzy_threshold=None):
+    match = knowledge_bank_matcher(load_knowledge_bank(pth_knowledge_bank), fuzzy_threshold=fuzzy_threshold)
+    return [match(paper) for _, paper in iter_papers(dir_json, paper_ids)]
+
+
+def combine_ensemble_labels(literal_preds, *model_preds):
+    '''
+    Like `combine_matching_and_model`, but for any number of models.  Literal matches
+    come first, followed by the labels from each model, in order.
+    '''
+    return [[label for label_set in set_tuple for label in label_set]
+            for set_tuple in zip(literal_preds, *model_preds)]
+
+# Cell
+def build_pipeline(dir_json, sample_submission, model_checkpoints=(), pth_knowledge_bank=None,
+                   metric=None, cache_dir='showus_cache',
+                   mark_title=False, mark_text=False, sentence_definition='sentence',
+                   max_length=64, overlap=20, min_length=10, contains_keywords=['data', 'study'],
+                   batch_size=64_000, per_device_batch_size=16, max_similarity=0.75,
+                   model_cache_dir=None, memory_budget=None, section_policy=None, fuzzy_threshold=None):
+    '''
+    Wire up the inference stages:
+
+        papers -+-> sentences -> predict (one per model) -> model_labels -+-> filter
+                |                                                         |
+                +-> literal_match ----------------------------------------+
+
+    Args:
+        dir_json (str, Path): Directory containing the papers' json files.
+        sample_submission (pd.DataFrame): Competition 'sample_submission.csv'.
+        model_checkpoints (list): Checkpoints of the models in the ensemble.
+        pth_knowledge_bank (None, str): Meta data like 'train.csv', or a `KnowledgeBank`
+            saved with `KnowledgeBank.save`, for literal matching.
+            If None, literal matching is not done.
+        fuzzy_threshold (None, float): If given, literal matching also finds mentions with at
+            least this Jaccard similarity to a label, with `showus.fuzzy.fuzzy_literal_match`.
+        metric: Passed to `batched_ner_predict`.
+        model_cache_dir (None, str): Passed to `predict_tags`.
+        memory_budget (None, float): Memory, in MB, within which to keep the process
+            while writing sentences and predicting, by adjusting the batch sizes.
+            The outputs don't depend on it, so it's not part of the cache keys.
+        section_policy (None, dict): If given, sections of the papers are pruned
+            with `prune_sections`, with this policy, before extracting sentences.
+        cache_dir (None, str): Directory of the cache.  If None, nothing is cached,
+            and the sentences are written to a temporary directory.
+
+    Returns:
+        stages (dict): `Artifact` of each stage.  `stages['filter'].value` are the
+            predicted labels for each paper, seperated by '|'.
+    '''
+    paper_ids = list(sample_submission['Id'])
+    stages = {}
+    # The sentences stage writes a json file even when nothing is cached, and
+    # predictions are only stored batch by batch, for resuming, when they are.
+    dir_sentences = (Path(cache_dir)/'sentences' if cache_dir is not None
+                     else Path(tempfile.mkdtemp(prefix='showus_sentences_')))
+    store_dir = Path(cache_dir)/'batches' if cache_dir is not None else None
+
+    # Papers are read ahead with `iter_papers` by the stages that need them.
+    stages['papers'] = Artifact(papers_digest(dir_json, paper_ids), lambda: dir_json)
+
+    sentence_params = dict(mark_title=mark_title, mark_text=mark_text,
+                           sentence_definition=sentence_definition,
+                           max_length=max_length, overlap=overlap,
+                           min_length=min_length, contains_keywords=contains_keywords)
+    if section_policy is not None:  # Only then, to keep the keys of sentences cached before.
+        sentence_params['section_policy'] = section_policy
+    sentences_key = hash_args('sentences', sentence_params, [stages['papers'].key])
+    stages['sentences'] = stage(
+        'sentences',
+        lambda papers: _write_sentences(
+            papers, sample_submission, dir_sentences/f'{sentences_key}.json',
+            memory_budget=memory_budget, **sentence_params),
+        deps=[stages['papers']], params=sentence_params, cache_dir=cache_dir)
+
+    model_stages = []
+    for model_checkpoint in model_checkpoints:
+        predict = stage(
+            'predict',
+            lambda sentences, ckpt=model_checkpoint: predict_tags(
+                sentences[0], model_checkpoint=ckpt, metric=metric, batch_size=batch_size,
+                per_device_batch_size=per_device_batch_size, model_cache_dir=model_cache_dir,
+                store_dir=store_dir, memory_budget=memory_budget),
+            deps=[stages['sentences']],
+            params={'model': checkpoint_digest(model_checkpoint)}, cache_dir=cache_dir)
+        model_stages.append(stage(
+            'model_labels',
+            lambda sentences, predictions: get_paper_dataset_labels(*sentences, predictions),
+            deps=[stages['sentences'], predict], cache_dir=cache_dir))
+        stages[f'predict_{len(model_stages) - 1}'] = predict
+        stages[f'model_labels_{len(model_stages) - 1}'] = model_stages[-1]
+
+    if pth_knowledge_bank is not None:
+        match_params = {'knowledge_bank': file_digest(pth_knowledge_bank)}
+        if fuzzy_threshold is not None:
+            match_params['fuzzy_threshold'] = fuzzy_threshold
+        stages['literal_match'] = stage(
+            'literal_match',
+            lambda papers: _literal_match(papers, pth_knowledge_bank, paper_ids,
+                                          fuzzy_threshold=fuzzy_threshold),
+            deps=[stages['papers']], params=match_params, cache_dir=cache_dir)
+    else:
+        stages['literal_match'] = Artifact(hash_args(None), lambda: [set() for _ in paper_ids])
+
+    stages['filter'] = stage(
+        'filter',
+        lambda literal_preds, *model_preds: filter_dataset_labels(
+            combine_ensemble_labels(literal_preds, *model_preds), max_similarity=max_similarity),
+        deps=[stages['literal_match']] + model_stages,
+        params={'max_similarity': max_similarity}, cache_dir=cache_dir)
+
+    return stages
+
+# Cell
+def run_pipeline(dir_json, pth_sample_submission, pth_submission='submission.csv', **kwargs):
+    '''
+    Run the inference pipeline and write the submission file.
+    `kwargs` are passed to `build_pipeline`.
+    '''
+    sample_submission = pd.read_csv(pth_sample_submission)
+    stages = build_pipeline(dir_json, sample_submission, **kwargs)
+    sample_submission['PredictionString'] = stages['filter'].value
+    sample_submission.to_csv(pth_submission, index=False)
+    return sample_submission
+
+# Cell
+def _section_action(arg):
+    # `type` of --prune-sections: 'KIND=ACTION' -> (kind, action).
+    kind, sep, action = arg.partition('=')
+    if not sep or kind not in SECTION_KINDS or action not in ('keep', 'skip', 'truncate'):
+        raise argparse.ArgumentTypeError(
+            f"{arg!r} should be KIND=ACTION, with KIND one of {', '.join(SECTION_KINDS)}, "
+            f"and ACTION one of keep, skip, truncate.")
+    return kind, action
+
+
+def main(argv=None):
+    '''
+    Entry point of the `showus` command.
+    '''
+    parser = argparse.ArgumentParser(
+        prog='showus', description='Predict dataset mentions in papers.')
+    parser.add_argument('dir_json', help="Directory containing the papers' json files.")
+    parser.add_argument('sample_submission', help="Path to 'sample_submission.csv'.")
+    parser.add_argument('--submission', default='submission.csv', help='Output csv.')
+    parser.add_argument('--model-checkpoint', action='append', default=[],
+                        help='Model checkpoint.  Give more than once for an ensemble.')
+    parser.add_argument('--knowledge-bank', default=None,
+                        help=("Meta data like 'train.csv', or a knowledge bank saved with "
+                              "KnowledgeBank.save, for literal matching."))
+    parser.add_argument('--fuzzy-threshold', type=float, default=None,
+                        help=('Also find mentions whose word-level Jaccard similarity to a label in '
+                              'the knowledge bank is at least this, e.g. 0.5.'))
+    parser.add_argument('--metric', default='seqeval', help='Passed to `load_metric`.')
+    parser.add_argument('--cache-dir', default='showus_cache')
+    parser.add_argument('--model-cache-dir', default=None,
+                        help='Convert models to safetensors here, and load them memory-mapped.')
+    parser.add_argument('--sentence-definition', default='sentence',
+                        choices=['sentence', 'section', 'paper'])
+    parser.add_argument('--mark-title', action='store_true')
+    parser.add_argument('--mark-text', action='store_true')
+    parser.add_argument('--max-length', type=int, default=64)
+    parser.add_argument('--overlap', type=int, default=20)
+    parser.add_argument('--min-length', type=int, default=10)
+    parser.add_argument('--keywords', nargs='*', default=['data', 'study'],
+                        help='Only predict on sentences containing one of these.')
+    parser.add_argument('--prune-sections', nargs='*', default=None, metavar='KIND=ACTION',
+                        type=_section_action,
+                        help=('Skip or truncate references, affiliations and tables before extracting '
+                              'sentences, with the default policy, changed by any KIND=ACTION given, '
+                              'e.g. table=skip.'))
+    parser.add_argument('--batch-size', type=int, default=64_000)
+    parser.add_argument('--memory-budget', type=float, default=None, metavar='MB',
+                        help=('Adjust batch sizes between batches to keep memory within this '
+                              'many MB.  --batch-size is then the first batch size.'))
+    parser.add_argument('--per-device-batch-size', type=int, default=16)
+    parser.add_argument('--max-similarity', type=float, default=0.75)
+    parser.add_argument('--metrics', default=None,
+                        help=('Record stage timings and counters, and append them to this file, '
+                              'in Prometheus text format if it ends with .prom, else as json lines.'))
+    parser.add_argument('--quiet', action='store_true', help='Do not print progress.')
+    parser.add_argument('--profile', default=None, metavar='DIR',
+                        help=('Profile each stage, and write its pstats and collapsed stacks, '
+                              'and a summary of hotspots, to this directory.'))
+    parser.add_argument('--incremental', action='store_true',
+                        help=('Keep per-paper outputs in --cache-dir, and only process papers '
+                              'that are new or have changed since the last run.'))
+    parser.add_argument('--shards', type=int, default=None, metavar='N',
+                        help=('Split the papers into N shards, each predicted on by a worker subprocess, '
+                              'with --cache-dir as the directory shared with the workers.'))
+    parser.add_argument('--workers', type=int, default=2,
+                        help='With --shards, the number of workers running at the same time.')
+    args = parser.parse_args(argv)
+    configure(enabled=True if args.metrics is not None else None,
+              verbose=False if args.quiet else None)
+    if args.profile is not None:
+        start_profiling()
+
+    metric = load_metric(args.metric) if args.model_checkpoint else None
+    if args.incremental:
+        from .manifest import run_incremental
+        run, cache_kwargs = run_incremental, {'store_dir': args.cache_dir}
+    elif args.shards is not None:
+        from .shard import run_sharded
+        run, cache_kwargs = run_sharded, {'shared_dir': args.cache_dir, 'num_shards': args.shards,
+                                          'num_workers': args.workers}
+        metric = args.metric  # Loaded by each worker.
+    else:
+        run, cache_kwargs = run_pipeline, {'cache_dir': args.cache_dir}
+
+    run(
+        args.dir_json, args.sample_submission, pth_submission=args.submission,
+        model_checkpoints=args.model_checkpoint, pth_knowledge_bank=args.knowledge_bank,
+        fuzzy_threshold=args.fuzzy_threshold, metric=metric, **cache_kwargs,
+        mark_title=args.mark_title, mark_text=args.mark_text,
+        sentence_definition=args.sentence_definition,
+        max_length=args.max_length, overlap=args.overlap, min_length=args.min_length,
+        contains_keywords=args.keywords or None,
+        batch_size=args.batch_size, per_device_batch_size=args.per_device_batch_size,
+        max_similarity=args.max_similarity, model_cache_dir=args.model_cache_dir,
+        memory_budget=args.memory_budget,
+        section_policy=(None if args.prune_sections is None else
+                        {**DEFAULT_SECTION_POLICY, **dict(args.prune_sections)}))
+
+    if args.metrics is not None:
+        labels = {'command': ('incremental' if args.incremental else
+                              'sharded' if args.shards is not None else 'pipeline')}
+        if args.metrics.endswith('.prom'):
+            with open(args.metrics, mode='a') as f:
+                f.write(to_prometheus(**labels))
+        else:
+            write_jsonl(args.metrics, **labels)
+    if args.profile is not None:
+        print(stop_profiling(args.profile))
\ No newline at end of file
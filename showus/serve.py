@@ -0,0 +1,449 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/serve.ipynb (unless otherwise specified).
+
+__all__ = ['latency_percentiles', 'ServerStats', 'MicroBatcher', 'LabelServer', 'main', 'load_test', 'benchmark_server']
+
+# Cell
+import os, sys, time
+import argparse
+import asyncio
+import json
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .showus import *
+from .pipeline import combine_ensemble_labels
+from .fuzzy import knowledge_bank_matcher
+from .instrument import log
+
+# Cell
+def latency_percentiles(latencies):
+    '''
+    Median and 99th percentile of `latencies` (s), in ms.  None if there are no latencies,
+    e.g. because every request failed.
+    '''
+    if len(latencies) == 0:
+        return {'p50_ms': None, 'p99_ms': None}
+    return {'p50_ms': 1000 * float(np.percentile(latencies, 50)),
+            'p99_ms': 1000 * float(np.percentile(latencies, 99))}
+
+
+class ServerStats:
+    '''
+    Latency of each request, and counts of requests, sentences, and model batches.
+    Percentiles are over the most recent `window` requests.
+    '''
+    def __init__(self, window=10_000):
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.sentences = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.t0 = time.time()
+
+    def record(self, latency):
+        self.requests += 1
+        self.latencies.append(latency)
+
+    def summary(self):
+        elapsed = time.time() - self.t0
+        return {'requests': self.requests, 'errors': self.errors,
+                **latency_percentiles(self.latencies),
+                'requests_per_s': self.requests / elapsed,
+                'sentences_per_s': self.sentences / elapsed,
+                'batches': self.batches,
+                'requests_per_batch': self.batched_requests / max(self.batches, 1)}
+
+# Cell
+class MicroBatcher:
+    '''
+    Gathers the sentences of concurrent requests into shared model batches.
+
+    Args:
+        models (list): (tokenizer, model) of each model in the ensemble.
+        max_batch_size (int): A batch is started once this many sentences are waiting.
+        max_wait (float): Otherwise, it's started this many seconds after the first
+            of the waiting requests arrived.
+        stats (None, ServerStats): Counts of sentences and batches are added to it.
+    '''
+    def __init__(self, models, max_batch_size=64, max_wait=0.005, stats=None):
+        self.models = models
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = stats or ServerStats()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='showus-model')
+        self.queue = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, sentences):
+        '''
+        Returns:
+            word_probs (list): For each model, the word-level class probabilities
+                of each sentence, like `batched_word_probs`.
+        '''
+        if not sentences:
+            return [[] for _ in self.models]
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((sentences, future))
+        return await future
+
+    def _predict(self, sentences):
+        return [batched_word_probs(sentences, tokenizer, model, batch_size=self.max_batch_size)
+                for tokenizer, model in self.models]
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            requests = [await self.queue.get()]
+            num_sentences = len(requests[0][0])
+            deadline = loop.time() + self.max_wait
+            while num_sentences < self.max_batch_size:
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                num_sentences += len(request[0])
+
+            sentences = [sentence for request_sentences, _ in requests for sentence in request_sentences]
+            try:
+                word_probs = await loop.run_in_executor(self.executor, self._predict, sentences)
+            except Exception as exc:
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            self.stats.sentences += len(sentences)
+            self.stats.batches += 1
+            self.stats.batched_requests += len(requests)
+
+            istart = 0
+            for request_sentences, future in requests:
+                iend = istart + len(request_sentences)
+                if not future.done():
+                    future.set_result([probs[istart:iend] for probs in word_probs])
+                istart = iend
+
+# Cell
+class LabelServer:
+    '''
+    Extracts dataset labels from papers sent to it over HTTP.
+
+    Args:
+        models (list): (tokenizer, model) of each model in the ensemble.
+        knowledge_bank (None, set, KnowledgeBank): As returned by `load_knowledge_bank`.
+            If None, literal matching is not done.
+        fuzzy_threshold (None, float): If given, literal matching also finds mentions with at
+            least this Jaccard similarity to a label, with `showus.fuzzy.fuzzy_literal_match`.
+        max_batch_size, max_wait: Passed to `MicroBatcher`.
+        max_similarity (float): Passed to `filter_dataset_labels`.
+        num_workers (None, int): Number of threads for the work done on each paper
+            outside the models.  Defaults to that of `ThreadPoolExecutor`.
+        sentence_kwargs: Passed to `get_paper_inference_sentences`.
+    '''
+    def __init__(self, models, knowledge_bank=None, fuzzy_threshold=None, max_batch_size=64,
+                 max_wait=0.005, max_similarity=0.75, num_workers=None, **sentence_kwargs):
+        self.knowledge_bank = knowledge_bank
+        self.match = (knowledge_bank_matcher(knowledge_bank, fuzzy_threshold=fuzzy_threshold)
+                      if knowledge_bank is not None else None)
+        self.max_similarity = max_similarity
+        self.sentence_kwargs = sentence_kwargs
+        self.stats = ServerStats()
+        self.batcher = MicroBatcher(models, max_batch_size=max_batch_size, max_wait=max_wait,
+                                    stats=self.stats)
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='showus-paper')
+        self.classlabel = get_ner_classlabel()
+
+    async def predict(self, paper):
+        '''
+        Returns:
+            labels (list): Dataset labels found in `paper`, like those in a
+                'PredictionString' of the submission, but as a list.
+        '''
+        loop = asyncio.get_event_loop()
+        paper, sentences = await loop.run_in_executor(self.executor, self._sentences, paper)
+        word_probs = await self.batcher.submit(sentences)
+        return await loop.run_in_executor(self.executor, self._labels, paper, sentences, word_probs)
+
+    def _sentences(self, paper):
+        paper = PaperText(paper)  # Shared by extracting sentences and literal matching.
+        return paper, get_paper_inference_sentences(paper, **self.sentence_kwargs)
+
+    def _labels(self, paper, sentences, word_probs):
+        model_labels = []
+        for probs in word_probs:
+            labels = set()
+            for sentence, prob in zip(sentences, probs):
+                pred = [self.classlabel.int2str(int(p)) for p in prob.argmax(axis=1)]
+                labels |= get_sentence_dataset_labels(sentence, pred)
+            model_labels.append([labels])
+        literal_labels = self.match(paper) if self.match is not None else set()
+
+        labels, = filter_dataset_labels(combine_ensemble_labels([literal_labels], *model_labels),
+                                        max_similarity=self.max_similarity)
+        return labels.split('|') if labels else []
+
+    async def _respond(self, method, path, body):
+        if method == 'GET' and path == '/stats':
+            return 200, self.stats.summary()
+        if method == 'POST' and path == '/predict':
+            t0 = time.time()
+            labels = await self.predict(json.loads(body))
+            self.stats.record(time.time() - t0)
+            return 200, {'labels': labels}
+        return 404, {'error': f'No route for {method} {path}.'}
+
+    async def _read_request(self, reader):
+        '''
+        Returns:
+            request (None, tuple): (method, path, headers, body), or None once the client
+                has closed the connection.  Raises ValueError if the request is malformed.
+        '''
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length < 0:
+            raise ValueError(f'Negative Content-Length: {length}.')
+        return method, path, headers, await reader.readexactly(length)
+
+    @staticmethod
+    async def _write_response(writer, status, response):
+        payload = json.dumps(response).encode('utf-8')
+        writer.write(f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                     f'Content-Type: application/json\r\n'
+                     f'Content-Length: {len(payload)}\r\n\r\n'.encode('latin-1') + payload)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except ValueError as exc:
+                    self.stats.errors += 1
+                    await self._write_response(writer, 400, {'error': f'Malformed request: {exc}'})
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+
+                try:
+                    status, response = await self._respond(method, path, body)
+                except Exception as exc:
+                    self.stats.errors += 1
+                    status, response = 500, {'error': repr(exc)}
+                await self._write_response(writer, status, response)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000, unix_socket=None, ready=None):
+        '''
+        Serve until cancelled.  Listens on `unix_socket` if given, otherwise on `host`:`port`.
+        `ready`, a `threading.Event`, is set once the server is listening.
+        '''
+        await self.batcher.start()
+        try:
+            if unix_socket is not None:
+                server = await asyncio.start_unix_server(self.handle, unix_socket)
+            else:
+                server = await asyncio.start_server(self.handle, host=host, port=port)
+            if ready is not None:
+                ready.set()
+            try:
+                await asyncio.get_event_loop().create_future()  # Until cancelled.
+            finally:
+                server.close()
+                await server.wait_closed()
+        finally:
+            await self.batcher.stop()
+            self.executor.shutdown(wait=True)
+
+# Cell
+def _run(coro):
+    '''
+    Run coroutine `coro` in a new event loop, like `asyncio.run` of Python 3.7.  If
+    interrupted, the coroutine is cancelled, and so can clean up, before the loop is closed.
+    '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    task = loop.create_task(coro)
+    try:
+        return loop.run_until_complete(task)
+    except BaseException:
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except BaseException:
+            pass
+        raise
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def main(argv=None):
+    '''
+    Entry point of the `showus-serve` command.
+    '''
+    parser = argparse.ArgumentParser(
+        prog='showus-serve', description='Serve dataset label extraction over HTTP.')
+    parser.add_argument('--model-checkpoint', action='append', default=[],
+                        help='Model checkpoint.  Give more than once for an ensemble.')
+    parser.add_argument('--model-cache-dir', default=None,
+                        help='Convert models to safetensors here, and load them memory-mapped.')
+    parser.add_argument('--knowledge-bank', default=None,
+                        help=("Meta data like 'train.csv', or a knowledge bank saved with "
+                              "KnowledgeBank.save, for literal matching."))
+    parser.add_argument('--fuzzy-threshold', type=float, default=None,
+                        help=('Also find mentions whose word-level Jaccard similarity to a label in '
+                              'the knowledge bank is at least this, e.g. 0.5.'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix-socket', default=None, help='Listen on this Unix socket instead.')
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-wait', type=float, default=0.005,
+                        help='Seconds to wait for more requests to batch with.')
+    parser.add_argument('--max-similarity', type=float, default=0.75)
+    args = parser.parse_args(argv)
+
+    from .modelcache import load_model
+    models = [(create_tokenizer(model_checkpoint=model_checkpoint),
+               load_model(model_checkpoint, cache_dir=args.model_cache_dir))
+              for model_checkpoint in args.model_checkpoint]
+    knowledge_bank = (load_knowledge_bank(args.knowledge_bank)
+                      if args.knowledge_bank is not None else None)
+    server = LabelServer(models, knowledge_bank=knowledge_bank, fuzzy_threshold=args.fuzzy_threshold,
+                         max_batch_size=args.max_batch_size, max_wait=args.max_wait,
+                         max_similarity=args.max_similarity)
+    print(f'Serving on {args.unix_socket or f"{args.host}:{args.port}"}')
+    try:
+        _run(server.serve(host=args.host, port=args.port, unix_socket=args.unix_socket))
+    except KeyboardInterrupt:
+        pass
+
+# Cell
+async def _client(host, port, bodies, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for body in bodies:
+            t0 = time.time()
+            writer.write(f'POST /predict HTTP/1.1\r\nHost: {host}\r\n'
+                         f'Content-Type: application/json\r\n'
+                         f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body)
+            await writer.drain()
+            status = (await reader.readline()).split()[1]
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            if status == b'200':
+                latencies.append(time.time() - t0)
+            else:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def load_test(papers, host='127.0.0.1', port=8000, num_requests=200, concurrency=16):
+    '''
+    Send `num_requests` requests, each with one of `papers`, over `concurrency`
+    connections, each of which sends its next request once it has a response.
+
+    Returns:
+        stats (dict): Latency percentiles and throughput of the successful requests,
+            as seen by the clients, and the number of 'errors'.
+    '''
+    bodies = [json.dumps(papers[i % len(papers)]).encode('utf-8') for i in range(num_requests)]
+    latencies, errors = [], []
+    t0 = time.time()
+    await asyncio.gather(*(_client(host, port, bodies[i::concurrency], latencies, errors)
+                           for i in range(concurrency)))
+    elapsed = time.time() - t0
+    if errors:
+        statuses = collections.Counter(status.decode('latin-1') for status in errors)
+        log(f'{len(errors)} of {num_requests} requests failed, with status: '
+            + ', '.join(f'{status} ({n})' for status, n in statuses.most_common()))
+    return {'requests': len(latencies), 'errors': len(errors),
+            **latency_percentiles(latencies),
+            'requests_per_s': len(latencies) / elapsed}
+
+
+def _run_until_cancelled(loop, task, ready, failures):
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        pass
+    except Exception as exc:
+        failures.append(exc)
+    finally:
+        ready.set()  # So that the caller isn't left waiting if the server failed to start.
+
+
+def benchmark_server(papers, models, knowledge_bank=None, max_waits=(0, 0.005, 0.02),
+                     max_batch_size=64, num_requests=200, concurrency=16, port=8765, timeout=30):
+    '''
+    For each of `max_waits`, start a `LabelServer` on localhost in a background thread,
+    and run `load_test` against it.  If the server fails, e.g. because `port` is taken,
+    its error is raised, and if it isn't listening after `timeout` seconds, a `TimeoutError`.
+
+    Returns:
+        results (list): For each of `max_waits`, the client-side stats from `load_test`,
+            and 'requests_per_batch' from the server.
+    '''
+    results = []
+    for max_wait in max_waits:
+        server = LabelServer(models, knowledge_bank=knowledge_bank,
+                             max_batch_size=max_batch_size, max_wait=max_wait)
+        loop, ready, failures = asyncio.new_event_loop(), threading.Event(), []
+        serving = loop.create_task(server.serve(port=port, ready=ready))
+        thread = threading.Thread(target=_run_until_cancelled, args=(loop, serving, ready, failures),
+                                  daemon=True)
+        thread.start()
+        try:
+            if not ready.wait(timeout):
+                raise TimeoutError(f'Server not listening on port {port} after {timeout} s.')
+            if failures:
+                raise failures[0]
+            stats = _run(load_test(papers, port=port, num_requests=num_requests,
+                                   concurrency=concurrency))
+        finally:
+            loop.call_soon_threadsafe(serving.cancel)
+            thread.join(timeout)
+            if not thread.is_alive():
+                loop.close()
+        if failures:
+            raise failures[0]
+        stats.update(max_wait=max_wait, requests_per_batch=server.stats.summary()['requests_per_batch'])
+        print(', '.join(f'{k}: {v:.3g}' if v is not None else f'{k}: -' for k, v in stats.items()))
+        results.append(stats)
+    return results
\ No newline at end of file
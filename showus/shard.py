@@ -0,0 +1,279 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/shard.ipynb (unless otherwise specified).
+
+__all__ = ['write_job', 'run_shard', 'worker_command', 'map_shards', 'merge_shards', 'reduce_shards', 'run_sharded']
+
+# Cell
+import os, sys, time
+import json
+import pickle
+import shutil
+import subprocess
+import collections
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from datasets import load_metric
+from .showus import *
+from .fuzzy import knowledge_bank_matcher
+from .pipeline import hash_args, file_digest, papers_digest, checkpoint_digest, predict_tags, combine_ensemble_labels
+from .instrument import span, spanned, count, log
+
+# Cell
+def _shard_name(shard):
+    return f'{shard:05d}'
+
+
+def _result_path(shared_dir, shard):
+    return Path(shared_dir)/'results'/f'{_shard_name(shard)}.pkl'
+
+
+def _absolute(pth):
+    '''
+    `pth` made absolute if it's a local path, so that workers can run in directories of their own.
+    Model checkpoints can also be names on the model hub, which are left as they are.
+    '''
+    return str(Path(pth).resolve()) if pth is not None and Path(pth).exists() else pth
+
+
+def write_job(shared_dir, dir_json, paper_ids, num_shards, model_checkpoints=(), pth_knowledge_bank=None,
+              metric='seqeval', max_similarity=0.75, model_cache_dir=None, fuzzy_threshold=None, **kwargs):
+    '''
+    Split `paper_ids` into `num_shards` shards, of consecutive papers, and write the job to
+    `shared_dir`.  If `shared_dir` already holds a different job, its results are removed.
+    Jobs differ if their parameters do, or the content of their papers, models or knowledge bank.
+
+    Args:
+        metric (str): Name of the metric, which each worker loads with `load_metric`.
+        kwargs: Passed to `get_ner_inference_data` and `predict_tags`, like those of `build_pipeline`.
+
+    Returns:
+        job (dict): The job written to 'job.json'.
+    '''
+    shared_dir = Path(shared_dir)
+    shards = [list(ids) for ids in np.array_split(np.asarray(paper_ids, dtype=object), num_shards)]
+    job = {'dir_json': _absolute(dir_json), 'shards': shards,
+           'model_checkpoints': [_absolute(ckpt) for ckpt in model_checkpoints],
+           'pth_knowledge_bank': _absolute(pth_knowledge_bank), 'fuzzy_threshold': fuzzy_threshold,
+           'metric': metric,
+           'max_similarity': max_similarity, 'model_cache_dir': _absolute(model_cache_dir), 'params': kwargs}
+    job['digests'] = {'papers': papers_digest(dir_json, paper_ids),
+                      'model_checkpoints': [checkpoint_digest(ckpt) for ckpt in model_checkpoints],
+                      'knowledge_bank': None if pth_knowledge_bank is None else file_digest(pth_knowledge_bank)}
+    job['key'] = hash_args(job)
+
+    pth_job = shared_dir/'job.json'
+    if pth_job.exists() and json.load(open(pth_job, mode='r'))['key'] != job['key']:
+        log('Removing the results of a different job.')
+        shutil.rmtree(shared_dir/'results', ignore_errors=True)
+        shutil.rmtree(shared_dir/'work', ignore_errors=True)
+    (shared_dir/'results').mkdir(parents=True, exist_ok=True)
+    with open(pth_job.with_suffix('.tmp'), mode='w') as f:
+        json.dump(job, f)
+    os.replace(pth_job.with_suffix('.tmp'), pth_job)
+    return job
+
+# Cell
+_SENTENCE_PARAMS = ['mark_title', 'mark_text', 'sentence_definition', 'max_length', 'overlap',
+                    'min_length', 'contains_keywords', 'section_policy']
+
+
+@spanned()
+def run_shard(shared_dir, shard, attempt=1):
+    '''
+    Worker: predict the labels of the papers in shard `shard` of the job in `shared_dir`,
+    and write them to its result file.  This is what the command line from
+    `worker_command` runs.  It changes the current directory while it runs, so it must
+    run in a process of its own, never in the one running `map_shards`.
+    '''
+    shared_dir = Path(shared_dir).resolve()
+    job = json.load(open(shared_dir/'job.json', mode='r'))
+    paper_ids = job['shards'][shard]
+    params = job['params']
+    sentence_params = {k: v for k, v in params.items() if k in _SENTENCE_PARAMS}
+    predict_params = {k: v for k, v in params.items() if k not in _SENTENCE_PARAMS}
+
+    work_dir = shared_dir/'work'/f'{_shard_name(shard)}-{attempt}'
+    work_dir.mkdir(parents=True, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(work_dir)  # `batched_ner_predict` and `Trainer` write to the current directory.
+    try:
+        result = {'paper_ids': paper_ids, 'model_labels': []}
+        test_rows, paper_length = get_ner_inference_data(job['dir_json'], pd.DataFrame({'Id': paper_ids}),
+                                                         **sentence_params)
+        write_ner_json(test_rows, pth='sentences.json')
+        metric = load_metric(job['metric']) if job['model_checkpoints'] else None
+        for model_checkpoint in job['model_checkpoints']:
+            predictions = predict_tags('sentences.json', model_checkpoint=model_checkpoint, metric=metric,
+                                       model_cache_dir=job['model_cache_dir'], **predict_params)
+            result['model_labels'].append(get_paper_dataset_labels('sentences.json', paper_length, predictions))
+    finally:
+        os.chdir(cwd)
+
+    if job['pth_knowledge_bank'] is not None:
+        match = knowledge_bank_matcher(load_knowledge_bank(job['pth_knowledge_bank']),
+                                       fuzzy_threshold=job['fuzzy_threshold'])
+        result['literal_match'] = [match(paper) for _, paper in iter_papers(job['dir_json'], paper_ids)]
+    else:
+        result['literal_match'] = [set() for _ in paper_ids]
+
+    pth_result = _result_path(shared_dir, shard)
+    pth_tmp = pth_result.with_name(f'{pth_result.stem}-{attempt}.tmp')
+    with open(pth_tmp, mode='wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(pth_tmp, pth_result)
+    count('papers', len(paper_ids))
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def worker_command(shared_dir, shard, attempt=1):
+    '''
+    Command line running `run_shard` in a new python process.
+    '''
+    code = 'import sys; from showus.shard import run_shard; run_shard(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))'
+    return [sys.executable, '-c', code, str(Path(shared_dir).resolve()), str(shard), str(attempt)]
+
+# Cell
+def map_shards(shared_dir, num_workers=2, launcher=subprocess.Popen, max_attempts=3, timeout=None,
+               backup_factor=2., poll_interval=1.):
+    '''
+    Run a worker for each shard of the job in `shared_dir` that isn't done yet, with
+    retries of failed shards, and backup copies of stragglers.
+
+    Args:
+        num_workers (int): Maximum number of workers running at the same time.
+        launcher (callable): Starts a worker, given its command line, from `worker_command`,
+            and returns a handle with `poll`, `kill` and `wait`, like `subprocess.Popen`.
+        max_attempts (int): Maximum number of workers started for each shard, including backups.
+        timeout (None, float): Workers running longer than this many seconds are killed, and retried.
+        backup_factor (None, float): Start a backup copy of a shard running longer than this
+            many times the median time of the shards done.  If None, there are no backups.
+        poll_interval (float): Seconds between checks on the workers.
+
+    Returns:
+        stats (dict): Number of shards 'done', of 'retries', and of 'backups' started.
+    '''
+    job = json.load(open(Path(shared_dir)/'job.json', mode='r'))
+    num_shards = len(job['shards'])
+    done = {shard for shard in range(num_shards) if _result_path(shared_dir, shard).exists()}
+    if done:
+        log(f'{len(done)} of {num_shards} shards already done.')
+    pending = collections.deque(shard for shard in range(num_shards) if shard not in done)
+    attempts, running, durations, backed_up = collections.Counter(), {}, [], set()
+    stats = {'done': 0, 'retries': 0, 'backups': 0}
+
+    def launch(shard):
+        attempts[shard] += 1
+        running[shard, attempts[shard]] = (launcher(worker_command(shared_dir, shard, attempts[shard])),
+                                           time.monotonic())
+
+    try:
+        while pending or running:
+            for (shard, attempt), (worker, t0) in list(running.items()):
+                if shard in done:  # Another copy finished first.
+                    worker.kill()
+                    worker.wait()
+                    del running[shard, attempt]
+                    continue
+                returncode = worker.poll()
+                if returncode is None:
+                    if timeout is None or time.monotonic() - t0 < timeout:
+                        continue
+                    log(f'Shard {shard}, attempt {attempt}: timed out.')
+                    worker.kill()
+                    worker.wait()
+                del running[shard, attempt]
+                if _result_path(shared_dir, shard).exists():
+                    done.add(shard)
+                    durations.append(time.monotonic() - t0)
+                    stats['done'] += 1
+                    count('shards_done')
+                elif any(s == shard for s, _ in running):
+                    continue  # A backup copy is still running.
+                elif attempts[shard] >= max_attempts:
+                    raise RuntimeError(f'Shard {shard} failed {attempts[shard]} times.')
+                else:
+                    log(f'Shard {shard}, attempt {attempt}: failed, with return code {returncode}; retrying.')
+                    pending.append(shard)
+                    stats['retries'] += 1
+                    count('shard_retries')
+
+            if not pending and backup_factor is not None and durations:
+                limit = backup_factor * float(np.median(durations))
+                for (shard, attempt), (_, t0) in list(running.items()):
+                    if (shard not in backed_up and attempts[shard] < max_attempts
+                            and time.monotonic() - t0 > limit and len(running) < num_workers):
+                        log(f'Shard {shard}: running for over {limit:.1f}s; starting a backup.')
+                        backed_up.add(shard)
+                        launch(shard)
+                        stats['backups'] += 1
+                        count('shard_backups')
+
+            while pending and len(running) < num_workers:
+                launch(pending.popleft())
+            time.sleep(poll_interval)
+    finally:
+        for worker, _ in running.values():
+            worker.kill()
+            worker.wait()
+
+    log(f"{stats['done']} shards done, with {stats['retries']} retries and {stats['backups']} backups.")
+    return stats
+
+
+def merge_shards(shared_dir):
+    '''
+    Merge the results of the shards of the job in `shared_dir`, in the order of the papers.
+
+    Returns:
+        literal_preds (list): For each paper, the set of labels from `literal_match`.
+        model_preds (list): For each model, for each paper, the set of labels from
+            `get_paper_dataset_labels`.
+    '''
+    job = json.load(open(Path(shared_dir)/'job.json', mode='r'))
+    literal_preds, model_preds = [], [[] for _ in job['model_checkpoints']]
+    for shard in range(len(job['shards'])):
+        with open(_result_path(shared_dir, shard), mode='rb') as f:
+            result = pickle.load(f)
+        literal_preds.extend(result['literal_match'])
+        for preds, labels in zip(model_preds, result['model_labels']):
+            preds.extend(labels)
+    return literal_preds, model_preds
+
+
+def reduce_shards(shared_dir, num_workers=1):
+    '''
+    Merge the results of the shards of the job in `shared_dir`, and filter them.
+
+    Args:
+        num_workers (int): Passed to `filter_dataset_labels`.
+
+    Returns:
+        filtered_dataset_labels (list): Labels for each paper of the job, in order,
+            seperated by '|'.
+    '''
+    max_similarity = json.load(open(Path(shared_dir)/'job.json', mode='r'))['max_similarity']
+    literal_preds, model_preds = merge_shards(shared_dir)
+    # Sorted, as the order of a set of strings differs between processes, and
+    # `filter_dataset_labels` keeps the first of labels that are too similar.
+    labels = combine_ensemble_labels(*([sorted(labels) for labels in preds]
+                                       for preds in [literal_preds] + model_preds))
+    return filter_dataset_labels(labels, max_similarity=max_similarity, num_workers=num_workers)
+
+# Cell
+def run_sharded(dir_json, pth_sample_submission, pth_submission='submission.csv', shared_dir='showus_shards',
+                num_shards=8, num_workers=2, launcher=subprocess.Popen, max_attempts=3, timeout=None,
+                backup_factor=2., poll_interval=1., **kwargs):
+    '''
+    Like `run_pipeline`, with the papers split into `num_shards` shards, which are predicted
+    on by workers started with `launcher`.  `kwargs` are passed to `write_job`, and the
+    other arguments to `map_shards`.
+    '''
+    sample_submission = pd.read_csv(pth_sample_submission)
+    write_job(shared_dir, dir_json, list(sample_submission['Id']), num_shards, **kwargs)
+    with span('map_shards'):
+        map_shards(shared_dir, num_workers=num_workers, launcher=launcher, max_attempts=max_attempts,
+                   timeout=timeout, backup_factor=backup_factor, poll_interval=poll_interval)
+    with span('reduce_shards'):
+        sample_submission['PredictionString'] = reduce_shards(shared_dir)
+    sample_submission.to_csv(pth_submission, index=False)
+    return sample_submission
\ No newline at end of file
@@ -1,21 +1,30 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/showus.ipynb (unless otherwise specified).
 
-__all__ = ['load_train_meta', 'load_papers', 'AAAsTITLE', 'ZZZsTITLE', 'AAAsTEXT', 'ZZZsTEXT', 'load_section',
-           'load_paper', 'text2words', 'clean_training_text', 'extract_sentences', 'shorten_sentences', 'find_sublist',
-           'get_ner_classlabel', 'tag_sentence', 'get_paper_ner_data', 'get_ner_data', 'write_ner_json',
-           'load_ner_datasets', 'batched_write_ner_json', 'create_tokenizer', 'tokenize_and_align_labels',
-           'remove_nonoriginal_outputs', 'jaccard_similarity', 'compute_metrics', 'get_ner_inference_data',
-           'batched_write_ner_inference_json', 'ner_predict', 'batched_ner_predict', 'get_paper_dataset_labels',
-           'create_knowledge_bank', 'literal_match', 'combine_matching_and_model', 'filter_dataset_labels']
+__all__ = ['load_train_meta', 'load_papers', 'iter_papers', 'AAAsTITLE', 'ZZZsTITLE', 'AAAsTEXT', 'ZZZsTEXT',
+           'load_section', 'load_paper', 'text2words', 'clean_training_text', 'PaperText', 'paper_text',
+           'extract_sentences', 'section_stats', 'classify_section', 'prune_sections', 'SECTION_KINDS',
+           'DEFAULT_SECTION_POLICY', 'section_pruning_report', 'shorten_sentences', 'find_sublist',
+           'get_ner_classlabel', 'tag_sentence', 'get_paper_ner_data', 'SentenceDeduplicator', 'get_ner_data',
+           'write_ner_json', 'load_ner_datasets', 'AdaptiveBatchSize', 'batched_write_ner_json', 'create_tokenizer',
+           'tokenize_and_align_labels', 'remove_nonoriginal_outputs', 'jaccard_similarity', 'compute_metrics',
+           'train_ner', 'get_paper_inference_sentences', 'get_ner_inference_data', 'batched_write_ner_inference_json',
+           'ner_predict', 'StoredPredictions', 'batched_ner_predict', 'tokenize_sentences', 'predict_probs',
+           'get_word_probs', 'batched_word_probs', 'get_sentence_dataset_labels', 'get_paper_dataset_labels',
+           'create_knowledge_bank', 'literal_match', 'KnowledgeBank', 'load_knowledge_bank',
+           'combine_matching_and_model', 'filter_dataset_labels']
 
 # Cell
 import os, sys, shutil, time
-from tqdm import tqdm
 from pathlib import Path
 import itertools
+import collections
+import hashlib
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from functools import partial
 import re
 import json
+import pickle
 import random
 import numpy as np
 import pandas as pd
@@ -26,6 +35,11 @@ import transformers, seqeval
 from transformers import AutoTokenizer, DataCollatorForTokenClassification
 from transformers import AutoModelForTokenClassification
 from transformers import TrainingArguments, Trainer
+from .instrument import span, spanned, count, count_padding, log, current_rss_mb
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 import matplotlib.pyplot as plt
 from IPython.display import display
@@ -76,6 +90,49 @@ def load_papers(dir_json, paper_ids):
             papers[paper_id] = paper
     return papers
 
+# Cell
+def _read_paper(pth):
+    with open(pth, 'r') as f:
+        return json.load(f)
+
+
+def iter_papers(dir_json, paper_ids, num_workers=8, prefetch=32):
+    '''
+    Read papers ahead of the consumer, with a pool of threads, so that processing
+    of the first papers can start while later ones are still being read.
+
+    Args:
+        dir_json (str, Path): Path to the directory in which each
+            json file contains the text for a paper.
+        paper_ids (iter): IDs of the papers to load.
+        num_workers (int): Number of threads reading papers.
+        prefetch (int): Maximum number of papers read ahead of the consumer.
+
+    Yields:
+        paper_id (str): ID of the paper.
+        paper (list): The sections in the paper.  Papers are yielded in the
+            order of `paper_ids`.
+    '''
+    paper_ids = iter(paper_ids)
+    pending = collections.deque()
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    def submit(n):
+        for paper_id in itertools.islice(paper_ids, n):
+            pending.append((paper_id, executor.submit(_read_paper, f'{dir_json}/{paper_id}.json')))
+
+    try:
+        submit(prefetch)
+        while pending:
+            paper_id, future = pending.popleft()
+            paper = future.result()
+            submit(1)
+            yield paper_id, paper
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
 # Cell
 
 # Special tokens
@@ -154,6 +211,103 @@ def clean_training_text(txt, lower=False, total_clean=False):
         txt = re.sub(' +', ' ', txt)
     return txt
 
+# Cell
+class PaperText:
+    '''
+    A paper, with its text in the forms that matching and extracting sentences use,
+    each worked out the first time it's needed, and kept for the stages after.
+    It can be passed in place of the paper to any function taking one.
+
+    Args:
+        paper (list): Each element is a dict of form {'section_title': "...", 'text': "..."}.
+
+    Attributes:
+        raw (str): Text of the sections, joined by '. '.
+        lower (str): `raw`, lowercased.
+        cleaned (str): `lower`, cleaned like `clean_training_text(lower=True, total_clean=True)`.
+        offsets (np.ndarray): Index in `raw` of each character in `cleaned`.  A space
+            standing for characters removed points to the first of them.
+    '''
+    def __init__(self, paper):
+        self.paper = paper
+        self._cache = {}
+
+    def __iter__(self):
+        return iter(self.paper)
+
+    def __len__(self):
+        return len(self.paper)
+
+    def __getitem__(self, i):
+        return self.paper[i]
+
+    def _get(self, key, fn):
+        if key not in self._cache:
+            self._cache[key] = fn()
+        return self._cache[key]
+
+    @property
+    def raw(self):
+        return self._get('raw', lambda: '. '.join(section['text'] for section in self.paper))
+
+    @property
+    def lower(self):
+        return self._get('lower', lambda: self.raw.lower())
+
+    @property
+    def cleaned(self):
+        if 'cleaned' not in self._cache:
+            self._clean()
+        return self._cache['cleaned']
+
+    @property
+    def offsets(self):
+        if 'offsets' not in self._cache:
+            self._clean()
+        return self._cache['offsets']
+
+    def _clean(self):
+        raw, lower = self.raw, self.lower
+        spans = np.array([m.span() for m in re.finditer('[A-Za-z0-9]+', lower)], dtype=np.int64).reshape(-1, 2)
+        self._cache['cleaned'] = ' '.join(lower[start:stop] for start, stop in spans.tolist())
+
+        # Each word, and the character after it, which the space joining it to the next stands for.
+        lengths = spans[:, 1] - spans[:, 0] + 1
+        ends = np.cumsum(lengths)
+        offsets = np.arange(ends[-1] if len(ends) else 0) + np.repeat(spans[:, 0] - (ends - lengths), lengths)
+        offsets = offsets[:-1]
+        if len(lower) != len(raw):  # Some characters are more than one once lowercased.
+            offsets = np.repeat(np.arange(len(raw)), [len(c.lower()) for c in raw])[offsets]
+        self._cache['offsets'] = offsets.astype(np.int32)
+
+    def raw_span(self, start, stop):
+        '''
+        Span of `raw` that `cleaned[start:stop]` comes from.
+        '''
+        return int(self.offsets[start]), int(self.offsets[stop - 1]) + 1
+
+    def sentences(self, sentence_definition='sentence', mark_title=False, mark_text=False):
+        '''
+        Sentences, as `extract_sentences` returns them.
+        '''
+        def extract():
+            if sentence_definition == 'sentence':
+                return [sentence for s in self.paper
+                        for sentence in s['text'].split('.') if s['text']]
+            elif sentence_definition == 'section':
+                return [load_section(s, mark_title=mark_title, mark_text=mark_text)
+                        for s in self.paper if s['section_title'] or s['text']]
+            elif sentence_definition == 'paper':
+                return [load_paper(self.paper, mark_title=mark_title, mark_text=mark_text)]
+        return self._get(('sentences', sentence_definition, mark_title, mark_text), extract)
+
+
+def paper_text(paper):
+    '''
+    `paper` as a `PaperText`, unless it already is one.
+    '''
+    return paper if isinstance(paper, PaperText) else PaperText(paper)
+
 # Cell
 
 def extract_sentences(paper, sentence_definition='sentence',
@@ -162,18 +316,177 @@ def extract_sentences(paper, sentence_definition='sentence',
     Returns:
         sentences (list): List of sentences.  Each sentence is a string.
     '''
-    if sentence_definition == 'sentence':
-        sentences = [sentence for s in paper
-                     for sentence in s['text'].split('.') if s['text']]
+    return list(paper_text(paper).sentences(sentence_definition, mark_title, mark_text))
 
-    elif sentence_definition == 'section':
-        sentences = [load_section(s, mark_title=mark_title, mark_text=mark_text)
-                     for s in paper if s['section_title'] or s['text']]
+# Cell
+SECTION_KINDS = ['body', 'references', 'acknowledgements', 'affiliations', 'table']
+
+DEFAULT_SECTION_POLICY = {'references': 'skip', 'affiliations': 'skip', 'table': 'truncate'}
+
+def _title_pattern(*phrases):
+    # Whole titles made of `phrases`, joined by 'and', '&' or commas, and optionally numbered,
+    # so that e.g. 'Reference standard' or 'Multiple correspondence analysis' don't match.
+    phrase = '(?:' + '|'.join(phrases) + ')'
+    return re.compile(rf'^\s*(?:(?:\d+(?:\.\d+)*|[ivx]+)\.?\s+)?{phrase}(?:\s*(?:,|and|&)\s*{phrase})*'
+                      r'(?:\s+(?:statements?|information|sources?))?[\s.:]*$', re.I)
+
+
+_SECTION_TITLES = [
+    ('references', _title_pattern(r'references?', 'bibliography', 'literature cited', 'works cited',
+                                  'cited literature', r'references? and notes')),
+    ('acknowledgements', _title_pattern(r'acknowledge?ments?', 'funding', 'financial support',
+                                        r'conflicts? of interests?', r'competing interests?',
+                                        r'declarations? of (?:competing|conflicting) interests?',
+                                        r'disclosures?', r"authors?'? contributions?")),
+    ('affiliations', _title_pattern(r"(?:authors?'? )?affiliations?", 'author information',
+                                    r'about the authors?', 'correspondence', r'address(?:es)? for correspondence',
+                                    r'corresponding authors?')),
+    ('table', re.compile(r'^\s*(supplementary\s+)?(table|tab\.)(\s|\d|$)', re.I))]
+
+_CITATION = re.compile(r'\([^()]{0,80}?\b(?:19|20)\d{2}[a-z]?\s*\)|\[\s*\d+(?:\s*[,–-]\s*\d+)*\s*\]'
+                       r'|\bet al\b|\bdoi\b', re.I)
+_YEAR = re.compile(r'\b(?:19|20)\d{2}[a-z]?\b')
+_AFFILIATION = re.compile(r'\b(?:university|department|institute|school|faculty|college|hospital|'
+                          r'centre|center|laboratory)\b', re.I)
+
+
+def section_stats(section):
+    '''
+    Statistics of the text of `section`, which set apart references, affiliations and tables.
 
-    elif sentence_definition == 'paper':
-        sentences = [load_paper(paper, mark_title=mark_title, mark_text=mark_text)]
+    Returns:
+        stats (dict): Number of 'words', per word, the number of 'citations', 'years' and
+            'affiliations' words, the 'digit_ratio' of the characters that aren't spaces,
+            and 'words_per_sentence', with sentences split at full stops.
+    '''
+    text = section['text'] or ''
+    words = text.split()
+    per_word = 1 / max(len(words), 1)
+    return {'words': len(words),
+            'citations': len(_CITATION.findall(text)) * per_word,
+            'years': len(_YEAR.findall(text)) * per_word,
+            'affiliations': len(_AFFILIATION.findall(text)) * per_word,
+            'digit_ratio': sum(map(str.isdigit, text)) / max(sum(map(len, words)), 1),
+            'words_per_sentence': len(words) / max(sum(1 for s in text.split('.') if s.strip()), 1)}
+
+
+def classify_section(section):
+    '''
+    Kind of `section`, one of `SECTION_KINDS`.
+    '''
+    title = section['section_title'] or ''
+    for kind, pattern in _SECTION_TITLES:
+        if pattern.search(title):
+            return kind
+
+    stats = section_stats(section)
+    if stats['words'] < 20:  # Too short to tell.
+        return 'body'
+    if stats['years'] >= 0.04 and stats['words_per_sentence'] < 12:
+        return 'references'
+    if stats['affiliations'] >= 0.08 and stats['words_per_sentence'] < 20:
+        return 'affiliations'
+    if stats['digit_ratio'] >= 0.25:
+        return 'table'
+    return 'body'
+
+
+def prune_sections(paper, policy=None, truncate_words=50):
+    '''
+    Skip or truncate the sections of `paper` that are unlikely to mention datasets.
 
-    return sentences
+    Args:
+        paper (list): Each element is a dict of form {'section_title': "...", 'text': "..."}.
+        policy (None, dict): What to do with each kind of section returned by `classify_section`:
+            'keep' it, 'skip' it, or 'truncate' its text to the first `truncate_words` words.
+            Kinds not in `policy` are kept.  If None, `DEFAULT_SECTION_POLICY` is used.
+
+    Returns:
+        paper (list): The sections kept.
+    '''
+    policy = DEFAULT_SECTION_POLICY if policy is None else policy
+    pruned = []
+    for section in paper:
+        action = policy.get(classify_section(section), 'keep')
+        if action == 'keep':
+            pruned.append(section)
+        elif action == 'truncate':
+            pruned.append({**section, 'text': ' '.join((section['text'] or '').split()[:truncate_words])})
+        elif action != 'skip':
+            raise ValueError(f"Section action should be 'keep', 'skip' or 'truncate', not {action!r}.")
+    return pruned
+
+# Cell
+def section_pruning_report(papers, train_meta, policy=None, truncate_words=50):
+    '''
+    How many words `prune_sections` removes from papers, against how many mentions
+    of their labelled datasets it removes with them.
+
+    Args:
+        papers (dict, str, Path): Each list in this dictionary consists of the section of a paper.
+            Or, the directory containing the papers' json files, which are then read ahead
+            with `iter_papers`.
+        train_meta (pd.DataFrame, str, Path): Meta data like 'train.csv', or a path to it.
+        policy, truncate_words: Passed to `prune_sections`.
+
+    Returns:
+        report (pd.DataFrame): For each kind of section, and in 'total', the 'action' taken, and
+            the number of 'sections', 'words', and 'mentions' of the papers' labels in them, and
+            how many of those are pruned.  'labels' is the number of papers' labels mentioned
+            in the sections, and 'labels_lost' those of them mentioned nowhere after pruning.
+    '''
+    policy = DEFAULT_SECTION_POLICY if policy is None else policy
+    df = load_train_meta(train_meta) if isinstance(train_meta, (str, Path)) else train_meta
+    if df['Id'].duplicated().any():
+        df = df.groupby('Id').agg({'dataset_label': '|'.join}).reset_index()
+    paper_labels = {paper_id: {clean_training_text(label, lower=True, total_clean=True)
+                               for label in dataset_label.split('|')}
+                    for paper_id, dataset_label in zip(df['Id'], df['dataset_label'])}
+
+    if isinstance(papers, (str, Path)):
+        paper_iter = iter_papers(papers, df['Id'])
+    else:
+        paper_iter = ((paper_id, papers[paper_id]) for paper_id in df['Id'])
+
+    columns = ['sections', 'words', 'words_pruned', 'mentions', 'mentions_pruned', 'labels', 'labels_lost']
+    report = {kind: dict.fromkeys(columns, 0) for kind in SECTION_KINDS}
+    total = dict.fromkeys(columns, 0)
+    for paper_id, paper in paper_iter:
+        labels = paper_labels[paper_id]
+        mentioned, kept = collections.defaultdict(set), set()
+        for section in paper:
+            kind = classify_section(section)
+            text = section['text'] or ''
+            pruned_text = ' '.join(s['text'] for s in prune_sections([section], policy, truncate_words))
+            cleaned = f" {clean_training_text(text, lower=True, total_clean=True)} "
+            cleaned_kept = f" {clean_training_text(pruned_text, lower=True, total_clean=True)} "
+
+            r = report[kind]
+            r['sections'] += 1
+            r['words'] += len(text.split())
+            r['words_pruned'] += len(text.split()) - len(pruned_text.split())
+            for label in labels:
+                n, n_kept = cleaned.count(f' {label} '), cleaned_kept.count(f' {label} ')
+                r['mentions'] += n
+                r['mentions_pruned'] += n - n_kept
+                if n:
+                    mentioned[label].add(kind)
+                if n_kept:
+                    kept.add(label)
+
+        for label, kinds in mentioned.items():
+            for kind in kinds:
+                report[kind]['labels'] += 1
+                report[kind]['labels_lost'] += label not in kept
+        total['labels'] += len(mentioned)
+        total['labels_lost'] += len(set(mentioned) - kept)
+
+    report = pd.DataFrame.from_dict(report, orient='index')
+    for column in columns[:5]:
+        total[column] = report[column].sum()
+    report.loc['total'] = total
+    report.insert(0, 'action', [policy.get(kind, 'keep') for kind in SECTION_KINDS] + [''])
+    return report
 
 # Cell
 
@@ -181,11 +494,15 @@ def shorten_sentences(sentences, max_length=64, overlap=20):
     '''
     Args:
         sentences (list): List of sentences. Each sentence is list of words.
-        max_length (int): Maximum number of words allowed for each sentence.
+        max_length (None, int): Maximum number of words allowed for each sentence.
+            If None, sentences are returned as they are.
         overlap (int): If a sentence exceeds `max_length`, we split it to multiple sentences with
             this amount of overlapping.
     '''
 
+    if max_length is None:
+        return sentences
+
     short_sentences = []
     for sentence in sentences:
         if len(sentence) > max_length:
@@ -244,7 +561,7 @@ def tag_sentence(sentence, labels, classlabel=None):
 def get_paper_ner_data(paper, labels, mark_title=False, mark_text=False,
                        pretokenizer=BertPreTokenizer(), classlabel=get_ner_classlabel(),
                        sentence_definition='sentence', max_length=64, overlap=20,
-                       neg_keywords=['data', 'study'], neg_sample_prob=None):
+                       neg_keywords=['data', 'study'], neg_sample_prob=None, rng=None):
     '''
     Get NER data for a single paper.
 
@@ -253,6 +570,8 @@ def get_paper_ner_data(paper, labels, mark_title=False, mark_text=False,
         labels (list): Each element is a string that is a dataset label.
         neg_keywords (None, iter): Keywords which a negative sample needs to have.
         neg_sample_prob (None, float): Probability with which to keep a negative sample.
+        rng (None, np.random.RandomState): Random numbers to sample negatives with.
+            If None, numpy's global random numbers are used.
 
     Returns:
         ner_data (list): Each element is a list of tuples of the form:
@@ -277,7 +596,7 @@ def get_paper_ner_data(paper, labels, mark_title=False, mark_text=False,
                 ner_data.append(tags)
                 cnt_neg += 1
         elif neg_sample_prob is not None:
-            if np.random.rand() < neg_sample_prob:
+            if (np.random if rng is None else rng).rand() < neg_sample_prob:
                 ner_data.append(tags)
                 cnt_neg += 1
         else:
@@ -287,17 +606,163 @@ def get_paper_ner_data(paper, labels, mark_title=False, mark_text=False,
     return cnt_pos, cnt_neg, ner_data
 
 # Cell
+class SentenceDeduplicator:
+    '''
+    Drop examples that are exact or near duplicates of ones kept before.
+
+    Args:
+        exact (None, str): Scope of exact duplicates: None, 'paper', or 'global'.
+        near (None, str): Scope of near duplicates: None, 'paper', or 'global'.
+        threshold (float): Smallest estimated Jaccard similarity of near duplicates.
+        num_perm (int): Number of permutations in the MinHash signatures.
+        bands (int): Number of bands the signatures are split into.  More find
+            near duplicates of lower similarity, at the cost of more comparisons.
+        shingle_size (int): Number of consecutive words in each shingle.
+
+    Attributes:
+        counts (collections.Counter): Number of examples that the examples kept stand
+            for, by the key from `example_key`.  With duplicates scoped to papers, the same
+            example can be kept in several papers, and these then share the count.
+    '''
+    _prime = (1 << 61) - 1
+
+    def __init__(self, exact='global', near='paper', threshold=0.8, num_perm=64, bands=16,
+                 shingle_size=3, seed=0):
+        assert exact in (None, 'paper', 'global') and near in (None, 'paper', 'global')
+        assert num_perm % bands == 0, 'num_perm should be a multiple of bands.'
+        self.exact, self.near, self.threshold = exact, near, threshold
+        self.bands, self.shingle_size = bands, shingle_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+        self.counts, self._kept = collections.Counter(), collections.Counter()
+        self.stats = collections.Counter()
+        self._keys, self._buckets, self._signatures = set(), {}, []
+        self._paper_keys, self._paper_buckets, self._paper_signatures = set(), {}, []
+
+    @staticmethod
+    def example_key(row):
+        '''
+        Hash of the words and tags of an example, like those from `get_paper_ner_data`.
+        '''
+        words, tags = zip(*row) if row else ((), ())
+        h = hashlib.blake2b('\x00'.join(words).encode('utf-8'), digest_size=8)
+        h.update(bytes(tag % 256 for tag in tags))
+        return int.from_bytes(h.digest(), 'little')
+
+    def _signature(self, row):
+        # Stable hashes of the (word, tag) pairs, combined into a hash of each shingle of them.
+        pairs = np.fromiter((zlib.crc32(f'{word}\x00{tag}'.encode('utf-8')) for word, tag in row),
+                            dtype=np.uint64, count=len(row))
+        n = max(len(row) - self.shingle_size + 1, 1)
+        shingles = np.zeros(n, dtype=np.uint64)
+        for j in range(min(self.shingle_size, len(row))):
+            shingles = (shingles * np.uint64(1_000_003) + pairs[j:j + n]) & np.uint64(0xFFFFFFFF)
+        # Universal hashing of each shingle, for each permutation, then the smallest for each.
+        return (((shingles[:, None] * self._a + self._b) % self._prime) & 0xFFFFFFFF).min(axis=0).astype(np.uint32)
+
+    def _near_duplicate(self, signature, buckets, signatures, i_new):
+        rows = len(signature) // self.bands
+        bucket_keys = [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(self.bands)]
+        original = None
+        for key in bucket_keys:
+            i = buckets.get(key)
+            if i is not None and (signatures[i][1] == signature).mean() >= self.threshold:
+                original = signatures[i][0]
+                break
+        if original is None:
+            for key in bucket_keys:
+                buckets.setdefault(key, i_new)
+        return original
+
+    def start_paper(self):
+        '''
+        Forget the examples of the previous paper, for the duplicates scoped to papers.
+        '''
+        self._paper_keys, self._paper_buckets, self._paper_signatures = set(), {}, []
+
+    def add(self, row):
+        '''
+        Returns:
+            kept (bool): Whether `row` is kept, i.e. isn't a duplicate of an example kept before.
+        '''
+        key = self.example_key(row)
+        self.stats['examples'] += 1
+        if self.exact is not None:
+            keys = self._keys if self.exact == 'global' else self._paper_keys
+            if key in keys:
+                self.counts[key] += 1
+                self.stats['exact_duplicates'] += 1
+                return False
+
+        if self.near is not None:
+            buckets, signatures = ((self._buckets, self._signatures) if self.near == 'global' else
+                                   (self._paper_buckets, self._paper_signatures))
+            signature = self._signature(row)
+            original = self._near_duplicate(signature, buckets, signatures, len(signatures))
+            if original is not None:
+                self.counts[original] += 1
+                self.stats['near_duplicates'] += 1
+                return False
+            signatures.append((key, signature))
+
+        if self.exact is not None:
+            keys.add(key)
+        self.counts[key] += 1
+        self._kept[key] += 1
+        return True
+
+    def dedup_paper(self, rows):
+        '''
+        Examples of a paper that are kept, in order.
+        '''
+        self.start_paper()
+        kept = [row for row in rows if self.add(row)]
+        count('duplicates', len(rows) - len(kept))
+        return kept
+
+    def weight(self, row):
+        '''
+        Number of examples that `row`, an example kept, stands for, on average
+        over the papers it's kept in.  The weights of all examples kept add up
+        to the number of examples seen.
+        '''
+        key = self.example_key(row)
+        if key not in self._kept:
+            return 1
+        weight = self.counts[key] / self._kept[key]
+        return int(weight) if weight.is_integer() else weight
+
+    def write_counts(self, pth):
+        '''
+        Add to each example in json file `pth`, as written by `write_ner_json`,
+        the number of examples it stands for, as 'count'.
+        '''
+        pth = Path(pth)
+        pth_tmp = pth.with_name(pth.name + '.tmp')
+        with open(pth, mode='r') as f, open(pth_tmp, mode='w') as f_out:
+            for line in f:
+                example = json.loads(line)
+                example['count'] = self.weight(list(zip(example['tokens'], example['ner_tags'])))
+                f_out.write(json.dumps(example) + '\n')
+        os.replace(pth_tmp, pth)
+
+# Cell
+@spanned()
 def get_ner_data(papers, df=None, mark_title=False, mark_text=False,
                  classlabel=None, pretokenizer=BertPreTokenizer(),
                  sentence_definition='sentence', max_length=64, overlap=20,
                  neg_keywords=['study', 'data'], neg_sample_prob=None,
-                 shuffle=True):
+                 shuffle=True, deduplicator=None):
     '''
     Get NER data for a list of papers.
 
     Args:
-        papers (dict): Like that returned by `load_papers`.
+        papers (dict, str, Path): Like that returned by `load_papers`, or the directory
+            containing the papers' json files, which are then read ahead with `iter_papers`.
         df (pd.DataFrame): Competition's train.csv or a subset of it.
+        deduplicator (SentenceDeduplicator, None): If given, duplicate samples are dropped,
+            and counted by it.
     Returns:
         cnt_pos (int): Number of samples (or 'sentences') that are tagged or partly
             tagged as datasets.
@@ -309,10 +774,12 @@ def get_ner_data(papers, df=None, mark_title=False, mark_text=False,
     cnt_pos, cnt_neg = 0, 0
     ner_data = []
 
-    tqdm._instances.clear()
-    pbar = tqdm(total=len(df))
-    for i, id, dataset_label in df[['Id', 'dataset_label']].itertuples():
-        paper = papers[id]
+    if isinstance(papers, (str, Path)):
+        paper_iter = iter_papers(papers, df['Id'])
+    else:
+        paper_iter = ((id, papers[id]) for id in df['Id'])
+
+    for (id, paper), dataset_label in zip(paper_iter, df['dataset_label']):
         labels = dataset_label.split('|')
 
         cnt_pos_, cnt_neg_, ner_data_ = get_paper_ner_data(
@@ -320,13 +787,20 @@ def get_ner_data(papers, df=None, mark_title=False, mark_text=False,
             classlabel=classlabel, pretokenizer=pretokenizer,
             sentence_definition=sentence_definition, max_length=max_length, overlap=overlap,
             neg_keywords=neg_keywords, neg_sample_prob=neg_sample_prob)
+        if deduplicator is not None:
+            ner_data_ = deduplicator.dedup_paper(ner_data_)
+            o = classlabel.str2int('O')
+            cnt_pos_ = sum(any(tag != o for _, tag in row) for row in ner_data_)
+            cnt_neg_ = len(ner_data_) - cnt_pos_
         cnt_pos += cnt_pos_
         cnt_neg += cnt_neg_
         ner_data.extend(ner_data_)
 
-        pbar.update(1)
-        pbar.set_description(f"Training data size: {cnt_pos} positives + {cnt_neg} negatives")
+        count('papers')
+        count('sentences', len(ner_data_))
+        count('words', sum(len(row) for row in ner_data_))
 
+    log(f'Training data size: {cnt_pos} positives + {cnt_neg} negatives')
     if shuffle:
         random.shuffle(ner_data)
     return cnt_pos, cnt_neg, ner_data
@@ -355,25 +829,107 @@ def load_ner_datasets(data_files=None):
         dataset.features['ner_tags'].feature = classlabel
     return datasets
 
+# Cell
+class AdaptiveBatchSize:
+    '''
+    Batch size that is adjusted between batches, to keep the resident memory of the
+    process within `memory_budget` MB.
+
+    After each batch, while its data is still held, the memory taken per item is estimated
+    from how much resident memory has grown since the first batch started.  The next batch
+    is then as large as fits in `headroom` of what the budget leaves, but at most `max_growth`
+    times as large as the last one, and at most half of it if the budget is already exceeded.
+    Without a `memory_budget`, the batch size stays at `batch_size`.
+
+    Usage:
+        sizer = AdaptiveBatchSize(1_000, memory_budget=4_000)
+        for start, stop in sizer.slices(len(df)):
+            data = process(df.iloc[start:stop])
+            sizer.update(stop - start)
+    '''
+    def __init__(self, batch_size, memory_budget=None, min_size=1, max_size=None,
+                 headroom=0.8, max_growth=2.):
+        self.size = batch_size
+        self.memory_budget, self.min_size, self.max_size = memory_budget, min_size, max_size
+        self.headroom, self.max_growth = headroom, max_growth
+        self.item_mb, self.baseline_mb, self.high_water_mb = None, None, None
+
+    def start(self):
+        '''
+        Record the resident memory before the first batch.
+        '''
+        if self.memory_budget is not None and self.baseline_mb is None:
+            self.baseline_mb = self.high_water_mb = current_rss_mb()
+
+    def slices(self, n):
+        '''
+        Yield (start, stop) of each batch of `n` items, each as large as the current batch size.
+        '''
+        self.start()
+        start = 0
+        while start < n:
+            stop = min(start + self.size, n)
+            yield start, stop
+            start = stop
+
+    def update(self, num_items):
+        '''
+        Set the size of the next batch, after a batch of `num_items` is done.
+        '''
+        if self.memory_budget is None or num_items == 0:
+            return self.size
+        self.start()
+        rss = current_rss_mb()
+        if rss > self.high_water_mb:  # Otherwise the batch fit in memory the process already had.
+            self.item_mb = (rss - self.baseline_mb) / num_items
+            self.high_water_mb = rss
+
+        size = int(self.max_growth * self.size)
+        if self.item_mb:
+            size = min(size, int(self.headroom * (self.memory_budget - self.baseline_mb) / self.item_mb))
+        if rss > self.memory_budget:
+            size = min(size, self.size // 2)
+        if self.max_size is not None:
+            size = min(size, self.max_size)
+        size = max(size, self.min_size)
+
+        if size != self.size:
+            log(f'Batch size {self.size} -> {size}: resident memory {rss:.0f} MB of '
+                f'{self.memory_budget:.0f} MB budget, {self.item_mb or 0:.4f} MB per item.')
+            count('batch_size_changes')
+        self.size = size
+        return size
+
 # Cell
 
 def batched_write_ner_json(papers, df, pth=Path('train_ner.json'), batch_size=4_000,
                            mark_title=False, mark_text=False,
                            classlabel=get_ner_classlabel(), pretokenizer=BertPreTokenizer(),
                            sentence_definition='sentence', max_length=64, overlap=20,
-                           neg_keywords=['study', 'data'], neg_sample_prob=None):
-
-    for i in range(0, len(df), batch_size):
-        print(f'Batch {i // batch_size}...', end='')
-        t0 = time.time()
-        cnt_pos, cnt_neg, ner_data = get_ner_data(
-            papers, df.iloc[i:i+batch_size],
-            mark_title=mark_title, mark_text=mark_text,
-            classlabel=classlabel, pretokenizer=pretokenizer,
-            sentence_definition=sentence_definition, max_length=max_length, overlap=overlap,
-            neg_keywords=neg_keywords, neg_sample_prob=neg_sample_prob)
-        write_ner_json(ner_data, pth=pth, mode='w' if i == 0 else 'a')
-        print(f'done in {(time.time() - t0) / 60} mins.')
+                           neg_keywords=['study', 'data'], neg_sample_prob=None,
+                           memory_budget=None, deduplicator=None):
+    '''
+    `batch_size` papers are processed at a time.  If `memory_budget` (MB) is given,
+    `batch_size` is just the first batch's size, and is adjusted with `AdaptiveBatchSize`.
+    With a `deduplicator`, duplicates are dropped across batches too, if its scope is
+    'global', and each sample is written with the 'count' of samples it stands for.
+    '''
+    sizer = AdaptiveBatchSize(batch_size, memory_budget=memory_budget)
+    for ib, (i, j) in enumerate(sizer.slices(len(df))):
+        log(f'Batch {ib}...')
+        with span('write_ner_json_batch'):
+            cnt_pos, cnt_neg, ner_data = get_ner_data(
+                papers, df.iloc[i:j],
+                mark_title=mark_title, mark_text=mark_text,
+                classlabel=classlabel, pretokenizer=pretokenizer,
+                sentence_definition=sentence_definition, max_length=max_length, overlap=overlap,
+                neg_keywords=neg_keywords, neg_sample_prob=neg_sample_prob,
+                deduplicator=deduplicator)
+            sizer.update(j - i)
+            write_ner_json(ner_data, pth=pth, mode='w' if i == 0 else 'a')
+    if deduplicator is not None:
+        # Counts of samples in earlier batches go up with duplicates in later ones.
+        deduplicator.write_counts(pth)
 
 # Cell
 def create_tokenizer(model_checkpoint='distilbert-base-cased'):
@@ -492,18 +1048,122 @@ def compute_metrics(p, metric=None, word_ids=None, label_list=None):
         "accuracy": results["overall_accuracy"],
     }
 
+# Cell
+def _tokenize_ner_dataset(dataset, tokenize_fn, tokenizer):
+    dataset = dataset.map(partial(tokenize_fn, tokenizer=tokenizer), batched=True,
+                          remove_columns=dataset.column_names)
+    return dataset.remove_columns(['word_ids']), dataset['word_ids']
+
+
+def train_ner(pth_train, model_checkpoint=None, pth_valid=None, metric=None, num_train_epochs=1,
+              batch_size=16, learning_rate=2e-5, output_dir='showus_training', seed=0, callbacks=None,
+              model=None, tokenizer=None, tokenize_fn=tokenize_and_align_labels, data_collator=None,
+              trainer_cls=Trainer, **kwargs):
+    '''
+    Fine-tune a model from `model_checkpoint` on the NER data in json file `pth_train`, as
+    written by `write_ner_json`.  If `pth_valid` is given, the trainer evaluates on it with
+    `compute_metrics` and `metric`.
+
+    Args:
+        model_checkpoint (None, str): Checkpoint to start from.  Only optional if
+            both `model` and `tokenizer` are given.
+        model (None, torch.nn.Module): Model to train instead of one from `model_checkpoint`,
+            e.g. a `showus.earlyexit.EarlyExitForTokenClassification`.
+        tokenizer (None, transformers.PreTrainedTokenizerFast): If None, it's
+            `create_tokenizer(model_checkpoint)`.
+        tokenize_fn (callable): Tokenises the training examples, like `tokenize_and_align_labels`,
+            e.g. `showus.distill.tokenize_and_align_soft_labels`.  The validation set is always
+            tokenised with `tokenize_and_align_labels`.
+        data_collator (None, callable): If None, `DataCollatorForTokenClassification`.
+        trainer_cls (type): `Trainer`, or a subclass of it, e.g. `showus.distill.DistillationTrainer`.
+        kwargs: Passed to `trainer_cls`, e.g. `temperature`.
+
+    Returns:
+        trainer (Trainer): Trainer of the fine-tuned model, `trainer.model`.
+    '''
+    if model_checkpoint is None and (model is None or tokenizer is None):
+        raise ValueError('`model_checkpoint` is needed, unless both `model` and `tokenizer` are given.')
+    tokenizer = create_tokenizer(model_checkpoint) if tokenizer is None else tokenizer
+    classlabel = get_ner_classlabel()
+    data_files = {'train': str(pth_train)}
+    if pth_valid is not None:
+        data_files['valid'] = str(pth_valid)
+    datasets = load_ner_datasets(data_files=data_files)
+    train_dataset, _ = _tokenize_ner_dataset(datasets['train'], tokenize_fn, tokenizer)
+    eval_dataset, word_ids = None, None
+    if pth_valid is not None:
+        eval_dataset, word_ids = _tokenize_ner_dataset(datasets['valid'], tokenize_and_align_labels, tokenizer)
+
+    if model is None:
+        model = AutoModelForTokenClassification.from_pretrained(model_checkpoint,
+                                                                num_labels=classlabel.num_classes)
+        model.resize_token_embeddings(len(tokenizer))
+    # The datasets only have the columns made by `tokenize_fn`, which `trainer_cls` may need even
+    # if they aren't arguments of the model, like 'soft_labels', so `Trainer` mustn't drop them.
+    args = TrainingArguments(output_dir=str(output_dir), num_train_epochs=num_train_epochs,
+                             learning_rate=learning_rate, weight_decay=0.01,
+                             per_device_train_batch_size=batch_size, per_device_eval_batch_size=batch_size,
+                             save_strategy='no', report_to='none', seed=seed, remove_unused_columns=False)
+    trainer = trainer_cls(model=model, args=args, train_dataset=train_dataset, eval_dataset=eval_dataset,
+                          data_collator=(DataCollatorForTokenClassification(tokenizer) if data_collator is None
+                                         else data_collator),
+                          compute_metrics=partial(compute_metrics, metric=metric, word_ids=word_ids,
+                                                  label_list=classlabel.names),
+                          callbacks=callbacks, **kwargs)
+    trainer.train()
+    return trainer
+
+# Cell
+def get_paper_inference_sentences(paper, mark_title=False, mark_text=False,
+                                  pretokenizer=BertPreTokenizer(),
+                                  sentence_definition='sentence', max_length=64, overlap=20,
+                                  min_length=10, contains_keywords=['data', 'study'],
+                                  section_policy=None):
+    '''
+    Get the sentences of a single paper to do inference on.
+
+    Args:
+        paper (list): Each element is a dict of form {'section_title': "...", 'text': "..."}.
+        max_length (int): Maximum number of words allowed in a sentence.
+        min_length (int): Mininum number of characters required in a sentence.
+        section_policy (None, dict): If given, sections are first pruned with
+            `prune_sections`, with this policy.
+
+    Returns:
+        sentences (list): Each element is a list of words.
+    '''
+    if section_policy is not None:
+        paper = prune_sections(paper, section_policy)
+    sentences = extract_sentences(paper, sentence_definition, mark_title, mark_text)
+    sentences = [text2words(s, pretokenizer=pretokenizer) for s in sentences]
+    sentences = shorten_sentences(sentences, max_length=max_length, overlap=overlap)
+
+    if min_length > 0:
+        sentences = [
+            sentence for sentence in sentences if len(' '.join(sentence)) > min_length]
+
+    if contains_keywords is not None:
+        sentences = [
+            sentence for sentence in sentences
+            if any(kw in ' '.join(word.lower() for word in sentence) for kw in contains_keywords)]
+
+    return sentences
+
 # Cell
 def get_ner_inference_data(papers, sample_submission,
                            mark_title=False, mark_text=False,
                            pretokenizer=BertPreTokenizer(), classlabel=get_ner_classlabel(),
                            sentence_definition='sentence', max_length=64, overlap=20,
-                           min_length=10, contains_keywords=['data', 'study']):
+                           min_length=10, contains_keywords=['data', 'study'], section_policy=None):
     '''
     Args:
-        papers (dict): Each list in this dictionary consists of the section of a paper.
+        papers (dict, str, Path): Each list in this dictionary consists of the section of a paper.
+            Or, the directory containing the papers' json files, which are then read ahead
+            with `iter_papers`.
         sample_submission (pd.DataFrame): Competition 'sample_submission.csv'.
         max_length (int): Maximum number of words allowed in a sentence.
         min_length (int): Mininum number of characters required in a sentence.
+        section_policy (None, dict): Passed to `get_paper_inference_sentences`.
 
     Returns:
         test_rows (list): Each list in this list is of the form:
@@ -513,41 +1173,46 @@ def get_ner_inference_data(papers, sample_submission,
     test_rows = []
     paper_length = []
 
-    for paper_id in sample_submission['Id']:
-        paper = papers[paper_id]
-
-        sentences = extract_sentences(paper, sentence_definition, mark_title, mark_text)
-        sentences = [text2words(s, pretokenizer=pretokenizer) for s in sentences]
-        sentences = shorten_sentences(sentences, max_length=max_length, overlap=overlap)
-
-        if min_length > 0:
-            sentences = [
-                sentence for sentence in sentences if len(' '.join(sentence)) > min_length]
+    if isinstance(papers, (str, Path)):
+        paper_iter = iter_papers(papers, sample_submission['Id'])
+    else:
+        paper_iter = ((paper_id, papers[paper_id]) for paper_id in sample_submission['Id'])
 
-        if contains_keywords is not None:
-            sentences = [
-                sentence for sentence in sentences
-                if any(kw in ' '.join(word.lower() for word in sentence) for kw in contains_keywords)]
+    for paper_id, paper in paper_iter:
+        sentences = get_paper_inference_sentences(
+            paper, mark_title=mark_title, mark_text=mark_text, pretokenizer=pretokenizer,
+            sentence_definition=sentence_definition, max_length=max_length, overlap=overlap,
+            min_length=min_length, contains_keywords=contains_keywords, section_policy=section_policy)
 
         for sentence in sentences:
             dummy_tags = [classlabel.str2int('O')]*len(sentence)
             test_rows.append(list(zip(sentence, dummy_tags)))
 
         paper_length.append(len(sentences))
+        count('papers')
+        count('sentences', len(sentences))
+        count('words', sum(len(sentence) for sentence in sentences))
 
-    print(f'total number of "sentences": {len(test_rows)}')
+    log(f'total number of "sentences": {len(test_rows)}')
     return test_rows, paper_length
 
 # Cell
 
+@spanned()
 def batched_write_ner_inference_json(papers, sample_submission,
-                                     pth='test_ner.json', batch_size=1_000, **kwargs):
-
+                                     pth='test_ner.json', batch_size=1_000, memory_budget=None,
+                                     **kwargs):
+    '''
+    `batch_size` papers are processed at a time.  If `memory_budget` (MB) is given,
+    `batch_size` is just the first batch's size, and is adjusted with `AdaptiveBatchSize`.
+    '''
     paper_length = []
 
-    for i in range(0, len(sample_submission), batch_size):
+    sizer = AdaptiveBatchSize(batch_size, memory_budget=memory_budget)
+    for i, j in sizer.slices(len(sample_submission)):
         test_rows, bpaper_length = get_ner_inference_data(
-            papers, sample_submission.iloc[i:i + batch_size], **kwargs)
+            papers, sample_submission.iloc[i:j], **kwargs)
+        sizer.update(j - i)
 
         write_ner_json(test_rows, pth, mode='w' if i==0 else 'a')
         paper_length.extend(bpaper_length)
@@ -556,22 +1221,21 @@ def batched_write_ner_inference_json(papers, sample_submission,
 
 # Cell
 
+@spanned()
 def ner_predict(pth=None, tokenizer=None, model=None, metric=None,
                 per_device_train_batch_size=16, per_device_eval_batch_size=16):
     classlabel = get_ner_classlabel()
     datasets = load_ner_datasets(data_files={'test':pth})
 
-    print('Tokenizing testset...', end='')
-    t0 = time.time()
-    tokenized_datasets = datasets.map(
-        partial(tokenize_and_align_labels, tokenizer=tokenizer, label_all_tokens=True),
-        batched=True)
-    print(f'completed in {(time.time() - t0) / 60:.2f} mins.')
+    with span('tokenize'):
+        tokenized_datasets = datasets.map(
+            partial(tokenize_and_align_labels, tokenizer=tokenizer, label_all_tokens=True),
+            batched=True)
 
-    print('Creating data collator...')
+    log('Creating data collator...')
     data_collator = DataCollatorForTokenClassification(tokenizer)
 
-    print('Creating (dummy) training arguments...')
+    log('Creating (dummy) training arguments...')
     args = TrainingArguments(output_dir='test_ner', num_train_epochs=3,
                              learning_rate=2e-5, weight_decay=0.01,
                              per_device_train_batch_size=per_device_train_batch_size,
@@ -579,54 +1243,257 @@ def ner_predict(pth=None, tokenizer=None, model=None, metric=None,
                              evaluation_strategy='epoch', logging_steps=4, report_to='none',
                              save_strategy='epoch', save_total_limit=6)
 
-    print('Creating trainer...')
+    log('Creating trainer...')
     word_ids = tokenized_datasets['test']['word_ids']
+    count('sentences_predicted', len(word_ids))
+    count_padding((len(w) for w in word_ids), per_device_eval_batch_size)
     compute_metrics_ = partial(compute_metrics, metric=metric, label_list=classlabel.names, word_ids=word_ids)
     trainer = Trainer(model=model, args=args,
                       train_dataset=tokenized_datasets['test'], eval_dataset=tokenized_datasets['test'],
                       data_collator=data_collator, tokenizer=tokenizer, compute_metrics=compute_metrics_)
 
-    print('Predicting on test samples...')
-    t0 = time.time()
-    predictions, label_ids, _ = trainer.predict(tokenized_datasets['test'])
-    print(f'completed in {(time.time() - t0) / 60:.2f} mins.')
+    with span('predict'):
+        predictions, label_ids, _ = trainer.predict(tokenized_datasets['test'])
 
-    print('Argmaxing...')
-    t0 = time.time()
-    predictions = predictions.argmax(axis=2)
-    print(f'completed in {(time.time() - t0) / 60:.2f} mins.')
+    with span('argmax'):
+        predictions = predictions.argmax(axis=2)
 
-    print('Removing non-original outputs...', end='')
-    t0 = time.time()
-    predictions = remove_nonoriginal_outputs(predictions, word_ids)
-    label_ids   = remove_nonoriginal_outputs(label_ids, word_ids)
-    print(f'completed in {(time.time() - t0) / 60:.2f} mins.')
+    with span('remove_nonoriginal_outputs'):
+        predictions = remove_nonoriginal_outputs(predictions, word_ids)
+        label_ids   = remove_nonoriginal_outputs(label_ids, word_ids)
 
     return predictions, label_ids
 
 # Cell
+def _model_digest(model):
+    '''
+    Hex digest of a model's weights.
+    '''
+    h = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        h.update(name.encode('utf-8'))
+        h.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+    return h.hexdigest()
+
+
+class StoredPredictions:
+    '''
+    Predictions stored by `batched_ner_predict`, read from disk one sentence
+    at a time, as they are iterated over.  On first indexing, the offset of each
+    line in the file is recorded, so that each item or slice is read with one seek.
+    '''
+    def __init__(self, pth, field=0, length=0):
+        self.pth, self.field, self.length = pth, field, length
+        self._offsets = None
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        with open(self.pth, mode='r') as f:
+            for line in itertools.islice(f, self.length):
+                yield json.loads(line)[self.field]
+
+    def _line_offsets(self):
+        if self._offsets is None:
+            offsets = []
+            with open(self.pth, mode='rb') as f:
+                for _ in range(self.length):
+                    offsets.append(f.tell())
+                    f.readline()
+            self._offsets = offsets
+        return self._offsets
+
+    def _read(self, start, stop):
+        with open(self.pth, mode='rb') as f:
+            f.seek(self._line_offsets()[start])
+            return [json.loads(f.readline())[self.field] for _ in range(start, stop)]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            return self._read(start, stop) if start < stop else []
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return self._read(i, i + 1)[0]
+
 
 def batched_ner_predict(pth, tokenizer=None, model=None, metric=None,
                         batch_size=64_000,
-                        per_device_train_batch_size=16, per_device_eval_batch_size=16):
+                        per_device_train_batch_size=16, per_device_eval_batch_size=16,
+                        store_dir=None, memory_budget=None):
     '''
     Do inference on dataset in batches.
+
+    If `store_dir` is given, the predictions for each batch are appended to a file
+    in `store_dir` as soon as the batch is done, and then a progress marker is updated.
+    Calling again with the same `pth`, model and `batch_size` resumes from the first
+    sentence that isn't done.  The predictions returned are then `StoredPredictions`,
+    read from the file as they are iterated over, rather than held in memory.
+
+    If `memory_budget` (MB) is given, `batch_size` is just the first batch's size,
+    and is adjusted with `AdaptiveBatchSize`.
     '''
-    lines = open(pth, mode='r').readlines()
+    if store_dir is not None:
+        key = hashlib.sha1(json.dumps([
+            hashlib.sha1(open(pth, mode='rb').read()).hexdigest(), _model_digest(model), batch_size
+        ]).encode('utf-8')).hexdigest()
+        store = Path(store_dir)/key
+        store.mkdir(parents=True, exist_ok=True)
+        pth_store, pth_progress = store/'predictions.jsonl', store/'progress.json'
+        progress = {'batches': 0, 'sentences': 0, 'offset': 0}
+        if pth_progress.exists():
+            progress = json.load(open(pth_progress, mode='r'))
+            log(f"Resuming after {progress['batches']} batches.")
+            count('resumed_batches', progress['batches'])
+        # Drop anything appended after the last progress marker.
+        with open(pth_store, mode='a') as f:
+            f.truncate(progress['offset'])
 
     pth_tmp = 'ner_predict_tmp.json'
     predictions, label_ids = [], []
-    for ib in range(0, len(lines), batch_size):
-        with open(pth_tmp, mode='w') as f:
-            f.writelines(lines[ ib: ib + batch_size ])
-
-        predictions_, label_ids_ = ner_predict(
-            pth_tmp, tokenizer=tokenizer, model=model, metric=metric,
-            per_device_train_batch_size=per_device_train_batch_size,
-            per_device_eval_batch_size=per_device_eval_batch_size)
-        predictions.extend(predictions_)
-        label_ids.extend(label_ids_)
-    return predictions, label_ids
+    sizer = AdaptiveBatchSize(batch_size, memory_budget=memory_budget)
+    sizer.start()
+    with open(pth, mode='r') as f:
+        if store_dir is not None:  # Skip the sentences already done.
+            for _ in itertools.islice(f, progress['sentences']):
+                pass
+        batches = iter(lambda: list(itertools.islice(f, sizer.size)), [])
+        for lines in batches:
+            with open(pth_tmp, mode='w') as f_tmp:
+                f_tmp.writelines(lines)
+
+            predictions_, label_ids_ = ner_predict(
+                pth_tmp, tokenizer=tokenizer, model=model, metric=metric,
+                per_device_train_batch_size=per_device_train_batch_size,
+                per_device_eval_batch_size=per_device_eval_batch_size)
+            sizer.update(len(lines))
+
+            if store_dir is None:
+                predictions.extend(predictions_)
+                label_ids.extend(label_ids_)
+                continue
+
+            with open(pth_store, mode='a') as f_store:
+                for pred, label in zip(predictions_, label_ids_):
+                    f_store.write(json.dumps([[int(p) for p in pred], [int(l) for l in label]]) + '\n')
+                f_store.flush()
+                os.fsync(f_store.fileno())
+                offset = f_store.tell()
+            progress = {'batches': progress['batches'] + 1,
+                        'sentences': progress['sentences'] + len(predictions_), 'offset': offset}
+            with open(pth_progress.with_suffix('.tmp'), mode='w') as f_progress:
+                json.dump(progress, f_progress)
+            os.replace(pth_progress.with_suffix('.tmp'), pth_progress)
+
+    if store_dir is None:
+        return predictions, label_ids
+    return (StoredPredictions(pth_store, field=0, length=progress['sentences']),
+            StoredPredictions(pth_store, field=1, length=progress['sentences']))
+
+# Cell
+def tokenize_sentences(sentences, tokenizer=None):
+    '''
+    Args:
+        sentences (list): Each element is a list of words.
+        tokenizer (transformers.AutoTokenizer): Tokenizer.
+
+    Returns:
+        inputs (transformers.BatchEncoding): Model inputs, padded to the longest sentence.
+        word_ids (list): For each sentence, the index of the word that each sub-token
+            belongs to.  None for special tokens and padding.
+    '''
+    inputs = tokenizer(sentences, truncation=True, is_split_into_words=True,
+                       padding=True, return_tensors='pt')
+    word_ids = [inputs.word_ids(batch_index=i) for i in range(len(sentences))]
+    count('subword_tokens', int(inputs['attention_mask'].sum()))
+    count('padded_positions', inputs['attention_mask'].numel())
+    return inputs, word_ids
+
+
+def predict_probs(inputs, model=None):
+    '''
+    Class probabilities for every sub-token.
+
+    Returns:
+        probs (np.array): Of shape (number of sentences, number of sub-tokens, number of classes).
+    '''
+    model.eval()
+    inputs = {k: v.to(model.device) for k, v in inputs.items()}
+    with torch.no_grad():
+        logits = model(**inputs).logits
+    return torch.softmax(logits, dim=-1).cpu().numpy()
+
+
+def get_word_probs(probs, word_ids):
+    '''
+    Keep just the probabilities of the first sub-token of each word, like
+    `remove_nonoriginal_outputs` does for label ids.
+
+    Returns:
+        word_probs (list): For each sentence, an np.array of shape
+            (number of words, number of classes).
+    '''
+    word_probs = []
+    for prob, word_id in zip(probs, word_ids):
+        idx = [i for i, w in enumerate(word_id)
+               if w is not None and (i == 0 or word_id[i - 1] != w)]
+        word_probs.append(prob[idx])
+    return word_probs
+
+# Cell
+def batched_word_probs(sentences, tokenizer=None, model=None, batch_size=64):
+    '''
+    Word-level class probabilities for many sentences, with a forward pass on
+    `batch_size` sentences at a time.  Sentences are batched in order of length,
+    to keep padding to a minimum.
+
+    Returns:
+        word_probs (list): For each sentence, an np.array of shape
+            (number of words, number of classes).
+    '''
+    order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+    word_probs = [None] * len(sentences)
+    for ib in range(0, len(order), batch_size):
+        idx = order[ib:ib + batch_size]
+        inputs, word_ids = tokenize_sentences([sentences[i] for i in idx], tokenizer=tokenizer)
+        probs = predict_probs(inputs, model=model)
+        for i, prob in zip(idx, get_word_probs(probs, word_ids)):
+            word_probs[i] = prob
+    return word_probs
+
+# Cell
+def get_sentence_dataset_labels(sentence, pred):
+    '''
+    Args:
+        sentence (list): List of words.
+        pred (list): Predicted tag ('O', 'I', or 'B') for each word.
+
+    Returns:
+        labels (set): Phrases tagged as dataset labels.
+    '''
+    labels = set()
+    curr_phrase = ''
+    for word, tag in zip(sentence, pred):
+        if tag == 'B': # start a new phrase
+            if curr_phrase:
+                labels.add(curr_phrase)
+                curr_phrase = ''
+            curr_phrase = word
+        elif tag == 'I' and curr_phrase: # continue the phrase
+            curr_phrase += ' ' + word
+        else: # end last phrase (if any)
+            if curr_phrase:
+                labels.add(curr_phrase)
+                curr_phrase = ''
+    # check if the label is the suffix of the sentence
+    if curr_phrase:
+        labels.add(curr_phrase)
+    return labels
 
 # Cell
 def get_paper_dataset_labels(pth, paper_length, predictions):
@@ -634,40 +1501,25 @@ def get_paper_dataset_labels(pth, paper_length, predictions):
     Args:
         pth (Path, str): Path to json file containing NER data.  Each row is
             of form: {'tokens': ['Studying', 'human'], 'ner_tags': [0, 0, ...]}.
+        predictions (iterable): Predicted tags for each sentence in `pth`.  Only
+            iterated over once, so it can be, for example, `StoredPredictions`.
 
     Returns:
         paper_dataset_labels (list): Each element is a set consisting of labels predicted
             by the model.
     '''
-    test_sentences = [json.loads(sample)['tokens'] for sample in open(pth).readlines()]
-
     paper_dataset_labels = [] # store all dataset labels for each publication
-    for ipaper in range(len(paper_length)):
-        istart = sum(paper_length[:ipaper])
-        iend = istart + paper_length[ipaper]
-
-        labels = set()
-        for sentence, pred in zip(test_sentences[istart:iend], predictions[istart:iend]):
-            curr_phrase = ''
-            for word, tag in zip(sentence, pred):
-                if tag == 'B': # start a new phrase
-                    if curr_phrase:
-                        labels.add(curr_phrase)
-                        curr_phrase = ''
-                    curr_phrase = word
-                elif tag == 'I' and curr_phrase: # continue the phrase
-                    curr_phrase += ' ' + word
-                else: # end last phrase (if any)
-                    if curr_phrase:
-                        labels.add(curr_phrase)
-                        curr_phrase = ''
-            # check if the label is the suffix of the sentence
-            if curr_phrase:
-                labels.add(curr_phrase)
-                curr_phrase = ''
-
-        # record dataset labels for this publication
-        paper_dataset_labels.append(labels)
+    with open(pth, mode='r') as f:
+        test_sentences = (json.loads(sample)['tokens'] for sample in f)
+        predictions = iter(predictions)
+        for n in paper_length:
+            labels = set()
+            for sentence, pred in zip(itertools.islice(test_sentences, n),
+                                      itertools.islice(predictions, n)):
+                labels |= get_sentence_dataset_labels(sentence, pred)
+
+            # record dataset labels for this publication
+            paper_dataset_labels.append(labels)
 
     return paper_dataset_labels
 
@@ -690,13 +1542,22 @@ def create_knowledge_bank(pth):
     return all_labels
 
 # Cell
+@spanned(log=False)
 def literal_match(paper, all_labels):
     '''
     Args:
-        paper ()
+        paper (list, PaperText): Each element is a dict of form {'section_title': "...", 'text': "..."}.
+        all_labels (set, KnowledgeBank): Labels to look for, lowercased, like those returned
+            by `create_knowledge_bank`.  A `KnowledgeBank` does the matching itself.
+
+    Returns:
+        labels (set): Cleaned labels found in the paper.
     '''
-    text_1 = '. '.join(section['text'] for section in paper).lower()
-    text_2 = clean_training_text(text_1, lower=True, total_clean=True)
+    if hasattr(all_labels, 'match'):
+        return all_labels.match(paper)
+
+    paper = paper_text(paper)
+    text_1, text_2 = paper.lower, paper.cleaned
 
     labels = set()
     for label in all_labels:
@@ -704,6 +1565,121 @@ def literal_match(paper, all_labels):
             labels.add(clean_training_text(label, lower=True, total_clean=True))
     return labels
 
+# Cell
+class KnowledgeBank:
+    '''
+    Dataset labels to match literally, lowercased, each with its cleaned form.
+    It can be passed to `literal_match` in place of the set from `create_knowledge_bank`.
+
+    Args:
+        labels (iter): Labels to start with.
+    '''
+    def __init__(self, labels=()):
+        self.labels = {}  # lowercased label -> cleaned label
+        self._automaton = None
+        self.add(labels)
+
+    @classmethod
+    def from_meta(cls, pth):
+        '''
+        Knowledge bank with the labels in meta data like 'train.csv'.
+        '''
+        knowledge_bank = cls()
+        knowledge_bank.add_meta(pth)
+        return knowledge_bank
+
+    def add(self, labels):
+        '''
+        Add `labels`, e.g. ones found by a model.
+
+        Returns:
+            n (int): Number of labels that weren't already in the knowledge bank.
+        '''
+        n = 0
+        for label in labels:
+            label = str(label).lower()
+            if label and label not in self.labels:
+                self.labels[label] = clean_training_text(label, lower=True, total_clean=True)
+                if self._automaton is not None:
+                    self._automaton.add_word(label, label)
+                n += 1
+        return n
+
+    def add_meta(self, pth):
+        '''
+        Add the 'dataset_title', 'dataset_label', and 'cleaned_label' of each row
+        in meta data like 'train.csv', given as a path or a `pd.DataFrame`.
+        '''
+        df = load_train_meta(pth, group_id=False) if isinstance(pth, (str, Path)) else pth
+        return self.add(df[['dataset_title', 'dataset_label', 'cleaned_label']].to_numpy().ravel())
+
+    def _index(self):
+        if ahocorasick is None or not self.labels:
+            return None
+        if self._automaton is None:
+            self._automaton = ahocorasick.Automaton()
+            for label in self.labels:
+                self._automaton.add_word(label, label)
+        if self._automaton.kind != ahocorasick.AHOCORASICK:
+            self._automaton.make_automaton()
+        return self._automaton
+
+    def find(self, text):
+        '''
+        Labels that occur in `text`, which should be lowercased.
+        '''
+        index = self._index()
+        if index is None:
+            return {label for label in self.labels if label in text}
+        return {label for _, label in index.iter(text)}
+
+    def match(self, paper):
+        '''
+        Cleaned labels that occur in `paper`, as `literal_match` finds them.
+        '''
+        paper = paper_text(paper)
+        return {self.labels[label] for label in self.find(paper.lower) | self.find(paper.cleaned)}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __contains__(self, label):
+        return str(label).lower() in self.labels
+
+    def __getstate__(self):
+        index = self._index()
+        return {'labels': self.labels, 'automaton': None if index is None else pickle.dumps(index)}
+
+    def __setstate__(self, state):
+        self.labels = state['labels']
+        self._automaton = None
+        if ahocorasick is not None and state['automaton'] is not None:
+            self._automaton = pickle.loads(state['automaton'])
+
+    def save(self, pth):
+        '''
+        Save to binary file at `pth`, to be loaded with `KnowledgeBank.load`.
+        '''
+        with open(pth, mode='wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(pth):
+        with open(pth, mode='rb') as f:
+            return pickle.load(f)
+
+
+def load_knowledge_bank(pth):
+    '''
+    Load `KnowledgeBank` saved at `pth`, or, if `pth` is a csv file, make one from the meta data in it.
+    '''
+    if Path(pth).suffix == '.csv':
+        return KnowledgeBank.from_meta(pth)
+    return KnowledgeBank.load(pth)
+
 # Cell
 def combine_matching_and_model(literal_preds, paper_dataset_labels):
     '''
@@ -728,28 +1704,61 @@ def combine_matching_and_model(literal_preds, paper_dataset_labels):
     return all_labels
 
 # Cell
-def filter_dataset_labels(all_labels, max_similarity=0.75):
+def _filter_labels(labels, max_similarity=0.75):
+    '''
+    Clean `labels` of a paper, and remove those too similar to one kept before them.
+
+    Returns:
+        filtered (str): Labels kept, seperated by '|'.
+    '''
+    labels = [clean_training_text(label, lower=True) for label in labels]
+    if len(labels) < 2:
+        return '|'.join(labels)
+
+    # Each label, as a row of 0s and 1s for the words it contains.
+    word_ids, rows, cols = {}, [], []
+    for i, label in enumerate(labels):
+        for word in set(label.split(' ')):
+            rows.append(i)
+            cols.append(word_ids.setdefault(word, len(word_ids)))
+    words = np.zeros((len(labels), len(word_ids)), dtype=np.float32)
+    words[rows, cols] = 1
+
+    intersection = (words @ words.T).astype(np.float64)
+    size = words.sum(axis=1, dtype=np.float64)
+    too_similar = intersection / (size[:, None] + size[None, :] - intersection) >= max_similarity
+
+    filtered, removed = [], np.zeros(len(labels), dtype=bool)
+    for i, label in enumerate(labels):
+        if not removed[i]:
+            filtered.append(label)
+            removed |= too_similar[i]
+    return '|'.join(filtered)
+
+
+def filter_dataset_labels(all_labels, max_similarity=0.75, num_workers=1, chunksize=64):
     '''
     When several labels for a paper are too similar, keep just one of them,
     the one that appears FIRST.
 
+    Each label is split into words once, and the Jaccard similarities, as computed by
+    `jaccard_similarity`, between all of a paper's labels are computed together, from
+    the product of a matrix of the words in each label with its transpose.
+
     Args:
         all_labels (list, set): Each element is a list of labels (str).
+        num_workers (int): If more than 1, papers are filtered in this many processes.
+        chunksize (int): Number of papers sent to a process at a time.
 
     Returns:
         filtered_dataset_labels (list): Each element is a string, containing
             labels seperated by '|'.
     '''
-    filtered_dataset_labels = []
-
-    for labels in all_labels:
-        filtered = []
-
-        for label in labels:
-            label = clean_training_text(label, lower=True)
-            if len(filtered) == 0 or all(jaccard_similarity(label, got_label) < max_similarity
-                                         for got_label in filtered):
-                filtered.append(label)
-
-        filtered_dataset_labels.append('|'.join(filtered))
-    return filtered_dataset_labels
\ No newline at end of file
+    # Sets are made lists here, so that their order, which decides which label is
+    # kept, is the same as this process', not that of the process filtering them.
+    all_labels = [list(labels) for labels in all_labels]
+    if num_workers > 1 and len(all_labels) > chunksize:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            return list(executor.map(partial(_filter_labels, max_similarity=max_similarity),
+                                     all_labels, chunksize=chunksize))
+    return [_filter_labels(labels, max_similarity) for labels in all_labels]
\ No newline at end of file
@@ -0,0 +1,125 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/streaming.ipynb (unless otherwise specified).
+
+__all__ = ['StreamingNERDataset', 'StreamingEpochCallback']
+
+# Cell
+import os, sys, time
+import hashlib
+import random
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import torch
+from transformers import TrainerCallback
+from .showus import *
+from .instrument import count
+
+# Cell
+class StreamingNERDataset(torch.utils.data.IterableDataset):
+    '''
+    Tokenised NER training examples, tagged from papers as they're read.  Each example is a
+    dict with 'input_ids', 'attention_mask' and 'labels', to be batched with
+    `DataCollatorForTokenClassification`.  It has no length, so `Trainer` needs `max_steps`.
+
+    Args:
+        papers (dict, str, Path): Like that returned by `load_papers`, or the directory
+            containing the papers' json files.
+        df (pd.DataFrame, str, Path): Competition's train.csv, or a subset of it, or a path to it.
+        tokenizer (transformers.PreTrainedTokenizerFast): Tokenizer, e.g. from `create_tokenizer`.
+        label_all_tokens (bool): Passed to `tokenize_and_align_labels`.
+        shuffle (bool): Shuffle the papers and the examples, differently for each epoch.
+        shuffle_buffer (int): Number of examples shuffled together.
+        seed (int): Seed of the shuffling and of the negatives sampled.
+        kwargs: Passed to `get_paper_ner_data`, e.g. `max_length` and `neg_sample_prob`.
+    '''
+    def __init__(self, papers, df, tokenizer, label_all_tokens=True, shuffle=True,
+                 shuffle_buffer=1_000, seed=0, **kwargs):
+        super().__init__()
+        df = load_train_meta(df) if isinstance(df, (str, Path)) else df
+        self.papers, self.tokenizer, self.label_all_tokens = papers, tokenizer, label_all_tokens
+        self.paper_labels = list(zip(df['Id'], df['dataset_label']))
+        self.shuffle, self.shuffle_buffer, self.seed = shuffle, shuffle_buffer, seed
+        self.kwargs = kwargs
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        '''
+        Sample the papers, negatives and order of epoch `epoch`.  With `Trainer`, it's called
+        by `StreamingEpochCallback`.
+        '''
+        self.epoch = epoch
+
+    def _rng(self, *keys):
+        digest = hashlib.sha1('-'.join(map(str, (self.seed, self.epoch) + keys)).encode()).digest()
+        return int.from_bytes(digest[:4], 'little')
+
+    def _shard(self):
+        paper_labels = list(self.paper_labels)
+        if self.shuffle:
+            random.Random(self._rng('papers')).shuffle(paper_labels)
+        info = torch.utils.data.get_worker_info()
+        if info is None:
+            return paper_labels, 0
+        return paper_labels[info.id::info.num_workers], info.id
+
+    def _read(self, paper_ids):
+        if isinstance(self.papers, (str, Path)):
+            return iter_papers(self.papers, paper_ids, num_workers=2)
+        return ((paper_id, self.papers[paper_id]) for paper_id in paper_ids)
+
+    def _examples(self, paper_labels):
+        labels = dict(paper_labels)
+        for paper_id, paper in self._read([paper_id for paper_id, _ in paper_labels]):
+            _, _, ner_data = get_paper_ner_data(paper, labels[paper_id].split('|'),
+                                                rng=np.random.RandomState(self._rng(paper_id)),
+                                                **self.kwargs)
+            count('papers')
+            count('sentences', len(ner_data))
+            if not ner_data:
+                continue
+            tokenized = tokenize_and_align_labels(
+                {'tokens': [[word for word, _ in row] for row in ner_data],
+                 'ner_tags': [[tag for _, tag in row] for row in ner_data]},
+                tokenizer=self.tokenizer, label_all_tokens=self.label_all_tokens)
+            for i in range(len(ner_data)):
+                yield {'input_ids': tokenized['input_ids'][i],
+                       'attention_mask': tokenized['attention_mask'][i],
+                       'labels': tokenized['labels'][i]}
+
+    def __iter__(self):
+        paper_labels, worker_id = self._shard()
+        examples = self._examples(paper_labels)
+        if not self.shuffle:
+            yield from examples
+            return
+
+        rnd, buffer = random.Random(self._rng('examples', worker_id)), []
+        for example in examples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(example)
+                continue
+            i = rnd.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = example
+        rnd.shuffle(buffer)
+        yield from buffer
+
+# Cell
+class StreamingEpochCallback(TrainerCallback):
+    '''
+    Calls `dataset.set_epoch` at the start of each of `Trainer`'s epochs.  They're counted here,
+    since `state.epoch` is only a fraction of `max_steps` for a dataset with no length.
+
+    Args:
+        dataset (StreamingNERDataset): `Trainer`'s `train_dataset`.
+    '''
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.epoch = 0
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.epoch = 0
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.dataset.set_epoch(self.epoch)
+        self.epoch += 1
\ No newline at end of file
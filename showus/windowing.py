@@ -0,0 +1,148 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/windowing.ipynb (unless otherwise specified).
+
+__all__ = ['window_sentences', 'stitch_window_probs', 'windowed_predict_probs', 'windowed_ner_predict']
+
+# Cell
+import os, sys, time
+import json
+import numpy as np
+import torch
+from .showus import *
+from .instrument import span, count, log
+
+# Cell
+def window_sentences(sentences, tokenizer=None, max_tokens=None, stride=32):
+    '''
+    Split sentences into overlapping windows of sub-tokens.
+
+    Args:
+        sentences (list): Each element is a list of words.
+        max_tokens (None, int): Maximum number of sub-tokens in a window, including
+            special tokens.  Defaults to the tokenizer's `model_max_length`.
+        stride (int): Number of sub-tokens shared by consecutive windows of a sentence.
+
+    Returns:
+        windows (transformers.BatchEncoding): Unpadded model inputs for each window.
+        sample_idx (list): Index of the sentence that each window comes from.
+        word_ids (list): For each window, the index of the word that each sub-token
+            belongs to.  None for special tokens.
+        word_starts (list): For each window, whether each sub-token is the first of its
+            word in the sentence.
+    '''
+    max_tokens = max_tokens or tokenizer.model_max_length
+    windows = tokenizer(sentences, is_split_into_words=True, truncation=True,
+                        max_length=max_tokens, stride=stride, return_overflowing_tokens=True,
+                        return_offsets_mapping=True)
+    sample_idx = windows.pop('overflow_to_sample_mapping')
+    offsets = windows.pop('offset_mapping')
+    word_ids = [windows.word_ids(i) for i in range(len(sample_idx))]
+    word_starts = [[w is not None and start == 0 and (i == 0 or word_id[i - 1] != w)
+                    for i, (w, (start, _)) in enumerate(zip(word_id, offset))]
+                   for word_id, offset in zip(word_ids, offsets)]
+    return windows, sample_idx, word_ids, word_starts
+
+# Cell
+def stitch_window_probs(window_probs, sample_idx, word_ids, word_starts, num_sentences):
+    '''
+    Combine the sub-token probabilities of overlapping windows into a single
+    probability for each word.  For each word, its first sub-token is used, from the
+    window, of those that contain it, in which it's furthest from either edge.
+
+    Args:
+        window_probs (list): For each window, an np.array of shape
+            (number of sub-tokens, number of classes).
+        sample_idx, word_ids, word_starts: Like those returned by `window_sentences`.
+        num_sentences (int): Number of sentences the windows came from.
+
+    Returns:
+        word_probs (list): For each sentence, an np.array of shape
+            (number of words, number of classes).
+    '''
+    best = [{} for _ in range(num_sentences)]  # word id -> (context, probs)
+    for prob, isample, word_id, starts in zip(window_probs, sample_idx, word_ids, word_starts):
+        positions = [i for i, w in enumerate(word_id) if w is not None]
+        if not positions:
+            continue
+        first, last = positions[0], positions[-1]
+        for i in positions:
+            w = word_id[i]
+            if not starts[i]:
+                continue
+            context = min(i - first, last - i)
+            if w not in best[isample] or context > best[isample][w][0]:
+                best[isample][w] = (context, prob[i])
+
+    word_probs = []
+    for b in best:
+        word_probs.append(np.stack([b[w][1] for w in sorted(b)]) if b else np.zeros((0, 0)))
+    return word_probs
+
+# Cell
+def windowed_predict_probs(sentences, tokenizer=None, model=None, max_tokens=None, stride=32,
+                           batch_size=16):
+    '''
+    Word-level class probabilities for sentences of any length.
+
+    Args:
+        sentences (list): Each element is a list of words.
+        max_tokens, stride: Passed to `window_sentences`.
+        batch_size (int): Number of windows in each forward pass.
+
+    Returns:
+        word_probs (list): For each sentence, an np.array of shape
+            (number of words, number of classes).
+        stats (dict): 'windows': number of windows.  'tokens': number of non-special
+            sub-tokens passed through the model.  'unique_tokens': number of those that
+            are not repeats from an overlap.  'redundant_fraction': fraction of the
+            sub-tokens that are repeats, i.e. compute spent on the overlaps.
+            'padding_fraction': fraction of the positions in the forward passes that are padding.
+    '''
+    windows, sample_idx, word_ids, word_starts = window_sentences(
+        sentences, tokenizer=tokenizer, max_tokens=max_tokens, stride=stride)
+
+    window_probs, padded = [], 0
+    for i in range(0, len(sample_idx), batch_size):
+        batch = {k: v[i:i + batch_size] for k, v in windows.items()}
+        inputs = tokenizer.pad(batch, return_tensors='pt')
+        probs = predict_probs(inputs, model=model)
+        lengths = inputs['attention_mask'].sum(dim=1).tolist()
+        padded += probs.shape[0] * probs.shape[1]
+        window_probs.extend(prob[:length] for prob, length in zip(probs, lengths))
+
+    word_probs = stitch_window_probs(window_probs, sample_idx, word_ids, word_starts, len(sentences))
+
+    num_windows = np.bincount(sample_idx, minlength=len(sentences))
+    tokens = sum(sum(w is not None for w in word_id) for word_id in word_ids)
+    unique_tokens = tokens - stride * int(np.maximum(num_windows - 1, 0).sum())
+    stats = {'windows': len(sample_idx),
+             'tokens': tokens,
+             'unique_tokens': unique_tokens,
+             'redundant_fraction': (tokens - unique_tokens) / max(tokens, 1),
+             'padding_fraction': 1 - sum(len(word_id) for word_id in word_ids) / max(padded, 1)}
+    return word_probs, stats
+
+# Cell
+def windowed_ner_predict(pth, tokenizer=None, model=None, max_tokens=None, stride=32,
+                         batch_size=16):
+    '''
+    Like `batched_ner_predict`, but each sentence in the NER json file at `pth` is split
+    into windows by sub-token counts, so no part of it is truncated, and every word
+    gets exactly one prediction.
+
+    Returns:
+        predictions (list): Each element is a list of predicted label ids for the
+            words in a sentence.
+        stats (dict): As returned by `windowed_predict_probs`.
+    '''
+    sentences = [json.loads(line)['tokens'] for line in open(pth, mode='r')]
+
+    with span('windowed_predict'):
+        word_probs, stats = windowed_predict_probs(
+            sentences, tokenizer=tokenizer, model=model, max_tokens=max_tokens, stride=stride,
+            batch_size=batch_size)
+        predictions = [prob.argmax(axis=1).tolist() if len(prob) else [] for prob in word_probs]
+    count('windows', stats['windows'])
+    count('redundant_tokens', stats['tokens'] - stats['unique_tokens'])
+    log(f"{stats['windows']} windows for {len(sentences)} sentences; "
+        f"{100 * stats['redundant_fraction']:.1f}% of sub-tokens were in overlaps.")
+    return predictions, stats
\ No newline at end of file